@@ -8,20 +8,132 @@ Mozilla Public License 2.0
 """
 
 from storm.locals import *
+from storm.properties import SimpleProperty
+from storm.variables import Variable
+from storm.uri import URI
 from datetime import datetime
+from collections import OrderedDict
+import calendar
+import os
+import sys
+import sqlite3
+import time
 import settings
 import logging
 import traceback
 
 logger = logging.getLogger(settings.LOGGER)
 
-DB_SCHEMA_VERSION = "0.0.1"
+DB_SCHEMA_VERSION = "0.0.3"
 """Database Schema Version
 The database schema version of this module must match the schema version
-of the settings, otherwise the database is not loaded to avoid inconsistencies
-and destructive changes.
+stored in the database. Databases with an older schema version are migrated
+with the steps in DB_MIGRATIONS, otherwise the database is not loaded to avoid
+inconsistencies and destructive changes.
 """
 
+
+class TimestampVariable(Variable):
+    """Storm variable for a datetime stored as integer seconds since the epoch (UTC)
+    """
+    __slots__ = ()
+
+    def parse_set(self, value, from_db):
+        if from_db:
+            return datetime.utcfromtimestamp(int(value))
+        if not isinstance(value, datetime):
+            raise TypeError("Expected datetime, found %s" % repr(value))
+        return value
+
+    def parse_get(self, value, to_db):
+        if to_db:
+            return calendar.timegm(value.utctimetuple())
+        return value
+
+
+class Timestamp(SimpleProperty):
+    """Storm property for a datetime stored as integer seconds since the epoch (UTC)
+    """
+    variable_class = TimestampVariable
+
+
+class UnitOfWork:
+    """Unit of work on a database store
+
+    Changes to data objects made within a unit of work are committed to
+    the database once, when the outermost unit of work on the store ends.
+    If the unit of work ends with an exception the changes are rolled back.
+    If the commit fails, the changes are rolled back and the exception of
+    the commit is raised.
+    While a unit of work is open, the add, update and remove methods of the
+    data objects do not commit.
+
+    If any of the nested units of work is durable, the database is
+    checkpointed with settings.DB_CHECKPOINT_DURABLE after the commit.
+
+    Usage::
+
+        with UnitOfWork(store):
+            swu.start()
+            swu.addSWOperation(id, operation)
+    """
+
+    state = {}
+    """Nesting depth and durability of open units of work per store
+    """
+
+    def __init__(self, store, durable=False):
+        """Constructor
+
+        @param store Database store object for the database backend.
+        @param durable True if the changes must survive a power loss
+                       once committed
+        """
+        self.store = store
+        self.durable = durable
+
+    def __enter__(self):
+        (depth, durable) = UnitOfWork.state.get(self.store, (0, False))
+        UnitOfWork.state[self.store] = (depth + 1, durable or self.durable)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        (depth, durable) = UnitOfWork.state.pop(self.store)
+        if depth > 1:
+            UnitOfWork.state[self.store] = (depth - 1, durable)
+            return False
+        if exc_type:
+            try:
+                self.store.rollback()
+            except Exception as e:
+                logger.error('common.database.UnitOfWork.__exit__(): Exception: %s', e)
+            return False
+        try:
+            self.store.commit()
+        except Exception as e:
+            # The changes are lost, callers must not carry on as if they
+            # had been stored.
+            logger.error('common.database.UnitOfWork.__exit__(): Commit failed: %s', e)
+            commit_error = sys.exc_info()
+            try:
+                self.store.rollback()
+            except Exception as e:
+                logger.error('common.database.UnitOfWork.__exit__(): Exception: %s', e)
+            raise commit_error[0], commit_error[1], commit_error[2]
+        if durable:
+            checkpointDatabase(self.store, settings.DB_CHECKPOINT_DURABLE)
+        return False
+
+    @classmethod
+    def commit(cls, store):
+        """Commit a store unless a unit of work is open on it
+
+        @param store Database store object for the database backend.
+        """
+        if store not in cls.state:
+            store.commit()
+
+
 class Persistance(Storm):
     """Core class for all data models
     
@@ -45,7 +157,7 @@ class Persistance(Storm):
         """
         try:
             store.add(self)
-            store.commit()
+            UnitOfWork.commit(store)
             self.store = store
             return True
         except Exception as e:
@@ -60,7 +172,7 @@ class Persistance(Storm):
         @return True if successful, False otherwise
         """
         try:
-            self.store.commit()
+            UnitOfWork.commit(self.store)
             return True
         except Exception as e:
             logger.error('common.database.Persistance.update(): Exception: %s', e)
@@ -77,7 +189,7 @@ class Persistance(Storm):
         """
         try:
             self.store.remove(self)
-            self.store.commit()
+            UnitOfWork.commit(self.store)
             self.store = None
             return True
         except Exception as e:
@@ -164,7 +276,8 @@ class SWUpdate(Persistance):
     """
     
     __storm_table__ = "SWUpdate"
-    SQL_CREATE = "CREATE TABLE SWUpdate (id VARCHAR PRIMARY KEY, name VARCHAR, startTime VARCHAR, finishTime VARCHAR, status VARCHAR)"
+    SQL_CREATE = "CREATE TABLE SWUpdate (id VARCHAR PRIMARY KEY, name VARCHAR, startTime INTEGER, finishTime INTEGER, status VARCHAR)"
+    SQL_INDEXES = [ "CREATE INDEX SWUpdateStatus ON SWUpdate (status)" ]
     SQL_CLEAR = "DELETE FROM SWUpdate"
     ST_PENDING = u"PENDING"
     ST_STARTED = u"STARTED"
@@ -173,10 +286,9 @@ class SWUpdate(Persistance):
     ST_ERROR = u"ERROR"
     id = Unicode(primary=True)
     name = Unicode()
-    startTime = DateTime()
-    finishTime = DateTime()
+    startTime = Timestamp()
+    finishTime = Timestamp()
     status = Unicode()
-    swOperations = []
     
     def __init__(self, id, name):
         """Constructor
@@ -190,6 +302,15 @@ class SWUpdate(Persistance):
         self.id = unicode(id)
         self.name = unicode(name)
         self.status = SWUpdate.ST_PENDING
+        # Associated software operations by id, in the order they were added.
+        self.swOperations = OrderedDict()
+
+    def __storm_loaded__(self):
+        """Storm hook invoked when the software update has been loaded from the database
+
+        The associated software operations are loaded by getSWOperations().
+        """
+        self.swOperations = None
         
     def start(self):
         """Start the software update
@@ -211,7 +332,7 @@ class SWUpdate(Persistance):
         ST_FINISHED.
         """
         if self.status == SWUpdate.ST_STARTED:
-            for swo in self.swOperations:
+            for swo in self.getSWOperations():
                 if not swo.isfinished():
                     return
             self.finishTime = datetime.utcnow()
@@ -236,8 +357,8 @@ class SWUpdate(Persistance):
         status is set to ST_ERROR.
         """
         if self.status == SWUpdate.ST_STARTED:
-            for swo in self.swOperations:
-                if not swo.error():
+            for swo in self.getSWOperations():
+                if not swo.iserror():
                     return
             self.finishTime = datetime.utcnow()
             self.status = SWUpdate.ST_ERROR
@@ -246,31 +367,31 @@ class SWUpdate(Persistance):
         """Retrieve all assiciated software operations
         
         This method retrieves all software operations associated with this software
-        update from the database and stores them in a local list.
+        update from the database with a single query and stores them in a local
+        index by id.
         
         @return List with software operations associated with this software update
         """
-        if not self.swOperations:
-            swo = SWOperation.findAll(self.store, "updateId", self.id)
-            for i in range(0, swo.count()):
-                self.swOperations.append(swo[i])
-        return self.swOperations
+        if self.swOperations is None:
+            self.swOperations = OrderedDict()
+            for swo in SWOperation.findAll(self.store, "updateId", self.id):
+                self.swOperations[swo.id] = swo
+        return self.swOperations.values()
         
     def getSWOperation(self, id):
         """Retrieve a particular software operation identified by id
         
-        Searches the local list of software operations for one with the
-        matching id. As software operations id's are unique a simple linear
-        search is sufficient.
+        Looks up the software operation in the local index by id.
         
         @param id Id of the software operation
         
         @return The software operation instance or None if not found
         """
-        for swo in self.swOperations:
-            if swo.id == unicode(id):
-                return swo
-        return None
+        if self.swOperations is None:
+            self.getSWOperations()
+        if not isinstance(id, unicode):
+            id = unicode(id)
+        return self.swOperations.get(id)
         
     def addSWOperation(self, id, operation):
         """Add a software operation to this software update
@@ -284,8 +405,10 @@ class SWUpdate(Persistance):
         
         @return Instance of the new software operation
         """
+        if self.swOperations is None:
+            self.getSWOperations()
         swo = SWOperation(id, self.id, operation)
-        self.swOperations.append(swo)
+        self.swOperations[swo.id] = swo
         swo.add(self.store)
         return swo
         
@@ -308,13 +431,12 @@ class SWUpdate(Persistance):
         """Store this software update and all associated software operations
         
         The method stores this software update and all software operations
-        associated with it in the database. The method first iterates over
-        the local list of software operations and stores them in the database
-        and then stores the software update itself.
+        associated with it in the database with a single commit.
         """
-        for swo in self.swOperations:
-            swo.update()
-        super(SWUpdate, self).update()
+        with UnitOfWork(self.store):
+            for swo in self.getSWOperations():
+                swo.update()
+            super(SWUpdate, self).update()
         
     @classmethod
     def getSWUpdate(cls, store, id, name):
@@ -334,8 +456,10 @@ class SWUpdate(Persistance):
         if not swu:
             swu = SWUpdate(id, name)
             swu.add(store)
-        else:
-            swu.getSWOperations()
+            # The results of its operations may have been kept when an
+            # earlier instance of the update was removed by pruneDatabase().
+            swu.swOperations = None
+        swu.getSWOperations()
         return swu
         
 
@@ -344,23 +468,28 @@ class SWOperation(Persistance):
     """Data model for software operations
     
     This data model class holds software operation information. A software
-    operation is associated with a software update trough a foreign key.
+    operation is associated with a software update trough a foreign key, which
+    is part of its primary key (updateId, id).
     """
     __storm_table__ = "SWOperation"
-    SQL_CREATE = "CREATE TABLE SWOperation (id VARCHAR PRIMARY KEY, operation VARCHAR, updateId VARCHAR, \
-                  startTime VARCHAR, finishTime VARCHAR, status VARCHAR, resultCode INTEGER, resultText VARCHAR)"
+    __storm_primary__ = "updateId", "id"
+    SQL_CREATE = "CREATE TABLE SWOperation (id VARCHAR, operation VARCHAR, updateId VARCHAR, \
+                  startTime INTEGER, finishTime INTEGER, status VARCHAR, resultCode INTEGER, resultText VARCHAR, \
+                  PRIMARY KEY (updateId, id))"
+    SQL_INDEXES = [ "CREATE INDEX SWOperationStatus ON SWOperation (status)",
+                    "CREATE INDEX SWOperationId ON SWOperation (id)" ]
     SQL_CLEAR = "DELETE FROM SWOperation"
     ST_PENDING = u"PENDING"
     ST_STARTED = u"STARTED"
     ST_FINISHED = u"FINISHED"
     ST_ABORTED = u"ABORTED"
     ST_ERROR = u"ERROR"
-    id = Unicode(primary=True)
+    id = Unicode()
     operation = Unicode()
     updateId = Unicode()
     updateRef = Reference(updateId, SWUpdate.id)
-    startTime = DateTime()
-    finishTime = DateTime()
+    startTime = Timestamp()
+    finishTime = Timestamp()
     status = Unicode()
     resultCode = Int()
     resultText = Unicode()
@@ -449,6 +578,203 @@ class SWOperation(Persistance):
         return self.status == SWOperation.ST_ERROR
 
 
+DB_MIGRATIONS = {
+    "0.0.1": ("0.0.2", [
+        # Integer timestamps and composite primary key (updateId, id)
+        "CREATE TABLE SWUpdateNew (id VARCHAR PRIMARY KEY, name VARCHAR, startTime INTEGER, finishTime INTEGER, status VARCHAR)",
+        "INSERT INTO SWUpdateNew SELECT id, name, CAST(strftime('%s', startTime) AS INTEGER), \
+         CAST(strftime('%s', finishTime) AS INTEGER), status FROM SWUpdate",
+        "DROP TABLE SWUpdate",
+        "ALTER TABLE SWUpdateNew RENAME TO SWUpdate",
+        "CREATE TABLE SWOperationNew (id VARCHAR, operation VARCHAR, updateId VARCHAR, \
+         startTime INTEGER, finishTime INTEGER, status VARCHAR, resultCode INTEGER, resultText VARCHAR, \
+         PRIMARY KEY (updateId, id))",
+        "INSERT INTO SWOperationNew SELECT id, operation, updateId, CAST(strftime('%s', startTime) AS INTEGER), \
+         CAST(strftime('%s', finishTime) AS INTEGER), status, resultCode, resultText FROM SWOperation",
+        "DROP TABLE SWOperation",
+        "ALTER TABLE SWOperationNew RENAME TO SWOperation",
+        "CREATE INDEX SWUpdateStatus ON SWUpdate (status)",
+        "CREATE INDEX SWOperationStatus ON SWOperation (status)"
+    ]),
+    "0.0.2": ("0.0.3", [
+        # Lookup of the results of an operation id across updates
+        "CREATE INDEX SWOperationId ON SWOperation (id)"
+    ])
+}
+"""Database Schema Migrations
+Maps a schema version to a tuple of the schema version it is migrated to
+and the list of SQL statements carrying out the migration.
+"""
+
+def getDatabaseURL():
+    """Get the URL of the database
+    
+    Adds the journal mode and synchronous options of the settings to
+    settings.DB_URL for a SQLite database whose URL has no options.
+    
+    @return Database URL
+    """
+    url = settings.DB_URL
+    if not url.startswith("sqlite:") or "?" in url:
+        return url
+    options = []
+    if settings.DB_JOURNAL_MODE:
+        options.append("journal_mode=" + settings.DB_JOURNAL_MODE)
+    if settings.DB_SYNCHRONOUS:
+        options.append("synchronous=" + settings.DB_SYNCHRONOUS)
+    if options:
+        url = url + "?" + "&".join(options)
+    return url
+
+def checkpointDatabase(store, mode):
+    """Checkpoint the write-ahead log of the database
+    
+    Copies the content of the log into the database. The log is synced
+    before and the database after the checkpoint. Does nothing if the
+    database does not use a write-ahead log.
+    
+    @param store Reference to the database store
+    @param mode Checkpoint mode, PASSIVE, FULL, RESTART or TRUNCATE, or
+                None to not checkpoint
+    
+    @return True if successful, False otherwise
+    """
+    if not mode or not settings.DB_URL.startswith("sqlite:"):
+        return True
+    try:
+        result = store.execute("PRAGMA wal_checkpoint({})".format(mode)).get_one()
+        store.commit()
+        logger.debug('common.database.checkpointDatabase(%s): Result: %s', mode, result)
+        return True
+    except Exception as e:
+        logger.error('common.database.checkpointDatabase(%s): Exception: %s', mode, e)
+        return False
+
+def prepareDatabaseFile():
+    """Prepare the SQLite database file before it is opened
+    
+    Sets the auto-vacuum mode of settings.DB_AUTO_VACUUM. The mode of an
+    existing database only changes with a VACUUM, which cannot be run within
+    the transactions of a store, so a separate connection is used.
+    """
+    if not settings.DB_AUTO_VACUUM or not settings.DB_URL.startswith("sqlite:"):
+        return
+    path = URI(settings.DB_URL).database
+    if not path or path == ":memory:":
+        return
+    modes = { "NONE": 0, "FULL": 1, "INCREMENTAL": 2 }
+    connection = sqlite3.connect(path, isolation_level=None)
+    try:
+        mode = connection.execute("PRAGMA auto_vacuum").fetchone()[0]
+        if mode != modes[settings.DB_AUTO_VACUUM]:
+            logger.info('common.database.prepareDatabaseFile(): Setting auto-vacuum mode %s', settings.DB_AUTO_VACUUM)
+            connection.execute("PRAGMA auto_vacuum = {}".format(settings.DB_AUTO_VACUUM))
+            connection.execute("VACUUM")
+    finally:
+        connection.close()
+
+def pruneDatabase(store, limit):
+    """Remove software updates according to the retention settings
+    
+    Removes up to limit software updates, oldest first, that are neither among
+    the settings.DB_RETENTION_UPDATES most recent updates nor have been finished
+    within the last settings.DB_RETENTION_DAYS days, together with their software
+    operations. If settings.DB_RETENTION_KEEP_RESULTS is True, the latest result
+    of a finished operation id is kept, up to settings.DB_RETENTION_RESULTS
+    results of removed updates in total.
+    
+    Must only be called while no software update is processed.
+    
+    @param store Reference to the database store
+    @param limit Maximum number of software updates to remove
+    
+    @return Number of software updates removed, None on error
+    """
+    if settings.DB_RETENTION_UPDATES is None and settings.DB_RETENTION_DAYS is None:
+        return 0
+    keep = settings.DB_RETENTION_UPDATES or 0
+    if settings.DB_RETENTION_DAYS is None:
+        cutoff = int(time.time()) + 1
+    else:
+        cutoff = int(time.time()) - settings.DB_RETENTION_DAYS * 24 * 3600
+    try:
+        with UnitOfWork(store):
+            ids = [ row[0] for row in store.execute(
+                "SELECT id FROM (SELECT id, COALESCE(finishTime, startTime, 0) AS time FROM SWUpdate \
+                 ORDER BY time DESC LIMIT -1 OFFSET ?) WHERE time < ? ORDER BY time LIMIT ?",
+                (keep, cutoff, limit)) ]
+            for id in ids:
+                if settings.DB_RETENTION_KEEP_RESULTS:
+                    store.execute("DELETE FROM SWOperation WHERE updateId = ? AND NOT (status = ? AND NOT EXISTS \
+                                   (SELECT 1 FROM SWOperation AS later WHERE later.id = SWOperation.id \
+                                    AND later.status = ? AND later.finishTime > SWOperation.finishTime))",
+                                  (id, SWOperation.ST_FINISHED, SWOperation.ST_FINISHED))
+                else:
+                    store.execute("DELETE FROM SWOperation WHERE updateId = ?", (id,))
+                store.execute("DELETE FROM SWUpdate WHERE id = ?", (id,))
+            if ids and settings.DB_RETENTION_KEEP_RESULTS and settings.DB_RETENTION_RESULTS is not None:
+                store.execute("DELETE FROM SWOperation WHERE rowid IN (SELECT rowid FROM SWOperation \
+                               WHERE updateId NOT IN (SELECT id FROM SWUpdate) \
+                               ORDER BY finishTime DESC LIMIT -1 OFFSET ?)",
+                              (settings.DB_RETENTION_RESULTS,))
+        if ids:
+            # Drop objects of removed rows cached by the store.
+            store.invalidate()
+            logger.info('common.database.pruneDatabase(): Removed updates: %s', ids)
+        return len(ids)
+    except Exception as e:
+        logger.error('common.database.pruneDatabase(): Exception: %s', e)
+        return None
+
+def vacuumDatabase(store, pages):
+    """Give free pages of the database back to the file system
+    
+    Requires the database to be in incremental auto-vacuum mode.
+    
+    @param store Reference to the database store
+    @param pages Maximum number of pages to release
+    
+    @return Number of pages released, None on error
+    """
+    if not settings.DB_URL.startswith("sqlite:"):
+        return 0
+    try:
+        with UnitOfWork(store):
+            free_pages = store.execute("PRAGMA freelist_count").get_one()[0]
+            store.execute("PRAGMA incremental_vacuum({})".format(int(pages))).get_all()
+            return free_pages - store.execute("PRAGMA freelist_count").get_one()[0]
+    except Exception as e:
+        logger.error('common.database.vacuumDatabase(): Exception: %s', e)
+        return None
+
+def getDatabaseMetrics(store):
+    """Get size and row counts of the database
+    
+    @param store Reference to the database store
+    
+    @return Dictionary with the size of the database in bytes ("size"),
+            the size of its free pages ("freeSize"), the size of its write-ahead
+            log ("walSize") and the number of software updates ("updates") and
+            software operations ("operations") stored, None on error
+    """
+    try:
+        metrics = {}
+        if settings.DB_URL.startswith("sqlite:"):
+            page_size = store.execute("PRAGMA page_size").get_one()[0]
+            metrics["size"] = store.execute("PRAGMA page_count").get_one()[0] * page_size
+            metrics["freeSize"] = store.execute("PRAGMA freelist_count").get_one()[0] * page_size
+            path = URI(settings.DB_URL).database
+            metrics["walSize"] = 0
+            if path and os.path.exists(path + "-wal"):
+                metrics["walSize"] = os.path.getsize(path + "-wal")
+        metrics["updates"] = store.execute("SELECT COUNT(*) FROM SWUpdate").get_one()[0]
+        metrics["operations"] = store.execute("SELECT COUNT(*) FROM SWOperation").get_one()[0]
+        store.commit()
+        return metrics
+    except Exception as e:
+        logger.error('common.database.getDatabaseMetrics(): Exception: %s', e)
+        return None
+
 def openDatabase():
     """Open the database
     
@@ -456,22 +782,28 @@ def openDatabase():
     does not exist or the schema has not been initialized the database will
     be created and the schema initialized.
     
-    This method also checks if the schema has the correct version. If the version
-    does not match then the reference to the store will not be returned to avoid
+    This method also checks if the schema has the correct version. A schema with
+    an older version is migrated. If the version does not match and cannot be
+    migrated then the reference to the store will not be returned to avoid
     data inconsistency and/or corruption.
     
     @return Reference to the database store if successfully opened.
     """
     try:
-        database = create_database(settings.DB_URL)
+        prepareDatabaseFile()
+        database = create_database(getDatabaseURL())
         store = Store(database)
+        if settings.DB_URL.startswith("sqlite:"):
+            for (name, value) in settings.DB_PRAGMAS:
+                store.execute("PRAGMA {} = {}".format(name, value))
+            store.commit()
         vc = checkDatabaseSchema(store)
-        if not vc:
+        if vc is None:
             logger.info('common.database.openDatabase(): Creating database schema')
             if not createDatabaseSchema(store):
                 return None
-        else:
-            if vc == False:
+        elif vc == False:
+            if not migrateDatabaseSchema(store):
                 return None
         return store
     except Exception as e:
@@ -491,6 +823,8 @@ def createDatabaseSchema(store):
         store.execute(System.SQL_CREATE)
         store.execute(SWUpdate.SQL_CREATE)
         store.execute(SWOperation.SQL_CREATE)
+        for statement in SWUpdate.SQL_INDEXES + SWOperation.SQL_INDEXES:
+            store.execute(statement)
         store.commit()
         System(System.KEY_VERSION, unicode(DB_SCHEMA_VERSION)).add(store)
         return True
@@ -518,10 +852,44 @@ def checkDatabaseSchema(store):
         if version.value == unicode(DB_SCHEMA_VERSION):
             return True
         else:
-            logger.error('common.database.checkDatabaseSchema(): Database schema version %s does not match settings: %s',
+            logger.info('common.database.checkDatabaseSchema(): Database schema version %s does not match settings: %s',
                         version.value, DB_SCHEMA_VERSION)
             return False
+
+def migrateDatabaseSchema(store):
+    """Migrate the database schema
+    
+    Migrates the database schema in place from the version stored in the
+    database to DB_SCHEMA_VERSION by carrying out the steps in DB_MIGRATIONS.
+    All steps are carried out in a single transaction, so that the database
+    is left unchanged if any of them fails.
+    
+    @param store Reference to the database store
+    
+    @return True if the database schema was successfully migrated, False otherwise
+    """
+    version = System.find(store, u"key", System.KEY_VERSION)
+    try:
+        while version.value != unicode(DB_SCHEMA_VERSION):
+            if version.value not in DB_MIGRATIONS:
+                logger.error('common.database.migrateDatabaseSchema(): No migration from schema version %s to %s',
+                             version.value, DB_SCHEMA_VERSION)
+                store.rollback()
+                return False
+            (target, statements) = DB_MIGRATIONS[version.value]
+            logger.info('common.database.migrateDatabaseSchema(): Migrating schema version %s to %s',
+                        version.value, target)
+            for statement in statements:
+                store.execute(statement)
+            version.value = unicode(target)
+        store.commit()
+        return True
+    except Exception as e:
+        logger.error('common.database.migrateDatabaseSchema(): Exception: %s', e)
+        store.rollback()
+        return False
         
+
 def resetDatabaseSchema(store):
     """Reset the database schema
     
@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+""" Franca IDL Signatures
+
+This module derives the D-Bus signatures of the methods of the Software
+Management components from their Franca IDL (.fidl) definitions and
+converts arguments to the exact D-Bus types of those signatures.
+
+(c) 2015, 2016 - Jaguar Land Rover.
+Mozilla Public License 2.0
+"""
+
+import re
+import glob
+import dbus
+import settings
+import logging
+
+logger = logging.getLogger(settings.LOGGER)
+
+_COMMENTS = re.compile(r"<\*\*.*?\*\*>|//[^\n]*", re.DOTALL)
+_TOKENS = re.compile(r'"[^"]*"|[A-Za-z_][\w.]*|[{}=\[\]]')
+
+# D-Bus signatures of the Franca basic types
+BASIC_TYPES = {
+    "Boolean": "b",
+    "UInt8": "y",
+    "Int16": "n",
+    "UInt16": "q",
+    "Int32": "i",
+    "UInt32": "u",
+    "Int64": "x",
+    "UInt64": "t",
+    "Float": "d",
+    "Double": "d",
+    "String": "s",
+    "ByteBuffer": "ay"
+}
+
+# D-Bus integer types with their range of values
+_INTEGERS = {
+    "y": (dbus.Byte, 0, 2**8 - 1),
+    "n": (dbus.Int16, -2**15, 2**15 - 1),
+    "q": (dbus.UInt16, 0, 2**16 - 1),
+    "i": (dbus.Int32, -2**31, 2**31 - 1),
+    "u": (dbus.UInt32, 0, 2**32 - 1),
+    "x": (dbus.Int64, -2**63, 2**63 - 1),
+    "t": (dbus.UInt64, 0, 2**64 - 1)
+}
+
+
+class SignatureRegistry:
+    """Registry of the D-Bus signatures of Franca IDL methods
+
+    The registry holds the in arguments of all methods of the interfaces
+    defined in a set of Franca IDL files. Enumerations are passed as Int32
+    like the result codes of swm.result(). Structures have no signature,
+    as the components pass them as dictionaries.
+    """
+
+    def __init__(self):
+        """Constructor
+        """
+        # interface -> {method: [(argument, type)]}
+        self.interfaces = {}
+        self.enumerations = set()
+        self.structures = set()
+
+
+    def load(self, pattern):
+        """Load all Franca IDL files matching a pattern
+
+        @param pattern Glob pattern of the files
+
+        @return True if successful, False otherwise
+        """
+        try:
+            for fname in sorted(glob.glob(pattern)):
+                with open(fname, "r") as f:
+                    self.parse(f.read())
+        except Exception as e:
+            logger.error('common.fidl.SignatureRegistry.load(%s): Exception: %s', pattern, e)
+            return False
+        logger.debug('common.fidl.SignatureRegistry.load(%s): %s interfaces.', pattern, len(self.interfaces))
+        return True
+
+
+    def parse(self, text):
+        """Parse the definitions of a Franca IDL file
+
+        @param text Content of the file
+        """
+        tokens = _TOKENS.findall(_COMMENTS.sub(" ", text))
+        i = 0
+        interface = None
+        depth = 0
+        while i < len(tokens):
+            token = tokens[i]
+            if token == "interface" and depth == 0:
+                interface = self.interfaces.setdefault(tokens[i + 1], {})
+                i = i + 2
+            elif token in ("struct", "enumeration"):
+                if token == "struct":
+                    self.structures.add(tokens[i + 1])
+                else:
+                    self.enumerations.add(tokens[i + 1])
+                i = self.skip_block(tokens, i + 2)
+            elif token == "method" and interface is not None:
+                i = self.parse_method(tokens, i + 1, interface)
+            elif token == "{":
+                depth = depth + 1
+                i = i + 1
+            elif token == "}":
+                depth = depth - 1
+                if depth == 0:
+                    interface = None
+                i = i + 1
+            else:
+                i = i + 1
+
+
+    def skip_block(self, tokens, i):
+        """Skip a block enclosed in braces
+
+        @param tokens List of tokens
+        @param i Index of the first token after the name of the block
+
+        @return Index of the token following the block
+        """
+        while tokens[i] != "{":
+            i = i + 1
+        depth = 0
+        while True:
+            if tokens[i] == "{":
+                depth = depth + 1
+            elif tokens[i] == "}":
+                depth = depth - 1
+                if depth == 0:
+                    return i + 1
+            i = i + 1
+
+
+    def parse_method(self, tokens, i, interface):
+        """Parse a method definition
+
+        @param tokens List of tokens
+        @param i Index of the name of the method
+        @param interface Dictionary of the methods of the interface
+
+        @return Index of the token following the method
+        """
+        name = tokens[i]
+        arguments = []
+        interface[name] = arguments
+        while tokens[i] != "{":
+            i = i + 1
+        i = i + 1
+        while tokens[i] != "}":
+            if tokens[i] == "in" and tokens[i + 1] == "{":
+                i = i + 2
+                while tokens[i] != "}":
+                    if tokens[i] == "array":
+                        # array <name> of <type>
+                        arguments.append((tokens[i + 1], ("array", tokens[i + 3])))
+                        i = i + 4
+                    elif tokens[i + 1] == "[":
+                        # <type>[] <name>
+                        arguments.append((tokens[i + 3], ("array", tokens[i])))
+                        i = i + 4
+                    else:
+                        arguments.append((tokens[i + 1], tokens[i]))
+                        i = i + 2
+                i = i + 1
+            elif tokens[i + 1] == "{":
+                i = self.skip_block(tokens, i + 1)
+            else:
+                i = i + 1
+        return i + 1
+
+
+    def get_signature(self, franca_type):
+        """Get the D-Bus signature of a Franca type
+
+        @param franca_type Name of the type or tuple ("array", element type)
+
+        @return D-Bus signature, None if the type has no signature
+        """
+        if isinstance(franca_type, tuple):
+            element = self.get_signature(franca_type[1])
+            if element is None:
+                return None
+            return "a" + element
+        if franca_type in BASIC_TYPES:
+            return BASIC_TYPES[franca_type]
+        if franca_type in self.enumerations:
+            return "i"
+        return None
+
+
+    def get_arguments(self, interface, method):
+        """Get the in arguments of a method
+
+        @param interface Name of the Franca interface
+        @param method Name of the method
+
+        @return List of (argument, signature) tuples, None if the method is
+                not defined
+        """
+        arguments = self.interfaces.get(interface, {}).get(method)
+        if arguments is None:
+            return None
+        return [ (name, self.get_signature(franca_type)) for (name, franca_type) in arguments ]
+
+
+def get_interface(path):
+    """Get the Franca interface of a dbus service
+
+    @param path Dbus service (org.genivi.xxx)
+
+    @return Name of the interface, by default the last component of path
+    """
+    return settings.DBUS_SIGNATURE_INTERFACES.get(path, path.split(".")[-1])
+
+
+def marshaller(signature):
+    """Get the function converting a value to a D-Bus signature
+
+    The function raises TypeError or ValueError if the value does not match
+    the signature.
+
+    @param signature D-Bus signature of a single complete type
+
+    @return Function taking the value and returning it as dbus type, None if
+            the signature is None or not supported
+    """
+    if signature is None:
+        return None
+
+    if signature == "s":
+        def marshal(value):
+            if not isinstance(value, basestring):
+                raise TypeError("expected a string, got {}".format(type(value).__name__))
+            return dbus.String(value)
+        return marshal
+
+    if signature == "b":
+        def marshal(value):
+            if not isinstance(value, bool):
+                raise TypeError("expected a boolean, got {}".format(type(value).__name__))
+            return dbus.Boolean(value)
+        return marshal
+
+    if signature == "d":
+        def marshal(value):
+            if isinstance(value, bool) or not isinstance(value, (int, long, float)):
+                raise TypeError("expected a number, got {}".format(type(value).__name__))
+            return dbus.Double(value)
+        return marshal
+
+    if signature in _INTEGERS:
+        (dbus_type, minimum, maximum) = _INTEGERS[signature]
+        def marshal(value):
+            if isinstance(value, bool) or not isinstance(value, (int, long)):
+                raise TypeError("expected an integer, got {}".format(type(value).__name__))
+            if value < minimum or value > maximum:
+                raise ValueError("{} out of range for signature {}".format(value, signature))
+            return dbus_type(value)
+        return marshal
+
+    if signature.startswith("a"):
+        element = marshaller(signature[1:])
+        if element is None:
+            return None
+        def marshal(value):
+            if not isinstance(value, (list, tuple)):
+                raise TypeError("expected an array, got {}".format(type(value).__name__))
+            return dbus.Array([ element(item) for item in value ], signature[1:])
+        return marshal
+
+    return None
+
+
+_registry = None
+
+def get_registry():
+    """Get the signature registry
+
+    The registry is loaded from settings.DBUS_SIGNATURE_FILES on first use.
+
+    @return Signature registry, None if settings.DBUS_SIGNATURE_FILES is None
+    """
+    global _registry
+    if _registry is None and settings.DBUS_SIGNATURE_FILES:
+        _registry = SignatureRegistry()
+        _registry.load(settings.DBUS_SIGNATURE_FILES)
+    return _registry
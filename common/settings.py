@@ -31,6 +31,77 @@ HMI_ENABLED = str2bool(os.getenv('SLM_HMI_ENABLED', 'false'))
 # SWM operations and their results are stored in a SQLite database.
 DB_URL = "sqlite:/var/run/swlm.sqlite"
 
+# SQLite tuning
+# With a write-ahead log (WAL) and synchronous NORMAL a commit appends to
+# the log without syncing it. The log is synced when it is checkpointed into
+# the database. Commits are atomic but the most recent ones may be lost on
+# power loss. Set DB_JOURNAL_MODE or DB_SYNCHRONOUS to None to use the SQLite
+# defaults (rollback journal, synchronous FULL). Both are only applied if
+# DB_URL does not contain any options.
+DB_JOURNAL_MODE = "WAL"
+DB_SYNCHRONOUS = "NORMAL"
+
+# Pragmas applied after opening the database: memory-mapped I/O size in
+# bytes, page cache size (negative values are in KiB) and number of pages
+# in the log after which it is checkpointed automatically.
+DB_PRAGMAS = [
+    ("mmap_size", 4 * 1024 * 1024),
+    ("cache_size", -2048),
+    ("wal_autocheckpoint", 1000)
+]
+
+# Checkpoint modes. DB_CHECKPOINT_DURABLE is run after the results of
+# operations have been committed, which syncs the log so that completed
+# operations are not carried out again after a power loss.
+# DB_CHECKPOINT_FINISHED is run when an update has been finished. Set to
+# None to not checkpoint.
+DB_CHECKPOINT_DURABLE = "PASSIVE"
+DB_CHECKPOINT_FINISHED = "TRUNCATE"
+
+# Space freed by deleting rows is given back to the file system
+# incrementally if DB_AUTO_VACUUM is "INCREMENTAL". An existing database
+# is converted with a VACUUM when it is opened. Set to None to leave the
+# database as it is. DB_VACUUM_PAGES is the number of free pages released
+# at a time.
+DB_AUTO_VACUUM = "INCREMENTAL"
+DB_VACUUM_PAGES = 256
+
+# Database Retention
+# Software updates and their operations are removed from the database
+# unless they are among the DB_RETENTION_UPDATES most recent updates or have
+# been finished within the last DB_RETENTION_DAYS days. Set both to None to
+# keep all updates. If DB_RETENTION_KEEP_RESULTS is True, the latest result of
+# each finished operation id is kept when its update is removed, so that the
+# operation is not carried out again if its update is received once more.
+# At most DB_RETENTION_RESULTS such results are kept, the oldest are removed
+# first. Set to None to keep them all, which lets the database grow without
+# bound if operation ids are not reused.
+#
+# Retention runs every DB_RETENTION_INTERVAL seconds while no update is
+# processed, removing at most DB_RETENTION_BATCH updates per main loop
+# iteration.
+DB_RETENTION_UPDATES = 50
+DB_RETENTION_DAYS = 365
+DB_RETENTION_KEEP_RESULTS = True
+DB_RETENTION_RESULTS = 10000
+DB_RETENTION_INTERVAL = 3600
+DB_RETENTION_BATCH = 10
+
+# Dbus Settings
+# Time in seconds to wait for the reply to an asynchronous dbus method call.
+DBUS_CALL_TIMEOUT = 25.0
+
+# The arguments of the dbus methods called for manifest operations are
+# converted to the D-Bus types declared in these Franca IDL files when
+# the manifest operations are prepared. Set to None to let dbus-python
+# guess the types from the values. DBUS_SIGNATURE_INTERFACES maps dbus
+# services whose name does not end with the name of their Franca
+# interface to the interface.
+DBUS_SIGNATURE_FILES = os.path.join(BASE_DIR, 'franca_idl', '*.fidl')
+DBUS_SIGNATURE_INTERFACES = {
+    "org.genivi.ModuleLoaderEcu1": "ModuleLoader"
+}
+
 # Logging settings
 LOGGER = 'swm.default'
 LOGFILE = os.path.join(BASE_DIR, 'swm.log')
@@ -128,6 +199,22 @@ OPERATIONS = {
         ]
     ),
 
+    # Installs several packages with a single invocation of the native
+    # package manager. Consecutive installPackage operations of a manifest
+    # are combined into installPackages automatically.
+    "installPackages": (
+        "org.genivi.PackageManager",
+        "installPackages",
+        [
+            ("images", None),
+            ("blacklistedPackages", [])     # default list of package names that are blackedlisted by default
+        ],
+        [
+            ("timeEstimate", 5000),         # default time estimate for the operation
+            ("onFailure", "abort")          # default action if operation fails: abort or continue
+        ]
+    ),
+
     "upgradePackage": (
         "org.genivi.PackageManager",
         "upgradePackage",
@@ -215,8 +302,7 @@ OPERATIONS = {
             ("disk", None),
             ("partitionNumber", None),
             ("start", None),
-            ("size", None),
-            ("blacklistedPartitions", [])
+            ("size", None)
         ],
         [
             ("timeEstimate", 10000),        # default time estimate for the operation
@@ -229,8 +315,21 @@ OPERATIONS = {
         "deleteDiskPartition",
         [
             ("disk", None),
-            ("partitionNnumber", None),
-            ("blacklistedPartitions", [])
+            ("partitionNumber", None)
+        ],
+        [
+            ("timeEstimate", 10000),        # default time estimate for the operation
+            ("onFailure", "abort")          # default action if operation fails: abort or continue
+        ]
+    ),
+
+    "changeDiskPartitions": (
+        "org.genivi.PartitionManager",
+        "changeDiskPartitions",
+        [
+            ("disk", None),
+            ("changes", None)               # list of createDiskPartition, resizeDiskPartition and
+                                            # deleteDiskPartition operations with their elements
         ],
         [
             ("timeEstimate", 10000),        # default time estimate for the operation
@@ -245,7 +344,8 @@ OPERATIONS = {
             ("disk", None),
             ("partitionNumber", None),
             ("image", None),
-            ("blacklistedPartitions", [])
+            ("blacklistedPartitions", []),
+            ("imageHash", "")
         ],
         [
             ("timeEstimate", 10000),        # default time estimate for the operation
@@ -258,7 +358,7 @@ OPERATIONS = {
         "patchDiskPartition",
         [
             ("disk", None),
-            ("partition_number", None),
+            ("partitionNumber", None),
             ("image", None),
             ("blacklistedPartitions", [])
         ],
@@ -289,6 +389,57 @@ OPERATIONS = {
 }
 
 
+# Operation Concurrency
+#
+# Software operations of a manifest that do not depend on each other may be
+# dispatched in parallel (see "dependsOn" and "parallel" in the manifest
+# operations). The number of operations that are in flight at the same time
+# on a single dbus service is limited by this dictionary, keyed by the
+# dbus service of the operation as defined in OPERATIONS above. Services not
+# listed use OPERATION_CONCURRENCY_DEFAULT. A manifest can override these
+# limits with its top-level "concurrency" element.
+#
+OPERATION_CONCURRENCY_DEFAULT = 1
+OPERATION_CONCURRENCY = {
+    "org.genivi.PackageManager": 1,         # native package managers lock their database
+    "org.genivi.PartitionManager": 1,
+    "org.genivi.LifecycleManager": 1,
+    "org.genivi.ModuleLoaderEcu1": 1
+}
+
+
+# Transaction Timeouts
+#
+# Software Loading Manager waits for the result of a dispatched operation
+# for TRANSACTION_TIMEOUT_FACTOR times the operation's timeEstimate, but at
+# least TRANSACTION_TIMEOUT_MIN milliseconds. A timed out operation is
+# aborted. Operations listed in TRANSACTION_RETRY_OPERATIONS can safely be
+# carried out twice and are dispatched again up to TRANSACTION_MAX_RETRIES
+# times before they are aborted. The result of any attempt is accepted.
+#
+TRANSACTION_TIMEOUT_FACTOR = 10
+TRANSACTION_TIMEOUT_MIN = 60000
+TRANSACTION_MAX_RETRIES = 1
+TRANSACTION_RETRY_OPERATIONS = [ "startComponents", "stopComponents" ]
+
+# Maximum number of consecutive manifest operations combined into a single
+# batch operation such as installPackages or changeDiskPartitions. Set to 1
+# to disable batching.
+OPERATION_BATCH_MAX = 64
+
+# If True, the operations of a manifest are validated, started in the
+# database and combined into batches only when they are dispatched. A manifest
+# with an invalid operation is then processed up to that operation, which is
+# aborted with SWM_RES_VALIDATION_FAILED. If False, all operations are
+# validated when the manifest is loaded and the manifest is rejected if any
+# of them is invalid.
+MANIFEST_LAZY = True
+
+# Number of bytes read from a manifest file at a time. Operations are
+# decoded one by one while the manifest is read.
+MANIFEST_READ_SIZE = 64 * 1024
+
+
 # Filesystem Commands
 #
 # SWM uses squashfs for update files that are mounted. Typically, only
@@ -298,34 +449,73 @@ OPERATIONS = {
 # https://github.com/vasi/squashfuse. Squashfuse requires FUSE to be installed
 # on the system.
 #
+# When running as root, the image is mounted read-only through a loop device,
+# so that files are read from the image on demand. Set SQUASHFS_LOOP to False
+# to extract the entire image with unsquashfs instead, e.g. if the kernel does
+# not support squashfs or loop devices.
+#
 # If a command does not need any arguments, other than the archive and the mount
 # point which are provided programmatically, set the variable to None. Do not use
 # an empty string or a string with spaces.
 #
 SQUASHFS_MOUNT_POINT = "/tmp/swlm"
 SQUASHFS_FUSE = SWM_SIMULATION
+SQUASHFS_LOOP = True
+SQUASHFS_EXTRACT = not SQUASHFS_FUSE and not SQUASHFS_LOOP
 if SQUASHFS_FUSE:
     # FUSE mount
     SQUASHFS_MOUNT_CMD = "/usr/local/bin/squashfuse {image_path} {mount_point}"
     SQUASHFS_UNMOUNT_CMD = ["/bin/fusermount", "-u"]
+elif SQUASHFS_LOOP:
+    # Read-only loop mount as root
+    SQUASHFS_MOUNT_CMD = "/bin/mount -t squashfs -o loop,ro {image_path} {mount_point}"
+    SQUASHFS_UNMOUNT_CMD = ["/bin/umount"]
 else:
-    # Regular mount as root 
+    # Full extraction as root
     SQUASHFS_MOUNT_CMD = "unsquashfs -f -d {mount_point} {image_path}"
     SQUASHFS_UNMOUNT_CMD = ["/bin/rm", "-r"]
 
+# Command extracting only the manifest of an image. The manifest is read
+# before the image is mounted, so that images whose manifest is rejected
+# or whose operations have all been processed already are never mounted.
+# Set to None to read the manifest from the mounted image.
+#
+if SQUASHFS_FUSE:
+    SQUASHFS_MANIFEST_CMD = None
+else:
+    SQUASHFS_MANIFEST_CMD = "unsquashfs -f -d {dest_dir} {image_path} update_manifest.json"
+
+# Number of queued images that are prepared, i.e. their manifest extracted
+# and validated and the image mounted, in the background while the current
+# manifest is processed. Set to 0 to prepare images only when their manifest
+# is loaded.
+SQUASHFS_PREFETCH = 1
+
+# Space in bytes that must remain free below SQUASHFS_MOUNT_POINT when an
+# image is extracted in the background. An extracted image is assumed to
+# take SQUASHFS_EXTRACT_FACTOR times the size of the image file. Images
+# that do not fit are extracted when their manifest is loaded.
+SQUASHFS_PREFETCH_MIN_FREE = 64 * 1024 * 1024
+SQUASHFS_EXTRACT_FACTOR = 4
+
 
 # Package Management Commands
 #
 # SWM uses the platform's package management systems to install, upgrade and
-# remove software packages.
+# remove software packages. The list command must print the installed packages
+# in the format of the package file names without extension. The package
+# database files are watched to detect changes made by other tools.
 #
 PACKAGE_MANAGER = os.getenv('SLM_PACKAGE_MANAGER', 'rpm')
+# Number of worker threads running package management commands. Commands
+# against the package database are always run one at a time.
+PKGMGR_WORKERS = 2
 if PACKAGE_MANAGER == "rpm":
     PKGMGR_INSTALL_CMD = ["rpm", "--install"]
     PKGMGR_UPGRADE_CMD = ["rpm", "--upgrade", "--oldpackage"]
     PKGMGR_REMOVE_CMD = ["rpm", "--erase"]
     PKGMGR_LIST_CMD = ["rpm", "--query", "--all"]
-    PKGMGR_CHECK_CMD = ["rpm", "--query"]
+    PKGMGR_DB_FILES = ["/var/lib/rpm/Packages", "/var/lib/rpm/rpmdb.sqlite"]
     PKGMGR_DEL_ARCH = '.'
     PKGMGR_DEL_REL = '-'
     PKGMGR_DEL_VER = '-'
@@ -333,8 +523,8 @@ elif PACKAGE_MANAGER == "deb":
     PKGMGR_INSTALL_CMD = ["dpkg", "--install"]
     PKGMGR_UPGRADE_CMD = ["dpkg", "--install"]
     PKGMGR_REMOVE_CMD = ["dpkg", "--purge"]
-    PKGMGR_LIST_CMD = ["dpkg-query", "--show", "--showformat", "'${Package}-${Version}.${Architecture}\n'"]
-    PKGMGR_CHECK_CMD = ["dpkg-query", "--list"]
+    PKGMGR_LIST_CMD = ["dpkg-query", "--show", "--showformat", "${Package}_${Version}_${Architecture}\n"]
+    PKGMGR_DB_FILES = ["/var/lib/dpkg/status"]
     PKGMGR_DEL_ARCH = '_'
     PKGMGR_DEL_REL = '-'
     PKGMGR_DEL_VER = '_'
@@ -343,5 +533,42 @@ else:
     PKGMGR_UPGRADE_CMD = ["echo", "Incorrect package manager defined."]
     PKGMGR_REMOVE_CMD = ["echo", "Incorrect package manager defined."]
     PKGMGR_LIST_CMD = ["echo", "Incorrect package manager defined."]
-    PKGMGR_CHECK_CMD = ["echo", "Incorrect package manager defined."]
+    PKGMGR_DB_FILES = []
+
+
+# Partition Management
+#
+# Images are written to partitions in blocks of PARTMGR_BLOCK_SIZE bytes, which
+# must be a multiple of the page size. If PARTMGR_DIRECT_IO is True the
+# partition is written with direct I/O, bypassing the page cache, where the
+# device supports it. If PARTMGR_SKIP_IDENTICAL is True each block is read
+# from the partition first and only written if it differs from the image,
+# which saves flash wear when an image is written again. Progress is reported
+# to Software Loading Manager every PARTMGR_PROGRESS_INTERVAL seconds.
+# Operations on the same disk are always carried out one at a time.
+#
+PARTMGR_WORKERS = 2
+PARTMGR_BLOCK_SIZE = 4 * 1024 * 1024
+PARTMGR_DIRECT_IO = True
+PARTMGR_SKIP_IDENTICAL = True
+PARTMGR_PROGRESS_INTERVAL = 5.0
+# Block size of the partition deltas created by partition_delta.py. Smaller
+# blocks make smaller deltas of images that changed in few places.
+PARTMGR_DELTA_BLOCK_SIZE = 4096
+# Images are hashed while they are written, as a Merkle tree of SHA-256
+# hashes over leaves of PARTMGR_HASH_BLOCK_SIZE bytes, which must divide
+# PARTMGR_BLOCK_SIZE. The root is checked against the imageHash element of
+# the manifest operation. If PARTMGR_VERIFY_READBACK is True the partition
+# is read back after writing and checked against the same leaves. Hashing
+# runs on PARTMGR_HASH_WORKERS threads alongside the disk I/O.
+PARTMGR_HASH_BLOCK_SIZE = 1024 * 1024
+PARTMGR_HASH_WORKERS = 2
+PARTMGR_VERIFY_READBACK = True
+# Partition tables are read and written by Partition Manager itself.
+# Consecutive partition changes of a manifest on the same disk are carried
+# out with a single table rewrite. Disks without a partition table get a
+# table of type PARTMGR_TABLE_TYPE, "gpt" or "mbr". PARTMGR_SECTOR_SIZE is
+# the sector size of disk image files, block devices report their own.
+PARTMGR_TABLE_TYPE = "gpt"
+PARTMGR_SECTOR_SIZE = 512
   
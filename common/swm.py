@@ -76,10 +76,77 @@ def result(operation_id, code, text):
     }
 
 
+# Process-wide session bus connection and cache of proxy objects
+# keyed by (service, object path, interface).
+_bus = None
+_proxies = {}
+
+
+def _name_owner_changed(name, old_owner, new_owner):
+    """Invalidate cached proxies of a service
+    
+    Signal handler for NameOwnerChanged. A proxy is bound to the unique
+    name of the service owner at the time it was created. If the service
+    goes away or is restarted the proxy has to be created again.
+    
+    @param name Well-known bus name of the service
+    @param old_owner Unique name of the previous owner
+    @param new_owner Unique name of the new owner
+    """
+    for key in [key for key in _proxies if key[0] == name]:
+        del _proxies[key]
+
+
+def get_bus():
+    """Get the session bus connection
+    
+    The connection is opened on first use and shared by all dbus method
+    invocations of the process.
+    
+    @return Session bus connection
+    """
+    global _bus
+    if _bus is None:
+        _bus = dbus.SessionBus()
+        _bus.add_signal_receiver(_name_owner_changed,
+                                 signal_name="NameOwnerChanged",
+                                 dbus_interface="org.freedesktop.DBus",
+                                 bus_name="org.freedesktop.DBus",
+                                 path="/org/freedesktop/DBus")
+    return _bus
+
+
+def get_proxy(path):
+    """Get the proxy object of a service
+    
+    Returns the cached proxy for the service or creates it if the service
+    has not been called yet or its owner has changed since.
+    
+    @param path Dbus service (org.genivi.xxx), also used as interface name
+    
+    @return Proxy object
+    """
+    key = (path, "/{}".format(path.replace(".", "/")), path)
+    proxy = _proxies.get(key)
+    if proxy is None:
+        proxy = get_bus().get_object(key[0], key[1], introspect=False)
+        _proxies[key] = proxy
+    return proxy
+
+
+def invalidate_proxy(path):
+    """Drop the cached proxy of a service
+    
+    @param path Dbus service (org.genivi.xxx)
+    """
+    _name_owner_changed(path, None, None)
+
+
 def dbus_method(path, method, *arguments):
     """Invokes dbus method
     
-    Invokes method with arguments via dbus.
+    Invokes method with arguments via dbus. The bus connection and the
+    proxy object of the service are cached across invocations.
     
     @param method Dbus method
     @param arguments Dictionary of arguments for the method
@@ -87,15 +154,130 @@ def dbus_method(path, method, *arguments):
     @return Always None
     """
     try:
-        bus = dbus.SessionBus()
-        bus_name = dbus.service.BusName(path, bus=bus)
-        obj = bus.get_object(bus_name.get_name(), "/{}".format(path.replace(".", "/")))
-        remote_method = obj.get_dbus_method(method, path)
+        remote_method = get_proxy(path).get_dbus_method(method, path)
         remote_method(*arguments)
     except Exception as e:
         logger.error('common.swm: dbus_method(%s, %s): Exception: %s', path, method, e)
+        invalidate_proxy(path)
     return None
 
+
+class DBusCall:
+    """Pending asynchronous dbus method invocation
+    
+    Handle returned by dbus_method_async(). The outcome of the invocation
+    is delivered from the main loop once the reply or an error arrives.
+    Callbacks added with add_done_callback() are invoked with the handle
+    as their only argument.
+    """
+    
+    def __init__(self, path, method):
+        """Constructor
+        
+        @param path Dbus service (org.genivi.xxx)
+        @param method Dbus method
+        """
+        self.path = path
+        self.method = method
+        self.done = False
+        self.result = None
+        self.error = None
+        self.callbacks = []
+        
+    def add_done_callback(self, callback):
+        """Add a callback invoked when the invocation has completed
+        
+        If the invocation has already completed the callback is invoked
+        immediately.
+        
+        @param callback Callable taking the DBusCall as argument
+        """
+        if self.done:
+            callback(self)
+        else:
+            self.callbacks.append(callback)
+            
+    def succeeded(self):
+        """Check if the invocation completed without error
+        
+        @return True if a reply was received, False otherwise
+        """
+        return self.done and self.error is None
+        
+    def set_result(self, *result):
+        """Reply handler
+        
+        @param result Values returned by the dbus method
+        """
+        if len(result) == 0:
+            self.result = None
+        elif len(result) == 1:
+            self.result = result[0]
+        else:
+            self.result = result
+        self._complete()
+        
+    def set_error(self, error):
+        """Error handler
+        
+        @param error Exception raised by the invocation
+        """
+        logger.error('common.swm: dbus_method_async(%s, %s): Exception: %s', self.path, self.method, error)
+        invalidate_proxy(self.path)
+        self.error = error
+        self._complete()
+        
+    def _complete(self):
+        self.done = True
+        callbacks = self.callbacks
+        self.callbacks = []
+        for callback in callbacks:
+            try:
+                callback(self)
+            except Exception as e:
+                logger.error('common.swm: DBusCall(%s, %s): Callback exception: %s', self.path, self.method, e)
+
+
+def dbus_method_async(path, method, *arguments, **kwargs):
+    """Invokes dbus method asynchronously
+    
+    Invokes method with arguments via dbus without waiting for the reply.
+    Requires a running main loop to deliver the reply.
+    
+    @param path Dbus service (org.genivi.xxx)
+    @param method Dbus method
+    @param arguments Arguments for the method
+    @param timeout Keyword argument, seconds to wait for the reply.
+                   Defaults to settings.DBUS_CALL_TIMEOUT
+    
+    @return DBusCall handle
+    """
+    call = DBusCall(path, method)
+    try:
+        remote_method = get_proxy(path).get_dbus_method(method, path)
+        remote_method(*arguments,
+                      reply_handler=call.set_result,
+                      error_handler=call.set_error,
+                      timeout=kwargs.get('timeout', settings.DBUS_CALL_TIMEOUT))
+    except Exception as e:
+        call.set_error(e)
+    return call
+
+
+def dbus_broadcast(paths, method, *arguments, **kwargs):
+    """Invokes the same dbus method on multiple services
+    
+    All invocations are issued at once without waiting for any reply.
+    
+    @param paths List of dbus services (org.genivi.xxx)
+    @param method Dbus method
+    @param arguments Arguments for the method
+    @param timeout Keyword argument, seconds to wait for each reply
+    
+    @return List of DBusCall handles, one per service
+    """
+    return [dbus_method_async(path, method, *arguments, **kwargs) for path in paths]
+
             
 def send_operation_result(transaction_id, result_code, result_text):
     """Send back operation result
@@ -108,6 +290,39 @@ def send_operation_result(transaction_id, result_code, result_text):
     
     @return Always None
     """
-    dbus_method("org.genivi.SoftwareLoadingManager", "operationResult",
-                transaction_id, result_code, result_text)
+    dbus_method_async("org.genivi.SoftwareLoadingManager", "operationResult",
+                      transaction_id, result_code, result_text)
+    return None
+
+
+def send_operation_progress(transaction_id, completed, total):
+    """Send back the progress of an operation
+    
+    Software Loading Manager extends the deadline of the operation
+    with every progress report.
+    
+    @param transaction_id Id of the transaction in progress
+    @param completed Number of bytes processed so far
+    @param total Total number of bytes to process
+    
+    @return Always None
+    """
+    dbus_method_async("org.genivi.SoftwareLoadingManager", "operationProgress",
+                      transaction_id, dbus.UInt64(completed), dbus.UInt64(total))
+    return None
+
+
+def send_operation_results(transaction_id, results):
+    """Send back the results of a batch operation
+    
+    Reports one result per item of a batch operation, such as installPackages,
+    in the order of the items.
+    
+    @param transaction_id Id of the transaction for which to report results
+    @param results List of results encoded with result()
+    
+    @return Always None
+    """
+    dbus_method_async("org.genivi.SoftwareLoadingManager", "operationResults",
+                      transaction_id, results)
     return None
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+""" Worker Pool
+
+This module provides a bounded pool of worker threads to carry out
+blocking work, such as running native tools, off the gobject main loop.
+
+(c) 2015, 2016 - Jaguar Land Rover.
+Mozilla Public License 2.0
+"""
+
+import threading
+import Queue
+import gobject
+import settings
+import logging
+
+logger = logging.getLogger(settings.LOGGER)
+
+
+class WorkerPool:
+    """Bounded pool of worker threads
+
+    Work items are executed by a fixed number of daemon threads. Work items
+    submitted with the same lock key are never executed concurrently, which
+    allows serializing access to a shared resource such as a package database.
+    The result of a work item is handed to its callback on the gobject main
+    loop, so callbacks may safely use dbus.
+    """
+
+    def __init__(self, workers):
+        """Constructor
+
+        Start the worker threads.
+
+        @param workers Number of worker threads
+        """
+        gobject.threads_init()
+        self.queue = Queue.Queue()
+        self.locks = {}
+        self.locks_lock = threading.Lock()
+        self.threads = []
+        for i in range(0, workers):
+            thread = threading.Thread(target=self.run, name="worker-{}".format(i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+
+    def get_lock(self, key):
+        """Get the lock for a lock key
+
+        @param key Lock key
+
+        @return Lock object
+        """
+        with self.locks_lock:
+            if key not in self.locks:
+                self.locks[key] = threading.Lock()
+            return self.locks[key]
+
+
+    def submit(self, work, callback, lock_key=None):
+        """Submit a work item
+
+        @param work Callable executed on a worker thread. Its return value is
+                    passed to the callback.
+        @param callback Callable invoked on the main loop with the arguments
+                        (result, error). error is None if work returned normally,
+                        otherwise it is the exception raised by work.
+        @param lock_key Work items with the same key are executed one at a time.
+                        None if the work item does not need to be serialized.
+        """
+        self.queue.put((work, callback, lock_key))
+
+
+    def run(self):
+        """Worker thread main function
+        """
+        while True:
+            (work, callback, lock_key) = self.queue.get()
+            result = None
+            error = None
+            try:
+                if lock_key is None:
+                    result = work()
+                else:
+                    with self.get_lock(lock_key):
+                        result = work()
+            except Exception as e:
+                logger.error('common.worker.WorkerPool.run(): Exception: %s', e)
+                error = e
+            gobject.idle_add(self.complete, callback, result, error)
+            self.queue.task_done()
+
+
+    def complete(self, callback, result, error):
+        """Main loop idle callback delivering the result of a work item
+
+        @return Always False to run only once
+        """
+        try:
+            callback(result, error)
+        except Exception as e:
+            logger.error('common.worker.WorkerPool.complete(): Exception: %s', e)
+        return False
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+""" Installed Package Index
+
+This module provides an in-memory index of the packages installed
+on the target.
+
+(c) 2015, 2016 - Jaguar Land Rover.
+Mozilla Public License 2.0
+"""
+
+import os
+import subprocess
+import threading
+import settings
+import logging
+
+logger = logging.getLogger(settings.LOGGER)
+
+
+class PackageIndex:
+    """Index of installed packages
+
+    The index is loaded once with the list command of the platform's package
+    manager. Packages installed, upgraded or removed by the Package Manager
+    are applied to the index incrementally. If the package database has been
+    modified by anybody else, as indicated by the modification time of its
+    files, the index is loaded again on the next lookup.
+
+    Installed packages are kept in the format of the list command, which
+    matches the name of the package file without its extension, e.g.
+    nano-2.3.6-7.fc22.x86_64 for rpm.
+    """
+
+    def __init__(self, split):
+        """Constructor
+
+        @param split Callable splitting a package file name into the tuple
+                     (name, ver, rel, arch, ptype)
+        """
+        self.split = split
+        self.lock = threading.RLock()
+        # name -> {package: (name, ver, rel, arch, ptype)}
+        self.packages = None
+        self.mtime = None
+
+
+    def getDatabaseTime(self):
+        """Get the modification time of the package database
+
+        @return Latest modification time of the database files, None if
+                none of them exists
+        """
+        mtime = None
+        for path in settings.PKGMGR_DB_FILES:
+            try:
+                mtime = max(mtime, os.stat(path).st_mtime)
+            except OSError:
+                pass
+        return mtime
+
+
+    def parse(self, package):
+        """Parse an installed package
+
+        @param package Installed package as listed by the list command
+        @return Tuple of (name,ver,rel,arch,ptype)
+        """
+        # The package file name parser expects an extension.
+        return self.split(package + ".installed")
+
+
+    def load(self):
+        """Load the index with the list command of the package manager
+
+        @return True if successful, False otherwise
+        """
+        cmd = list(settings.PKGMGR_LIST_CMD)
+        logger.debug('PackageManager.PackageIndex.load(): Command: %s', cmd)
+        mtime = self.getDatabaseTime()
+        sp = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        (stdout, stderr) = sp.communicate()
+        if sp.returncode != 0:
+            logger.error('PackageManager.PackageIndex.load(): Error: %s.', stderr)
+            return False
+        packages = {}
+        for package in stdout.split("\n"):
+            package = package.strip()
+            if not package:
+                continue
+            parts = self.parse(package)
+            packages.setdefault(parts[0], {})[package] = parts
+        self.packages = packages
+        self.mtime = mtime
+        logger.debug('PackageManager.PackageIndex.load(): %s packages.', len(packages))
+        return True
+
+
+    def refresh(self):
+        """Load the index if it has not been loaded or is out of date
+
+        @return True if the index is up to date, False otherwise
+        """
+        with self.lock:
+            if self.packages is None or self.mtime != self.getDatabaseTime():
+                return self.load()
+            return True
+
+
+    def invalidate(self):
+        """Force loading the index on the next lookup
+        """
+        with self.lock:
+            self.packages = None
+
+
+    def list(self):
+        """Get all installed packages
+
+        @return List of installed packages, None if the index could not be loaded
+        """
+        with self.lock:
+            if not self.refresh():
+                return None
+            return [ package for versions in self.packages.itervalues() for package in versions ]
+
+
+    def lookup(self, name):
+        """Get the installed packages of a name
+
+        @param name Name of the package
+        @return Dictionary of installed package to its tuple (name,ver,rel,arch,ptype),
+                empty if not installed
+        """
+        with self.lock:
+            if not self.refresh():
+                return {}
+            return dict(self.packages.get(name, {}))
+
+
+    def add(self, image_path, replace=False):
+        """Add a package that has been installed
+
+        @param image_path Path to the package file
+        @param replace True if the package replaces all installed versions
+        """
+        package = os.path.splitext(os.path.basename(image_path))[0]
+        with self.lock:
+            if self.packages is None:
+                return
+            parts = self.parse(package)
+            if replace:
+                self.packages[parts[0]] = {}
+            self.packages.setdefault(parts[0], {})[package] = parts
+            self.mtime = self.getDatabaseTime()
+
+
+    def remove(self, name):
+        """Remove a package that has been removed
+
+        @param name Name of the package
+        """
+        with self.lock:
+            if self.packages is None:
+                return
+            self.packages.pop(name, None)
+            self.mtime = self.getDatabaseTime()
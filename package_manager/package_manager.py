@@ -24,6 +24,9 @@ import subprocess
 import os
 import getopt
 import daemon
+import worker
+import package_index
+import version
 
 
 logger = logging.getLogger(settings.LOGGER)
@@ -48,6 +51,85 @@ class PkgMgrService(dbus.service.Object):
         bus_name = dbus.service.BusName('org.genivi.PackageManager', bus=dbus.SessionBus())
         dbus.service.Object.__init__(self, bus_name, '/org/genivi/PackageManager')
 
+        # Package management commands are run by a pool of worker threads so
+        # that the service keeps answering dbus calls while they execute.
+        self.workers = worker.WorkerPool(settings.PKGMGR_WORKERS)
+
+        # Index of installed packages, updated with the changes made by
+        # the commands run by this service.
+        self.index = package_index.PackageIndex(self.splitPackageName)
+
+
+    def runCommand(self, cmd, update_index=None):
+        """Run a package management command
+        
+        Executed on a worker thread. Commands are serialized per package
+        database by the caller.
+        
+        @param cmd Command as list of arguments
+        @param update_index Callable applying the change to the package index,
+                            invoked if the command succeeded
+        @return Tuple of (returncode, stdout, stderr)
+        """
+        if settings.SWM_SIMULATION:
+            time.sleep(settings.SWM_SIMULATION_WAIT)
+            return (0, "", "")
+        sp = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        (stdout, stderr) = sp.communicate()
+        if sp.returncode == 0 and update_index:
+            update_index()
+        elif sp.returncode != 0:
+            # The command may have partially succeeded.
+            self.index.invalidate()
+        return (sp.returncode, stdout, stderr)
+
+
+    def submitCommand(self, transaction_id, method, operation, failure_code, cmd, work=None, update_index=None):
+        """Run a package management command off the main loop
+        
+        The command is run on the worker pool, serialized with all other
+        commands against the package database. Once it has completed, the
+        result is sent to Software Loading Manager from the main loop.
+        
+        @param transaction_id Software Loading Manager transaction id
+        @param method Name of the calling dbus method, for logging
+        @param operation Name of the operation for the result text, e.g. Installation
+        @param failure_code Result code to report if the command fails
+        @param cmd Command as list of arguments
+        @param work Callable to run instead of the command. It returns the
+                    command result or a tuple (resultcode, resulttext) to
+                    report without running the command.
+        @param update_index Callable applying the change to the package index
+        """
+        def done(result, error):
+            if error:
+                logger.error('PackageManager.PkgMgrService.%s(): Exception: %s.', method, error)
+                swm.send_operation_result(transaction_id,
+                                          swm.SWMResult.SWM_RES_INTERNAL_ERROR,
+                                          "Internal_error: {}".format(error))
+                return
+            if len(result) == 2:
+                (resultcode, resulttext) = result
+            elif settings.SWM_SIMULATION:
+                resultcode = swm.SWMResult.SWM_RES_OK
+                resulttext = "{} Simulation successful. Command: {}".format(operation, cmd)
+                logger.info('PackageManager.PkgMgrService.%s(): %s Simulation successful.', method, operation)
+            elif result[0] == 0:
+                resultcode = swm.SWMResult.SWM_RES_OK
+                resulttext = "{} successful. Result: {}".format(operation, result[1])
+                logger.info('PackageManager.PkgMgrService.%s(): %s successful.', method, operation)
+            else:
+                resultcode = failure_code
+                resulttext = "{} failed. Error: {}".format(operation, result[2])
+                logger.error('PackageManager.PkgMgrService.%s(): %s failed: %s.', method, operation, result[2])
+            swm.send_operation_result(transaction_id, resultcode, resulttext)
+
+        if settings.SWM_SIMULATION:
+            logger.info('PackageManager.PkgMgrService.%s(): %s Simulation...', method, operation)
+        if not work:
+            work = lambda: self.runCommand(cmd, update_index)
+        self.workers.submit(work, done, lock_key=settings.PACKAGE_MANAGER)
+
 
     @dbus.service.method('org.genivi.PackageManager',
                          async_callbacks=('send_reply', 'send_error'))
@@ -94,28 +176,9 @@ class PkgMgrService(dbus.service.Object):
             cmd.append(image_path)
             logger.info('PackageManager.PkgMgrService.installPackage(): Command: %s', cmd)
 
-            if settings.SWM_SIMULATION:
-                # simulate installation
-                logger.info('PackageManager.PkgMgrService.installPackage(): Installation Simulation...')
-                time.sleep(settings.SWM_SIMULATION_WAIT)
-                resultcode = swm.SWMResult.SWM_RES_OK
-                resulttext = "Installation Simulation successful. Command: {}".format(cmd)
-                logger.info('PackageManager.PkgMgrService.installPackage(): Installation Simulation successful.')
-            else:
-                # perform installation
-                sp = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                if sp.wait() == 0:
-                    (stdout, stderr) = sp.communicate()
-                    resultcode = swm.SWMResult.SWM_RES_OK
-                    resulttext = "Installation successful. Result: {}".format(stdout)
-                    logger.info('PackageManager.PkgMgrService.installPackage(): Installation successful.')
-                else:
-                    (stdout, stderr) = sp.communicate()
-                    resultcode = swm.SWMResult.SWM_RES_INSTALL_FAILED
-                    resulttext = "Installation failed. Error: {}".format(stderr)
-                    logger.error('PackageManager.PkgMgrService.installPackage(): Installation failed: %s.', stderr)
-                
-            swm.send_operation_result(transaction_id, resultcode, resulttext)
+            self.submitCommand(transaction_id, 'installPackage', "Installation",
+                               swm.SWMResult.SWM_RES_INSTALL_FAILED, cmd,
+                               update_index=lambda: self.index.add(image_path))
 
         except Exception as e:
             logger.error('PackageManager.PkgMgrService.installPackage(): Exception: %s.', e)
@@ -126,6 +189,127 @@ class PkgMgrService(dbus.service.Object):
         
             
 
+    @dbus.service.method('org.genivi.PackageManager',
+                         async_callbacks=('send_reply', 'send_error'))
+    def installPackages(self, 
+                        transaction_id,
+                        image_paths,
+                        blacklisted_packages,
+                        send_reply, 
+                        send_error):
+        """Install Software Packages
+        
+        Dbus callback for installing several software packages with a single
+        invocation of the platform's package management system. One result
+        per package is reported back, in the order of image_paths.
+        
+        @param transaction_id Software Loading Manager transaction id
+        @param image_paths Paths to the software packages to be installed
+        @param blacklisted_packages List of packages that must not be installed
+        @param send_reply DBus callback for a standard reply
+        @param send_error DBus callback for error response
+        """
+
+        logger.debug('PackageManager.PkgMgrService.installPackages(%s, %s, %s): Called.',
+                     transaction_id, image_paths, blacklisted_packages)
+
+        try:
+            #
+            # Send back an immediate reply since DBUS
+            # doesn't like python dbus-invoked methods to do 
+            # their own calls (nested calls).
+            #
+            send_reply(True)
+
+            # extract packages and check for blacklisted
+            results = [ None ] * len(image_paths)
+            install = []
+            for (i, image_path) in enumerate(image_paths):
+                pkg = os.path.basename(image_path)
+                if pkg in blacklisted_packages:
+                    logger.warning('PackageManager.PkgMgrService.installPackages(): Blacklisted Package: %s', pkg)
+                    results[i] = swm.result(image_path,
+                                            swm.SWMResult.SWM_RES_OPERATION_BLACKLISTED,
+                                            "Blacklisted Package: {}".format(pkg))
+                else:
+                    install.append(i)
+
+            if not install:
+                swm.send_operation_results(transaction_id, results)
+                return None
+
+            # assemble installation command for all packages
+            cmd = list(settings.PKGMGR_INSTALL_CMD)
+            cmd.extend([ image_paths[i] for i in install ])
+            logger.info('PackageManager.PkgMgrService.installPackages(): Command: %s', cmd)
+
+            def done(result, error):
+                if error:
+                    logger.error('PackageManager.PkgMgrService.installPackages(): Exception: %s.', error)
+                    (returncode, stdout, stderr) = (None, "", "Internal_error: {}".format(error))
+                else:
+                    (returncode, stdout, stderr) = result
+                failed = self.getFailedPackages(stderr)
+                for i in install:
+                    if error:
+                        resultcode = swm.SWMResult.SWM_RES_INTERNAL_ERROR
+                        resulttext = stderr
+                    elif settings.SWM_SIMULATION:
+                        resultcode = swm.SWMResult.SWM_RES_OK
+                        resulttext = "Installation Simulation successful. Command: {}".format(cmd)
+                    elif returncode == 0 or (failed is not None and not self.isFailedPackage(image_paths[i], failed)):
+                        resultcode = swm.SWMResult.SWM_RES_OK
+                        resulttext = "Installation successful. Result: {}".format(stdout)
+                    else:
+                        resultcode = swm.SWMResult.SWM_RES_INSTALL_FAILED
+                        resulttext = "Installation failed. Error: {}".format(stderr)
+                    results[i] = swm.result(image_paths[i], resultcode, resulttext)
+                logger.info('PackageManager.PkgMgrService.installPackages(): Installation finished with return code %s.', returncode)
+                swm.send_operation_results(transaction_id, results)
+
+            if settings.SWM_SIMULATION:
+                logger.info('PackageManager.PkgMgrService.installPackages(): Installation Simulation...')
+            def update_index():
+                for i in install:
+                    self.index.add(image_paths[i])
+            self.workers.submit(lambda: self.runCommand(cmd, update_index), done,
+                                lock_key=settings.PACKAGE_MANAGER)
+
+        except Exception as e:
+            logger.error('PackageManager.PkgMgrService.installPackages(): Exception: %s.', e)
+            swm.send_operation_result(transaction_id,
+                                      swm.SWMResult.SWM_RES_INTERNAL_ERROR,
+                                      "Internal_error: {}".format(e))
+        return None
+
+
+    def getFailedPackages(self, stderr):
+        """Get the packages that failed in a multi-package command
+        
+        rpm carries out all packages of a command in a single transaction,
+        hence either all or none of them fail. dpkg processes the packages
+        one by one and lists those that failed at the end of its output.
+        
+        @param stderr Error output of the command
+        @return Set of failed package names and paths, or None if unknown
+        """
+        marker = "Errors were encountered while processing:"
+        if settings.PACKAGE_MANAGER != "deb" or marker not in stderr:
+            return None
+        return set([ line.strip() for line in stderr.split(marker, 1)[1].split("\n") if line.strip() ])
+
+
+    def isFailedPackage(self, image_path, failed):
+        """Check if a package is in the set of failed packages
+        
+        @param image_path Path to the software package
+        @param failed Set returned by getFailedPackages
+        @return True if the package failed, False otherwise
+        """
+        name = self.splitPackageName(os.path.basename(image_path))[0]
+        return image_path in failed or name in failed
+
+
     @dbus.service.method('org.genivi.PackageManager',
                          async_callbacks=('send_reply', 'send_error'))
     def upgradePackage(self, 
@@ -168,46 +352,25 @@ class PkgMgrService(dbus.service.Object):
                                             "Blacklisted Package: {}".format(pkg))
                 return None
 
-            # check if package is installed and compare versions
-            pkglist = self.checkInstalledPackage(pkg)
-            if len(pkglist) > 0 and not allow_downgrade:
-                # only need to check package version if package is installed
-                # and downgrading is not allowed
-                if not self.isNewer(pkglist, pkg):
-                    logger.info('PackageManager.PkgMgrService.upgradePackage(): Downgrade prohibited.')
-                    swm.send_operation_result(transaction_id,
-                                                swm.SWMResult.SWM_RES_OLD_VERSION,
-                                                "Package downgrade prohibited.")
-                    return None
-                    
-
             # assemble upgrade command
             cmd = list(settings.PKGMGR_UPGRADE_CMD)
             cmd.append(image_path)
             logger.info('PackageManager.PkgMgrService.upgradePackage(): Command: %s', cmd)
 
-            if settings.SWM_SIMULATION:
-                # simulate upgrade
-                logger.info('PackageManager.PkgMgrService.upgradePackage(): Upgrade Simulation...')
-                time.sleep(settings.SWM_SIMULATION_WAIT)
-                resultcode = swm.SWMResult.SWM_RES_OK
-                resulttext = "Upgrade Simulation successful. Command: {}".format(cmd)
-                logger.info('PackageManager.PkgMgrService.upgradePackage(): Upgrade Simulation successful.')
-            else:
-                # perform upgrade
-                sp = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                if sp.wait() == 0:
-                    (stdout, stderr) = sp.communicate()
-                    resultcode = swm.SWMResult.SWM_RES_OK
-                    resulttext = "Upgrade successful. Result: {}".format(stdout)
-                    logger.info('PackageManager.PkgMgrService.upgradePackage(): Upgrade successful.')
-                else:
-                    (stdout, stderr) = sp.communicate()
-                    resultcode = swm.SWMResult.SWM_RES_UPGRADE_FAILED
-                    resulttext = "Upgrade failed. Error: {}".format(stderr)
-                    logger.error('PackageManager.PkgMgrService.upgradePackage(): Upgrade failed: %s.', stderr)
-                
-            swm.send_operation_result(transaction_id, resultcode, resulttext)
+            def upgrade():
+                # check if package is installed and compare versions
+                pkglist = self.checkInstalledPackage(pkg)
+                if len(pkglist) > 0 and not allow_downgrade:
+                    # only need to check package version if package is installed
+                    # and downgrading is not allowed
+                    if not self.isNewer(pkglist, pkg):
+                        logger.info('PackageManager.PkgMgrService.upgradePackage(): Downgrade prohibited.')
+                        return (swm.SWMResult.SWM_RES_OLD_VERSION,
+                                "Package downgrade prohibited.")
+                return self.runCommand(cmd, lambda: self.index.add(image_path, True))
+
+            self.submitCommand(transaction_id, 'upgradePackage', "Upgrade",
+                               swm.SWMResult.SWM_RES_UPGRADE_FAILED, cmd, upgrade)
 
         except Exception as e:
             logger.error('PackageManager.PkgMgrService.upgradePackage(): Exception: %s.', e)
@@ -250,28 +413,9 @@ class PkgMgrService(dbus.service.Object):
             cmd.append(package_id)
             logger.info('PackageManager.PkgMgrService.removePackage(): Command: %s', cmd)
 
-            if settings.SWM_SIMULATION:
-                # simulate removal
-                logger.info('PackageManager.PkgMgrService.removePackage(): Removal Simulation...')
-                time.sleep(settings.SWM_SIMULATION_WAIT)
-                resultcode = swm.SWMResult.SWM_RES_OK
-                resulttext = "Removal Simulation successful. Command: {}".format(cmd)
-                logger.info('PackageManager.PkgMgrService.removePackage(): Removal Simulation successful.')
-            else:
-                # perform removal
-                sp = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                if sp.wait() == 0:
-                    (stdout, stderr) = sp.communicate()
-                    resultcode = swm.SWMResult.SWM_RES_OK
-                    resulttext = "Removal successful. Result: {}".format(stdout)
-                    logger.info('PackageManager.PkgMgrService.removePackage(): Removal successful.')
-                else:
-                    (stdout, stderr) = sp.communicate()
-                    resultcode = swm.SWMResult.SWM_RES_REMOVAL_FAILED
-                    resulttext = "Removal failed. Error: {}".format(stderr)
-                    logger.error('PackageManager.PkgMgrService.removePackage(): Removal failed: %s.', stderr)
-                
-            swm.send_operation_result(transaction_id, resultcode, resulttext)
+            self.submitCommand(transaction_id, 'removePackage', "Removal",
+                               swm.SWMResult.SWM_RES_REMOVAL_FAILED, cmd,
+                               update_index=lambda: self.index.remove(package_id))
 
         except Exception as e:
             logger.error('PackageManager.PkgMgrService.removePackage(): Exception: %s.', e)
@@ -286,24 +430,17 @@ class PkgMgrService(dbus.service.Object):
         """Get a list of installed packages
         """
         try:
-            # assemble list command
-            cmd = list(settings.PKGMGR_LIST_CMD)
-            logger.debug('PackageManager.PkgMgrService.getInstalledPackages(): Command: %s', cmd)
-            
             if settings.SWM_SIMULATION:
                 # simulate package list
                 return [ 'bluez_driver_1.2.2', 'bluez_apps_2.4.4' ]
             else:
-                # return package list
-                sp = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                (stdout, stderr) = sp.communicate()
-                if sp.returncode == 0:
-                    pl = stdout.split("\n")[:-1]
-                    logger.debug('PackageManager.PkgMgrService.getInstalledPackages(): Package List: %s.', pl)
-                    return pl
-                else:
-                    logger.error('PackageManager.PkgMgrService.getInstalledPackages(): Error: %s.', stderr)
+                # return package list from the index
+                pl = self.index.list()
+                if pl is None:
+                    logger.error('PackageManager.PkgMgrService.getInstalledPackages(): Could not list packages.')
                     return None
+                logger.debug('PackageManager.PkgMgrService.getInstalledPackages(): Package List: %s.', pl)
+                return pl
 
         except Exception as e:
             logger.error('PackageManager.PkgMgrService.getInstalledPackages(): Exception: %s.', e)
@@ -317,26 +454,19 @@ class PkgMgrService(dbus.service.Object):
         @return List of packages that match, empty list otherwise
         """
         try:
-            # assemble check command
             name = self.splitPackageName(package)[0]
-            cmd = list(settings.PKGMGR_CHECK_CMD)
-            cmd.append(name)
-            logger.debug('PackageManager.PkgMgrService.checkInstalledPackage(): Command: %s', cmd)
             
             if settings.SWM_SIMULATION:
                 # simulate package list
                 return [ splitext(package)[0] ]
             else:
                 # check if package is installed
-                sp = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                (stdout, stderr) = sp.communicate()
-                if sp.returncode == 0:
-                    pl = stdout.split("\n")[:-1]
+                pl = self.index.lookup(name).keys()
+                if pl:
                     logger.info('PackageManager.PkgMgrService.checkInstalledPackages(): Package List: %s.', pl)
-                    return pl
                 else:
                     logger.info('PackageManager.PkgMgrService.checkInstalledPackages(): Package not installed.')
-                    return []
+                return pl
             
         except Exception as e:
             logger.error('PackageManager.PkgMgrService.checkInstalledPackage(): Exception: %s.', e)
@@ -388,15 +518,17 @@ class PkgMgrService(dbus.service.Object):
         """Check if package is newer than all packages in a list
         of packages
         
-        @param packagelist List of packages to check against
-        @param package Package to check
+        Versions are compared according to the rules of the platform's
+        package manager, using sort keys cached per package.
+        
+        @param packagelist List of installed packages to check against
+        @param package Package file name to check
         @return True if package is newer, False otherwise
         """
         
-        version = self.getPackageVersion(package)
+        key = version.package_key(package, self.splitPackageName)
         for pkg in package_list:
-            pver = self.getPackageVersion(pkg)
-            if version <= pver:
+            if version.package_key(pkg, self.index.parse) >= key:
                 return False
         return True
             
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+""" Package Version Comparison
+
+This module provides version comparison for rpm and Debian packages.
+Versions are converted into sort keys once, so that comparing versions
+is a plain tuple comparison. The keys order versions like rpmvercmp()
+and dpkg's verrevcmp() respectively.
+
+(c) 2015, 2016 - Jaguar Land Rover.
+Mozilla Public License 2.0
+"""
+
+import re
+import settings
+import logging
+
+logger = logging.getLogger(settings.LOGGER)
+
+# Maximum number of cached sort keys
+CACHE_SIZE = 10000
+
+_keys = {}
+
+_RPM_SEGMENT = re.compile(r"(~|\^|[0-9]+|[a-zA-Z]+)")
+_DEB_SEGMENT = re.compile(r"([^0-9]*)([0-9]*)")
+
+# rpm: markers of the segment types. A segment at the end of the
+# version sorts after a tilde but before anything else, except for
+# a caret which sorts after the end of the version.
+_RPM_TILDE = (-1,)
+_RPM_END = (0,)
+_RPM_CARET = (0, 1)
+_RPM_ALPHA = 1
+_RPM_NUMERIC = 2
+
+
+def rpm_version_key(version):
+    """Get the sort key of an rpm version or release string
+
+    Alphanumeric segments are compared, separators are ignored. Numeric
+    segments sort after alphabetic ones, a tilde sorts before anything,
+    including the end of the version.
+
+    @param version Version or release string
+    @return Sort key
+    """
+    key = []
+    for segment in _RPM_SEGMENT.findall(version or ""):
+        if segment == "~":
+            key.append(_RPM_TILDE)
+        elif segment == "^":
+            key.append(_RPM_CARET)
+        elif segment.isdigit():
+            key.append((_RPM_NUMERIC, int(segment)))
+        else:
+            key.append((_RPM_ALPHA, segment))
+    key.append(_RPM_END)
+    return tuple(key)
+
+
+def _deb_order(c):
+    """Get the sort order of a character in a non-digit part of a Debian version
+    """
+    if c == "~":
+        return -1
+    if c.isalpha():
+        return ord(c)
+    return ord(c) + 256
+
+
+# Non-digit part and number of an empty Debian version segment
+_DEB_EMPTY = ((0,), 0)
+
+
+def deb_version_key(version):
+    """Get the sort key of a Debian upstream version or revision string
+
+    The string is split into alternating non-digit and digit parts. The
+    non-digit parts are compared character by character, with letters
+    sorting before other characters, a tilde sorting before anything and
+    the end of the part sorting before everything except a tilde. The digit
+    parts are compared numerically.
+
+    @param version Upstream version or revision string
+    @return Sort key
+    """
+    key = []
+    for (text, digits) in _DEB_SEGMENT.findall(version or ""):
+        if not text and not digits:
+            continue
+        key.append((tuple([_deb_order(c) for c in text]) + (0,), int(digits or 0)))
+    # Only the first segment may have an empty non-digit part. At any
+    # later position the end of the version, which compares like empty
+    # segments, sorts after a tilde and before anything else, hence the
+    # keys compare correctly although their lengths differ.
+    if not key:
+        key.append(_DEB_EMPTY)
+    key.append(_DEB_EMPTY)
+    return tuple(key)
+
+
+def version_key(version, release):
+    """Get the sort key of a package version
+
+    The package format is selected by settings.PACKAGE_MANAGER. An epoch
+    may be given as prefix of the version, separated by a colon. Keys are
+    cached per version and release.
+
+    @param version Version string, optionally with epoch
+    @param release Release (rpm) or revision (Debian) string
+    @return Sort key
+    """
+    cache_key = (version, release)
+    key = _keys.get(cache_key)
+    if key is not None:
+        return key
+
+    epoch = 0
+    version = version or ""
+    if ":" in version:
+        (epoch, version) = version.split(":", 1)
+        try:
+            epoch = int(epoch)
+        except ValueError:
+            logger.warning('PackageManager.version.version_key(): Invalid epoch: %s', epoch)
+            epoch = 0
+
+    if settings.PACKAGE_MANAGER == "deb":
+        key = (epoch, deb_version_key(version), deb_version_key(release))
+    else:
+        key = (epoch, rpm_version_key(version), rpm_version_key(release))
+
+    if len(_keys) >= CACHE_SIZE:
+        _keys.clear()
+    _keys[cache_key] = key
+    return key
+
+
+def package_key(package, split):
+    """Get the sort key of the version of a package
+
+    Keys are cached per package string, so the package is split only
+    the first time its key is requested.
+
+    @param package Package file name or installed package
+    @param split Callable splitting the package into the tuple
+                 (name, ver, rel, arch, ptype)
+    @return Sort key
+    """
+    key = _keys.get(package)
+    if key is None:
+        (name, ver, rel, arch, ptype) = split(package)
+        key = version_key(ver, rel)
+        _keys[package] = key
+    return key
+
+
+def compare(version1, release1, version2, release2):
+    """Compare two package versions
+
+    @return Negative if the first version is older, zero if both versions
+            are equal and positive if the first version is newer
+    """
+    return cmp(version_key(version1, release1), version_key(version2, release2))
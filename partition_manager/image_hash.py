@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+""" Image Hashes
+
+This module computes the Merkle tree hash of partition images. The image
+is cut into leaves of settings.PARTMGR_HASH_BLOCK_SIZE bytes, which are
+hashed in parallel while the image is written.
+
+Tree definition, as in RFC 6962:
+
+    leaf hash = SHA-256(0x00 || leaf data)
+    node hash = SHA-256(0x01 || left hash || right hash)
+
+A node without a right sibling is carried up to the next level unchanged.
+The root of an image is the hash of its expanded content, the same for a
+raw image and the sparse image created from it. Ranges of a sparse image
+whose content does not matter are hashed as zeros.
+
+(c) 2015, 2016 - Jaguar Land Rover.
+Mozilla Public License 2.0
+"""
+
+import os
+import sys
+import hashlib
+import binascii
+import collections
+from multiprocessing.pool import ThreadPool
+import settings
+import logging
+import sparse_image
+
+logger = logging.getLogger(settings.LOGGER)
+
+
+def hash_leaves(data, leaf_size):
+    """Hash the leaves of a piece of an image
+
+    Runs on the threads of a HashPipeline. hashlib does not hold the
+    interpreter lock while hashing, so leaves are hashed in parallel.
+
+    @param data Piece of the image starting at a leaf boundary
+    @param leaf_size Size of a leaf in bytes
+
+    @return List of leaf hashes
+    """
+    leaves = []
+    for offset in xrange(0, len(data), leaf_size):
+        h = hashlib.sha256("\0")
+        h.update(buffer(data, offset, leaf_size))
+        leaves.append(h.digest())
+    return leaves
+
+
+def merkle_root(leaves):
+    """Compute the root of a Merkle tree
+
+    @param leaves List of leaf hashes
+
+    @return Root hash, the hash of no data if there are no leaves
+    """
+    if not leaves:
+        return hashlib.sha256("").digest()
+    level = leaves
+    while len(level) > 1:
+        parents = [ hashlib.sha256("\1" + level[i] + level[i + 1]).digest()
+                    for i in xrange(0, len(level) - 1, 2) ]
+        if len(level) % 2:
+            parents.append(level[-1])
+        level = parents
+    return level[0]
+
+
+_pool = None
+
+def get_pool():
+    """Get the pool of hashing threads
+
+    The pool of settings.PARTMGR_HASH_WORKERS threads is started on first use
+    and shared by all pipelines.
+
+    @return ThreadPool object
+    """
+    global _pool
+    if _pool is None:
+        _pool = ThreadPool(settings.PARTMGR_HASH_WORKERS)
+    return _pool
+
+
+class HashPipeline:
+    """Pipeline hashing an image while it is streamed
+
+    The image is fed in pieces of any size. Whole leaves are handed to the
+    pool of hashing threads, at most settings.PARTMGR_BLOCK_SIZE bytes per
+    job. The number of jobs in flight
+    is bounded, feeding blocks while the pool is behind. Runs of leaves
+    filled with a repeated value are hashed once.
+    """
+
+    def __init__(self):
+        """Constructor
+        """
+        self.leaf_size = settings.PARTMGR_HASH_BLOCK_SIZE
+        self.job_size = max(settings.PARTMGR_BLOCK_SIZE // self.leaf_size, 1) * self.leaf_size
+        self.pool = get_pool()
+        # Leaf hashes in order, lists of leaf hashes or pending jobs
+        self.jobs = []
+        self.pending = collections.deque()
+        self.data = []
+        self.size = 0
+        # value -> hash of a leaf filled with it
+        self.fills = {}
+
+
+    def update(self, data):
+        """Feed a piece of the image
+
+        @param data Piece of the image following the previous piece
+        """
+        if not self.size and len(data) == self.job_size:
+            self.submit(data)
+            return
+        self.data.append(data)
+        self.size = self.size + len(data)
+        if self.size >= self.job_size:
+            data = "".join(self.data)
+            whole = len(data) - len(data) % self.leaf_size
+            for offset in xrange(0, whole, self.job_size):
+                self.submit(data[offset:min(offset + self.job_size, whole)])
+            self.data = [ data[whole:] ]
+            self.size = len(self.data[0])
+
+
+    def update_fill(self, value, length):
+        """Feed a range of the image filled with a repeated value
+
+        @param value Value of 4 bytes
+        @param length Length of the range, a multiple of 4
+        """
+        # Complete the current leaf.
+        head = min((self.leaf_size - self.size % self.leaf_size) % self.leaf_size, length)
+        if head:
+            self.update(value * (head // 4))
+            length = length - head
+        if length < self.leaf_size:
+            if length:
+                self.update(value * (length // 4))
+            return
+        self.flush()
+        if value not in self.fills:
+            self.fills[value] = hash_leaves(value * (self.leaf_size // 4), self.leaf_size)[0]
+        self.jobs.append([ self.fills[value] ] * (length // self.leaf_size))
+        if length % self.leaf_size:
+            self.update(value * (length % self.leaf_size // 4))
+
+
+    def submit(self, data):
+        """Hand whole leaves to the pool
+
+        @param data Leaf data
+        """
+        while len(self.pending) >= 2 * settings.PARTMGR_HASH_WORKERS:
+            self.pending.popleft().wait()
+        job = self.pool.apply_async(hash_leaves, (data, self.leaf_size))
+        self.jobs.append(job)
+        self.pending.append(job)
+
+
+    def flush(self):
+        """Hand the data fed so far to the pool, also a partial last leaf
+        """
+        if self.size:
+            self.submit("".join(self.data))
+            self.data = []
+            self.size = 0
+
+
+    def leaves(self):
+        """Wait for all leaves to be hashed
+
+        No more data can be fed afterwards.
+
+        @return List of leaf hashes
+        """
+        self.flush()
+        leaves = []
+        for job in self.jobs:
+            if isinstance(job, list):
+                leaves.extend(job)
+            else:
+                leaves.extend(job.get())
+        self.jobs = []
+        self.pending.clear()
+        return leaves
+
+
+def image_root(image_path):
+    """Compute the Merkle root of an image file
+
+    @param image_path Path of the image, raw or in the sparse image format
+
+    @return Root hash as hexadecimal string
+    """
+    pipeline = HashPipeline()
+    fd = os.open(image_path, os.O_RDONLY)
+    try:
+        if sparse_image.is_sparse(fd):
+            (block_size, blocks, count, chunk_header_size) = sparse_image.read_header(fd)
+            os.lseek(fd, 0, os.SEEK_SET)
+            for (chunk_type, offset, chunk_blocks, value) in sparse_image.chunks(fd):
+                length = chunk_blocks * block_size
+                if chunk_type == sparse_image.CHUNK_RAW:
+                    while length > 0:
+                        data = os.read(fd, min(length, settings.PARTMGR_BLOCK_SIZE))
+                        if not data:
+                            raise Exception("Sparse image truncated")
+                        pipeline.update(data)
+                        length = length - len(data)
+                else:
+                    pipeline.update_fill(value or "\0\0\0\0", length)
+        else:
+            while True:
+                data = os.read(fd, settings.PARTMGR_BLOCK_SIZE)
+                if not data:
+                    break
+                pipeline.update(data)
+        return binascii.hexlify(merkle_root(pipeline.leaves()))
+    finally:
+        os.close(fd)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print "Usage:", sys.argv[0], "image"
+        sys.exit(1)
+    print image_root(sys.argv[1])
@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+""" Partition Delta
+
+This module provides a block delta format for partition images. A delta
+transforms the content of a partition, the source image, into a new
+target image. It is applied in place to the partition, so that only the
+blocks that have changed are transferred and written.
+
+Delta file format, all integers big endian:
+
+    header:  "SWMDELT1", block size (uint32), source size (uint64),
+             target size (uint64), SHA-256 of the source image (32 bytes),
+             SHA-256 of the target image (32 bytes), SHA-256 of the
+             records (32 bytes)
+    records: one per block of the target image, in order
+             COPY (uint8 0), source block index (uint64)
+             DATA (uint8 1), length (uint64), zlib compressed block
+
+A COPY record never refers to a source block before its own target block.
+Those blocks have already been overwritten when the record is applied.
+The records are checked against their hash before the partition is
+written, as a delta failing halfway leaves the partition holding neither
+image.
+
+(c) 2015, 2016 - Jaguar Land Rover.
+Mozilla Public License 2.0
+"""
+
+import os
+import sys
+import zlib
+import struct
+import bisect
+import hashlib
+import time
+import settings
+import logging
+import partition_writer
+
+logger = logging.getLogger(settings.LOGGER)
+
+MAGIC = "SWMDELT1"
+HEADER = struct.Struct(">8sIQQ32s32s32s")
+RECORD = struct.Struct(">BQ")
+
+# Record types
+COPY = 0
+DATA = 1
+
+
+def read_exactly(fd, length):
+    """Read a number of bytes from a file
+
+    @param fd File descriptor
+    @param length Number of bytes to read
+
+    @return Data read, shorter than length only at the end of the file
+    """
+    data = os.read(fd, length)
+    while data and len(data) < length:
+        more = os.read(fd, length - len(data))
+        if not more:
+            break
+        data = data + more
+    return data
+
+
+def hash_prefixes(fd, sizes, block_size):
+    """Compute the SHA-256 of prefixes of a file in a single pass
+
+    @param fd File descriptor, read from its start
+    @param sizes List of prefix lengths in bytes
+    @param block_size Number of bytes read at a time
+
+    @return List of digests, one per prefix length
+    """
+    hashes = [ hashlib.sha256() for size in sizes ]
+    offset = 0
+    os.lseek(fd, 0, os.SEEK_SET)
+    while offset < max(sizes):
+        data = read_exactly(fd, min(block_size, max(sizes) - offset))
+        if not data:
+            break
+        for (h, size) in zip(hashes, sizes):
+            if offset < size:
+                h.update(data[:size - offset])
+        offset = offset + len(data)
+    return [ h.digest() for h in hashes ]
+
+
+def make_delta(source_path, target_path, delta_path, block_size=None):
+    """Create the delta between two partition images
+
+    Target blocks are matched against the source blocks at the same
+    position first, then against any later source block with the same
+    content.
+
+    @param source_path Image currently on the partition
+    @param target_path Image the partition is patched to
+    @param delta_path File the delta is written to
+    @param block_size Block size of the delta, settings.PARTMGR_DELTA_BLOCK_SIZE
+                      if None
+
+    @return Tuple (number of COPY records, number of DATA records)
+    """
+    block_size = block_size or settings.PARTMGR_DELTA_BLOCK_SIZE
+    source_fd = os.open(source_path, os.O_RDONLY)
+    target_fd = os.open(target_path, os.O_RDONLY)
+    try:
+        source_size = os.fstat(source_fd).st_size
+        target_size = os.fstat(target_fd).st_size
+        (source_hash,) = hash_prefixes(source_fd, [source_size], 1024 * 1024)
+        (target_hash,) = hash_prefixes(target_fd, [target_size], 1024 * 1024)
+
+        # digest -> ascending indexes of the full source blocks with it
+        signatures = {}
+        os.lseek(source_fd, 0, os.SEEK_SET)
+        for index in xrange(0, source_size // block_size):
+            digest = hashlib.sha1(read_exactly(source_fd, block_size)).digest()
+            signatures.setdefault(digest, []).append(index)
+
+        copies = 0
+        literals = 0
+        os.lseek(target_fd, 0, os.SEEK_SET)
+        records = hashlib.sha256()
+        with open(delta_path, "wb") as delta:
+            delta.write(HEADER.pack(MAGIC, block_size, source_size, target_size, source_hash, target_hash, ""))
+            index = 0
+            while True:
+                block = read_exactly(target_fd, block_size)
+                if not block:
+                    break
+                source = None
+                if index * block_size + len(block) <= source_size:
+                    os.lseek(source_fd, index * block_size, os.SEEK_SET)
+                    if read_exactly(source_fd, len(block)) == block:
+                        source = index
+                if source is None and len(block) == block_size:
+                    indexes = signatures.get(hashlib.sha1(block).digest(), [])
+                    i = bisect.bisect_left(indexes, index)
+                    if i < len(indexes):
+                        source = indexes[i]
+                if source is not None:
+                    record = RECORD.pack(COPY, source)
+                    copies = copies + 1
+                else:
+                    data = zlib.compress(block, 6)
+                    record = RECORD.pack(DATA, len(data)) + data
+                    literals = literals + 1
+                delta.write(record)
+                records.update(record)
+                index = index + 1
+            delta.seek(0)
+            delta.write(HEADER.pack(MAGIC, block_size, source_size, target_size, source_hash, target_hash,
+                                    records.digest()))
+    finally:
+        os.close(source_fd)
+        os.close(target_fd)
+    return (copies, literals)
+
+
+class DeltaPatcher:
+    """Patcher applying a delta to a partition in place
+
+    The partition is checked to hold the source image of the delta before
+    anything is written. Records copying a block onto itself are not written.
+    The target image is hashed while it is produced and checked against the
+    delta once all records have been applied.
+    """
+
+    def __init__(self, device, progress=None):
+        """Constructor
+
+        @param device Path of the partition device, or of a file standing in
+                      for it
+        @param progress Callable invoked with (bytes done, bytes total) every
+                        settings.PARTMGR_PROGRESS_INTERVAL seconds and once
+                        patching has completed
+        """
+        self.device = device
+        self.progress = progress
+        self.total = 0
+        self.written = 0
+        self.elapsed = 0.0
+
+
+    def patch(self, delta_path):
+        """Apply a delta to the partition
+
+        @param delta_path Path of the delta
+
+        @return True if the delta was applied, False if the partition already
+                held the target image. Raises an exception if the partition
+                holds neither the source nor the target image or if the
+                delta is corrupt.
+        """
+        start = time.time()
+        delta_fd = os.open(delta_path, os.O_RDONLY)
+        try:
+            device_fd = os.open(self.device, os.O_RDWR)
+            try:
+                applied = self.apply(delta_fd, device_fd)
+            finally:
+                os.close(device_fd)
+        finally:
+            os.close(delta_fd)
+        self.elapsed = time.time() - start
+        logger.info('PartitionManager.DeltaPatcher.patch(%s): %s bytes in %.1f s, %s bytes written, applied: %s.',
+                    self.device, self.total, self.elapsed, self.written, applied)
+        return applied
+
+
+    def apply(self, delta_fd, device_fd):
+        """Apply the records of a delta to the partition
+
+        @param delta_fd File descriptor of the delta
+        @param device_fd File descriptor of the partition device
+
+        @return True if the delta was applied, False if the partition already
+                held the target image
+        """
+        header = read_exactly(delta_fd, HEADER.size)
+        if len(header) < HEADER.size or header[:len(MAGIC)] != MAGIC:
+            raise Exception("Not a partition delta")
+        (magic, block_size, source_size, target_size, source_hash, target_hash, records_hash) = HEADER.unpack(header)
+        self.total = target_size
+        records = hashlib.sha256()
+        while True:
+            data = os.read(delta_fd, settings.PARTMGR_BLOCK_SIZE)
+            if not data:
+                break
+            records.update(data)
+        if records.digest() != records_hash:
+            raise Exception("Delta is corrupt")
+        os.lseek(delta_fd, HEADER.size, os.SEEK_SET)
+        size = os.lseek(device_fd, 0, os.SEEK_END)
+        if target_size > size:
+            raise Exception("Target image of {} bytes does not fit into partition of {} bytes".format(target_size, size))
+
+        (current_source, current_target) = hash_prefixes(device_fd, [source_size, target_size],
+                                                         settings.PARTMGR_BLOCK_SIZE)
+        if current_source != source_hash:
+            if current_target == target_hash:
+                # Patched before, e.g. by an attempt interrupted after all
+                # records had been applied.
+                return False
+            raise Exception("Partition does not hold the source image of the delta")
+
+        target = hashlib.sha256()
+        done = 0
+        reported = time.time()
+        while done < target_size:
+            index = done // block_size
+            length = min(block_size, target_size - done)
+            record = read_exactly(delta_fd, RECORD.size)
+            if len(record) < RECORD.size:
+                raise Exception("Delta truncated at target offset {}".format(done))
+            (kind, argument) = RECORD.unpack(record)
+            if kind == COPY:
+                if argument < index or argument * block_size + length > source_size:
+                    raise Exception("Invalid source block {} for target block {}".format(argument, index))
+                os.lseek(device_fd, argument * block_size, os.SEEK_SET)
+                block = read_exactly(device_fd, length)
+                write = argument != index
+            elif kind == DATA:
+                block = zlib.decompress(read_exactly(delta_fd, argument))
+                write = True
+            else:
+                raise Exception("Invalid record type {} for target block {}".format(kind, index))
+            if len(block) != length:
+                raise Exception("Invalid length of target block {}".format(index))
+
+            target.update(block)
+            if write:
+                os.lseek(device_fd, done, os.SEEK_SET)
+                written = 0
+                while written < length:
+                    written = written + os.write(device_fd, buffer(block, written))
+                self.written = self.written + length
+            done = done + length
+            if self.progress and time.time() - reported >= settings.PARTMGR_PROGRESS_INTERVAL:
+                reported = time.time()
+                self.progress(done, target_size)
+
+        os.fsync(device_fd)
+        partition_writer.fadvise(device_fd, 0, 0, partition_writer.POSIX_FADV_DONTNEED)
+        if target.digest() != target_hash:
+            raise Exception("Target image hash mismatch after patching")
+        if self.progress:
+            self.progress(done, target_size)
+        return True
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 4:
+        print "Usage:", sys.argv[0], "source_image target_image delta"
+        sys.exit(1)
+    (copies, literals) = make_delta(sys.argv[1], sys.argv[2], sys.argv[3])
+    print "Delta {}: {} blocks copied, {} blocks literal, {} bytes".format(
+        sys.argv[3], copies, literals, os.path.getsize(sys.argv[3]))
@@ -14,6 +14,10 @@ from dbus.mainloop.glib import DBusGMainLoop
 import sys
 import time
 import swm
+import worker
+import partition_writer
+import partition_delta
+import partition_table
 import settings
 import logging
 import os
@@ -41,6 +45,160 @@ class PartMgrService(dbus.service.Object):
         bus_name = dbus.service.BusName('org.genivi.PartitionManager', bus=dbus.SessionBus())
         dbus.service.Object.__init__(self, bus_name, '/org/genivi/PartitionManager')
 
+        # Partition operations block on disk I/O and are carried out on
+        # worker threads.
+        self.workers = worker.WorkerPool(settings.PARTMGR_WORKERS)
+
+
+    def submitOperation(self, transaction_id, method, disk, failure_code, work):
+        """Carry out a partition operation off the main loop
+        
+        The operation is run on the worker pool, serialized with all other
+        operations on the same disk. Once it has completed, the result is
+        sent to Software Loading Manager from the main loop.
+        
+        @param transaction_id Software Loading Manager transaction id
+        @param method Name of the calling dbus method, for logging
+        @param disk Disk the operation is carried out on
+        @param failure_code Result code to report if the operation fails
+        @param work Callable carrying out the operation. It returns a tuple
+                    (resultcode, resulttext), or a list of results encoded
+                    with swm.result() for a batch operation, and raises an
+                    exception if the operation fails.
+        """
+        def done(result, error):
+            if error:
+                logger.error('PartitionManager.PartMgrService.%s(): Exception: %s.', method, error)
+                swm.send_operation_result(transaction_id, failure_code, "Error: {}".format(error))
+                return
+            if isinstance(result, list):
+                logger.info('PartitionManager.PartMgrService.%s(): %s results.', method, len(result))
+                swm.send_operation_results(transaction_id, result)
+                return
+            (resultcode, resulttext) = result
+            logger.info('PartitionManager.PartMgrService.%s(): %s', method, resulttext)
+            swm.send_operation_result(transaction_id, resultcode, resulttext)
+
+        self.workers.submit(work, done, lock_key=disk)
+
+
+    def progressReporter(self, transaction_id):
+        """Get a callback reporting the progress of an operation
+        
+        The callback may be invoked from a worker thread. The progress is
+        sent to Software Loading Manager from the main loop.
+        
+        @param transaction_id Software Loading Manager transaction id
+        
+        @return Callable taking the arguments (completed, total)
+        """
+        def progress(completed, total):
+            gobject.idle_add(swm.send_operation_progress, transaction_id, completed, total)
+        return progress
+
+
+    def writeImage(self, transaction_id, disk, partition_number, image_path, image_hash):
+        """Write an image to a partition
+        
+        Runs on a worker thread.
+        
+        @param transaction_id Software Loading Manager transaction id
+        @param disk Disk of the partition
+        @param partition_number Number of the partition
+        @param image_path Image to write to the partition
+        @param image_hash Merkle root of the image, empty to not check it
+        
+        @return Tuple (resultcode, resulttext)
+        """
+        device = partition_writer.get_partition_device(disk, partition_number)
+        writer = partition_writer.PartitionWriter(device, self.progressReporter(transaction_id))
+        writer.write(image_path, image_hash or None)
+        return (swm.SWMResult.SWM_RES_OK,
+                "Writing disk partition successful. Disk: {}:{}. {} bytes in {:.1f} s ({:.1f} MB/s), {} bytes written, {} bytes discarded."
+                .format(disk, partition_number, writer.total, writer.elapsed,
+                        writer.total / max(writer.elapsed, 0.001) / 1e6, writer.written, writer.discarded))
+
+
+    # Result codes of failed partition changes by operation
+    CHANGE_FAILURES = {
+        "createDiskPartition": swm.SWMResult.SWM_RES_CREATE_PARTITION_FAILED,
+        "resizeDiskPartition": swm.SWMResult.SWM_RES_RESIZE_PARTITION_FAILED,
+        "deleteDiskPartition": swm.SWMResult.SWM_RES_DELETE_PARTITION_FAILED
+    }
+
+    def changePartitions(self, disk, changes):
+        """Apply changes to the partition table of a disk
+        
+        Runs on a worker thread. The table is read once, all changes are
+        applied to it in memory and it is written with a single rewrite,
+        sync and re-read by the kernel. If a change fails, none of the
+        changes is written.
+        
+        @param disk Disk to change the partitions of
+        @param changes List of dictionaries with the operation and the
+                       arguments of each change, see changeDiskPartitions()
+        
+        @return List of tuples (resultcode, resulttext), one per change
+        """
+        fd = os.open(disk, os.O_RDWR)
+        try:
+            table = partition_table.PartitionTable(fd)
+            table.read()
+            for (i, change) in enumerate(changes):
+                operation = change["operation"]
+                number = int(change["partitionNumber"])
+                try:
+                    if operation == "createDiskPartition":
+                        table.create(number, int(change["type"]), int(change["start"]), int(change["size"]),
+                                     str(change.get("guid", "")), unicode(change.get("name", "")))
+                    elif operation == "resizeDiskPartition":
+                        table.resize(number, int(change["start"]), int(change["size"]))
+                    elif operation == "deleteDiskPartition":
+                        table.delete(number)
+                    else:
+                        raise Exception("Unknown partition change {}".format(operation))
+                except Exception as e:
+                    logger.error('PartitionManager.PartMgrService.changePartitions(%s): %s of partition %s failed: %s.',
+                                 disk, operation, number, e)
+                    results = []
+                    for (j, other) in enumerate(changes):
+                        code = self.CHANGE_FAILURES.get(other["operation"], swm.SWMResult.SWM_RES_GENERAL_ERROR)
+                        if j == i:
+                            results.append((code, "Error: {}".format(e)))
+                        else:
+                            results.append((code, "Not applied. Change of partition {} failed.".format(number)))
+                    return results
+            reread = table.write()
+        finally:
+            os.close(fd)
+        text = "Partition table updated. Disk: {}, {} changes.".format(disk, len(changes))
+        if not reread:
+            text = text + " The kernel uses the new table after a reboot."
+        return [ (swm.SWMResult.SWM_RES_OK, text) ] * len(changes)
+
+
+    def patchImage(self, transaction_id, disk, partition_number, delta_path):
+        """Apply a delta to a partition
+        
+        Runs on a worker thread.
+        
+        @param transaction_id Software Loading Manager transaction id
+        @param disk Disk of the partition
+        @param partition_number Number of the partition
+        @param delta_path Delta to apply to the partition
+        
+        @return Tuple (resultcode, resulttext)
+        """
+        device = partition_writer.get_partition_device(disk, partition_number)
+        patcher = partition_delta.DeltaPatcher(device, self.progressReporter(transaction_id))
+        if not patcher.patch(delta_path):
+            return (swm.SWMResult.SWM_RES_OK,
+                    "Patching disk partition successful. Disk: {}:{}. Delta already applied."
+                    .format(disk, partition_number))
+        return (swm.SWMResult.SWM_RES_OK,
+                "Patching disk partition successful. Disk: {}:{}. {} bytes in {:.1f} s, {} bytes written."
+                .format(disk, partition_number, patcher.total, patcher.elapsed, patcher.written))
+
 
     @dbus.service.method('org.genivi.PartitionManager',
                          async_callbacks=('send_reply', 'send_error'))
@@ -57,14 +215,15 @@ class PartMgrService(dbus.service.Object):
                               send_error): 
         """Create a Partition on a Disk
         
-        Dbus callback for creating a partition on a disk using the platform's
-        partition management system.
+        Dbus callback for creating a partition in the partition table of a
+        disk. A disk without a partition table gets a new table.
         
         @param transaction_id Software Loading Manager transaction id
         @param disk Disk to partition
         @param partition_number Number of the partition
-        @param partition_type Type of the partition
-        @param start Start sector of the partition
+        @param partition_type MBR type of the partition, mapped to the GPT
+                              partition type on GPT disks
+        @param start Offset in bytes of the partition
         @param size Size in bytes of the partition
         @param guid GUID for the partition
         @param name Name of the partition
@@ -98,9 +257,12 @@ class PartMgrService(dbus.service.Object):
             else:
                 # perform disk partition creation
                 logger.info('PartitionManager.PartMgrService.createDiskPartition(): Creating disk partition...')
-                resultcode = swm.SWMResult.SWM_RES_OK
-                resulttext = "Creating disk partition successful. Disk: {}:{}".format(disk, partition_number)
-                logger.info('PartitionManager.PartMgrService.createDiskPartition(): Creating disk partition successful.')
+                change = { "operation": "createDiskPartition", "partitionNumber": partition_number,
+                           "type": partition_type, "start": start, "size": size, "guid": guid, "name": name }
+                self.submitOperation(transaction_id, "createDiskPartition", disk,
+                                     swm.SWMResult.SWM_RES_CREATE_PARTITION_FAILED,
+                                     lambda: self.changePartitions(disk, [ change ])[0])
+                return None
 
             swm.send_operation_result(transaction_id, resultcode, resulttext)
 
@@ -124,15 +286,14 @@ class PartMgrService(dbus.service.Object):
                               send_error): 
         """Resize a Partition on a Disk
         
-        Dbus callback for resizing a partition on a disk using the platform's
-        partition management system.
+        Dbus callback for resizing a partition in the partition table of a
+        disk. The start of the partition cannot be moved.
         
         @param transaction_id Software Loading Manager transaction id
         @param disk Disk on which to resize the partition
         @param partition_number Number of the partition
-        @param partition_type Type of the partition
-        @param start Start sector of the partition
-        @param size Size in bytes of the partition
+        @param start Offset in bytes of the partition, which must not change
+        @param size New size in bytes of the partition
         @param send_reply DBus callback for a standard reply
         @param send_error DBus callback for error response
         """
@@ -163,9 +324,12 @@ class PartMgrService(dbus.service.Object):
             else:
                 # perform resizing the disk partition
                 logger.info('PartitionManager.PartMgrService.resizeDiskPartition(): Resizing disk partition...')
-                resultcode = swm.SWMResult.SWM_RES_OK
-                resulttext = "Resizing disk partition successful. Disk: {}:{}".format(disk, partition_number)
-                logger.info('PartitionManager.PartMgrService.resizeDiskPartition(): Resizing disk partition successful.')
+                change = { "operation": "resizeDiskPartition", "partitionNumber": partition_number,
+                           "start": start, "size": size }
+                self.submitOperation(transaction_id, "resizeDiskPartition", disk,
+                                     swm.SWMResult.SWM_RES_RESIZE_PARTITION_FAILED,
+                                     lambda: self.changePartitions(disk, [ change ])[0])
+                return None
 
             swm.send_operation_result(transaction_id, resultcode, resulttext)
 
@@ -187,8 +351,8 @@ class PartMgrService(dbus.service.Object):
                               send_error): 
         """Delete a Partition on a Disk
         
-        Dbus callback for deleting a partition on a disk using the platform's
-        partition management system.
+        Dbus callback for deleting a partition from the partition table of
+        a disk.
         
         @param transaction_id Software Loading Manager transaction id
         @param disk Disk from which to delete the partition
@@ -223,9 +387,11 @@ class PartMgrService(dbus.service.Object):
             else:
                 # perform deleting the disk partition
                 logger.info('PartitionManager.PartMgrService.deleteDiskPartition(): Deleting disk partition...')
-                resultcode = swm.SWMResult.SWM_RES_OK
-                resulttext = "Deleting disk partition successful. Disk: {}:{}".format(disk, partition_number)
-                logger.info('PartitionManager.PartMgrService.deleteDiskPartition(): Deleting disk partition successful.')
+                change = { "operation": "deleteDiskPartition", "partitionNumber": partition_number }
+                self.submitOperation(transaction_id, "deleteDiskPartition", disk,
+                                     swm.SWMResult.SWM_RES_DELETE_PARTITION_FAILED,
+                                     lambda: self.changePartitions(disk, [ change ])[0])
+                return None
 
             swm.send_operation_result(transaction_id, resultcode, resulttext)
 
@@ -237,6 +403,67 @@ class PartMgrService(dbus.service.Object):
         return None
 
 
+    @dbus.service.method('org.genivi.PartitionManager',
+                         async_callbacks=('send_reply', 'send_error'))
+    def changeDiskPartitions(self, 
+                             transaction_id,
+                             disk,
+                             changes,
+                             send_reply, 
+                             send_error): 
+        """Change several Partitions on a Disk
+        
+        Dbus callback for creating, resizing and deleting partitions with a
+        single update of the partition table of a disk. Either all changes
+        are applied or none. One result per change is reported back, in the
+        order of changes.
+        
+        @param transaction_id Software Loading Manager transaction id
+        @param disk Disk to change the partitions of
+        @param changes List of dictionaries with the element "operation",
+                       createDiskPartition, resizeDiskPartition or
+                       deleteDiskPartition, and the elements of the operation
+        @param send_reply DBus callback for a standard reply
+        @param send_error DBus callback for error response
+        """
+
+        logger.debug('PartitionManager.PartMgrService.changeDiskPartitions(%s, %s, %s): Called.',
+                     transaction_id, disk, changes)
+
+        try:
+            #
+            # Send back an immediate reply since DBUS
+            # doesn't like python dbus-invoked methods to do 
+            # their own calls (nested calls).
+            #
+            send_reply(True)
+
+            ids = [ "{}:{}".format(disk, change["partitionNumber"]) for change in changes ]
+            if settings.SWM_SIMULATION:
+                # simulate changing the disk partitions
+                logger.info('PartitionManager.PartMgrService.changeDiskPartitions(): Changing disk partitions simulation...')
+                time.sleep(settings.SWM_SIMULATION_WAIT)
+                swm.send_operation_results(transaction_id,
+                                           [ swm.result(i, swm.SWMResult.SWM_RES_OK,
+                                                        "Changing disk partition simulation successful. Disk: {}".format(i))
+                                             for i in ids ])
+                logger.info('PartitionManager.PartMgrService.changeDiskPartitions(): Changing disk partitions simulation successful.')
+            else:
+                # perform changing the disk partitions
+                logger.info('PartitionManager.PartMgrService.changeDiskPartitions(): Changing %s disk partitions...', len(changes))
+                self.submitOperation(transaction_id, "changeDiskPartitions", disk,
+                                     swm.SWMResult.SWM_RES_GENERAL_ERROR,
+                                     lambda: [ swm.result(i, resultcode, resulttext) for (i, (resultcode, resulttext))
+                                               in zip(ids, self.changePartitions(disk, changes)) ])
+
+        except Exception as e:
+            logger.error('PartitionManager.PartMgrService.changeDiskPartitions(): Exception: %s.', e)
+            swm.send_operation_result(transaction_id,
+                                      swm.SWMResult.SWM_RES_INTERNAL_ERROR,
+                                      "Internal_error: {}".format(e))
+        return None
+
+
     @dbus.service.method('org.genivi.PartitionManager',
                          async_callbacks=('send_reply', 'send_error'))
     def writeDiskPartition(self, 
@@ -245,6 +472,7 @@ class PartMgrService(dbus.service.Object):
                              partition_number,
                              image_path,
                              blacklisted_partitions,
+                             image_hash,
                              send_reply, 
                              send_error): 
         """Write a Partition on a Disk
@@ -257,12 +485,13 @@ class PartMgrService(dbus.service.Object):
         @param partition_number Number of the partition
         @param image_path Image to write to the partition
         @param blacklisted_partitions List of blacklisted partitions
+        @param image_hash Merkle root of the image, empty to not check it
         @param send_reply DBus callback for a standard reply
         @param send_error DBus callback for error response
         """
 
-        logger.debug('PartitionManager.PartMgrService.writeDiskPartition(%s, %s, %s, %s, %s): Called.',
-                     transaction_id, disk, partition_number, image_path, blacklisted_partitions)
+        logger.debug('PartitionManager.PartMgrService.writeDiskPartition(%s, %s, %s, %s, %s, %s): Called.',
+                     transaction_id, disk, partition_number, image_path, blacklisted_partitions, image_hash)
 
         try:
             #
@@ -287,9 +516,10 @@ class PartMgrService(dbus.service.Object):
             else:
                 # perform writing the disk partition
                 logger.info('PartitionManager.PartMgrService.writeDiskPartition(): Writing disk partition...')
-                resultcode = swm.SWMResult.SWM_RES_OK
-                resulttext = "Writing disk partition successful. Disk: {}:{}".format(disk, partition_number)
-                logger.info('PartitionManager.PartMgrService.writeDiskPartition(): Writing disk partition successful.')
+                self.submitOperation(transaction_id, "writeDiskPartition", disk,
+                                     swm.SWMResult.SWM_RES_WRITE_PARTITION_FAILED,
+                                     lambda: self.writeImage(transaction_id, disk, partition_number, image_path, image_hash))
+                return None
 
             swm.send_operation_result(transaction_id, resultcode, resulttext)
 
@@ -351,9 +581,10 @@ class PartMgrService(dbus.service.Object):
             else:
                 # perform patching the disk partition
                 logger.info('PartitionManager.PartMgrService.patchDiskPartition(): Patching disk partition...')
-                resultcode = swm.SWMResult.SWM_RES_OK
-                resulttext = "Patching disk partition successful. Disk: {}:{}".format(disk, partition_number)
-                logger.info('PartitionManager.PartMgrService.patchDiskPartition(): Patching disk partition successful.')
+                self.submitOperation(transaction_id, "patchDiskPartition", disk,
+                                     swm.SWMResult.SWM_RES_PATCH_PARTITION_FAILED,
+                                     lambda: self.patchImage(transaction_id, disk, partition_number, image_path))
+                return None
 
             swm.send_operation_result(transaction_id, resultcode, resulttext)
 
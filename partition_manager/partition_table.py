@@ -0,0 +1,404 @@
+# -*- coding: utf-8 -*-
+""" Partition Tables
+
+This module reads, changes and writes GPT and MBR partition tables of
+disks or disk image files without invoking external tools. All changes
+are made to the table in memory and written with a single rewrite of the
+table.
+
+MBR tables are limited to the four primary partitions. Logical partitions
+in extended partitions are not supported.
+
+(c) 2015, 2016 - Jaguar Land Rover.
+Mozilla Public License 2.0
+"""
+
+import os
+import stat
+import fcntl
+import struct
+import uuid
+import zlib
+import settings
+import logging
+
+logger = logging.getLogger(settings.LOGGER)
+
+# Block device ioctls
+BLKSSZGET = 0x1268
+BLKRRPART = 0x125f
+
+MBR_SIGNATURE = "\x55\xaa"
+# status, first CHS, type, last CHS, first sector, number of sectors
+MBR_ENTRY = struct.Struct("<B3sB3sII")
+MBR_ENTRIES_OFFSET = 446
+MBR_TYPE_PROTECTIVE = 0xEE
+MBR_TYPES_EXTENDED = (0x05, 0x0F, 0x85)
+# CHS address of sectors that are addressed by LBA only
+CHS_LBA = "\xfe\xff\xff"
+
+GPT_SIGNATURE = "EFI PART"
+GPT_REVISION = 0x00010000
+GPT_HEADER = struct.Struct("<8sIIIIQQQQ16sQIII")
+GPT_ENTRY = struct.Struct("<16s16sQQQ72s")
+GPT_ENTRIES = 128
+
+# GPT partition types of the MBR partition types
+GPT_TYPES = {
+    0x07: "EBD0A0A2-B9E5-4433-87C0-68B6B72699C7",   # Microsoft basic data
+    0x0B: "EBD0A0A2-B9E5-4433-87C0-68B6B72699C7",
+    0x0C: "EBD0A0A2-B9E5-4433-87C0-68B6B72699C7",
+    0x82: "0657FD6D-A4AB-43C4-84E5-0933C84B4F4F",   # Linux swap
+    0x83: "0FC63DAF-8483-4772-8E79-3D69D8477DE4",   # Linux file system
+    0x8E: "E6D6D379-F507-44C2-A23C-238F2A3DF928",   # Linux LVM
+    0xEF: "C12A7328-F81F-11D2-BA4B-00A0C93EC93B",   # EFI system partition
+    0xFD: "A19D880F-05FC-4D3B-A006-743F0F84911E"    # Linux RAID
+}
+
+
+class Partition:
+    """Entry of a partition table
+
+    Start and size are in sectors. GPT partitions have a type GUID, MBR
+    partitions a type byte.
+    """
+
+    def __init__(self, number, partition_type, start, size, guid="", name="", attributes=0):
+        """Constructor
+
+        @param number Number of the partition, starting at 1
+        @param partition_type Type of the partition, GUID string or MBR type
+        @param start First sector
+        @param size Number of sectors
+        @param guid Unique GUID of a GPT partition
+        @param name Name of a GPT partition
+        @param attributes GPT attributes or MBR status
+        """
+        self.number = number
+        self.type = partition_type
+        self.start = start
+        self.size = size
+        self.guid = guid
+        self.name = name
+        self.attributes = attributes
+
+    def end(self):
+        """Get the sector following the partition
+        """
+        return self.start + self.size
+
+
+class PartitionTable:
+    """Partition table of a disk
+
+    The table is read from the disk by read(), changed in memory by
+    create(), resize() and delete() and written back by write().
+    """
+
+    def __init__(self, fd):
+        """Constructor
+
+        @param fd File descriptor of the disk, opened for reading and writing
+        """
+        self.fd = fd
+        self.block_device = stat.S_ISBLK(os.fstat(fd).st_mode)
+        if self.block_device:
+            self.sector_size = struct.unpack("i", fcntl.ioctl(fd, BLKSSZGET, struct.pack("i", 0)))[0]
+        else:
+            self.sector_size = settings.PARTMGR_SECTOR_SIZE
+        self.sectors = os.lseek(fd, 0, os.SEEK_END) // self.sector_size
+        self.kind = None
+        self.disk_guid = None
+        self.partitions = {}
+        self.mbr = None
+        self.changed = False
+
+
+    def read_sectors(self, lba, count):
+        """Read sectors from the disk
+
+        @param lba First sector
+        @param count Number of sectors
+
+        @return Data read
+        """
+        os.lseek(self.fd, lba * self.sector_size, os.SEEK_SET)
+        data = os.read(self.fd, count * self.sector_size)
+        if len(data) != count * self.sector_size:
+            raise Exception("Disk truncated at sector {}".format(lba))
+        return data
+
+
+    def write_sectors(self, lba, data):
+        """Write sectors to the disk
+
+        @param lba First sector
+        @param data Data to write, a multiple of the sector size
+        """
+        os.lseek(self.fd, lba * self.sector_size, os.SEEK_SET)
+        written = 0
+        while written < len(data):
+            written = written + os.write(self.fd, buffer(data, written))
+
+
+    def read(self):
+        """Read the partition table from the disk
+
+        A disk without a partition table gets an empty table of type
+        settings.PARTMGR_TABLE_TYPE.
+        """
+        if self.sectors < 2 * (GPT_ENTRIES * GPT_ENTRY.size // self.sector_size + 2) + 1:
+            raise Exception("Disk of {} sectors is too small".format(self.sectors))
+        self.mbr = self.read_sectors(0, 1)
+        entries = [ MBR_ENTRY.unpack_from(self.mbr, MBR_ENTRIES_OFFSET + i * MBR_ENTRY.size) for i in range(0, 4) ]
+        if self.mbr[510:512] != MBR_SIGNATURE:
+            self.kind = settings.PARTMGR_TABLE_TYPE
+            self.disk_guid = uuid.uuid4().bytes_le
+            self.mbr = None
+            self.changed = True
+        elif MBR_TYPE_PROTECTIVE in [ entry[2] for entry in entries ]:
+            self.kind = "gpt"
+            self.read_gpt()
+        else:
+            self.kind = "mbr"
+            for (i, (status, first_chs, partition_type, last_chs, start, size)) in enumerate(entries):
+                if partition_type:
+                    self.partitions[i + 1] = Partition(i + 1, partition_type, start, size, attributes=status)
+        logger.debug('PartitionManager.PartitionTable.read(): %s table, %s partitions, %s sectors of %s bytes.',
+                     self.kind, len(self.partitions), self.sectors, self.sector_size)
+
+
+    def read_gpt(self):
+        """Read a GUID partition table
+
+        The backup table at the end of the disk is used if the primary
+        table is corrupt.
+        """
+        for lba in (1, self.sectors - 1):
+            header = self.read_sectors(lba, 1)[:GPT_HEADER.size]
+            (signature, revision, header_size, crc, reserved, current_lba, backup_lba,
+             first_usable, last_usable, disk_guid, entries_lba, count, entry_size,
+             entries_crc) = GPT_HEADER.unpack(header)
+            if signature != GPT_SIGNATURE or header_size != GPT_HEADER.size or \
+               zlib.crc32(header[:16] + "\0\0\0\0" + header[20:]) & 0xffffffff != crc:
+                logger.warning('PartitionManager.PartitionTable.read_gpt(): Invalid GPT header at sector %s.', lba)
+                continue
+            if entry_size != GPT_ENTRY.size or count > GPT_ENTRIES:
+                raise Exception("Unsupported GPT with {} entries of {} bytes".format(count, entry_size))
+            data = self.read_sectors(entries_lba, (count * entry_size + self.sector_size - 1) // self.sector_size)
+            data = data[:count * entry_size]
+            if zlib.crc32(data) & 0xffffffff != entries_crc:
+                logger.warning('PartitionManager.PartitionTable.read_gpt(): Invalid GPT entries at sector %s.', entries_lba)
+                continue
+            self.disk_guid = disk_guid
+            for i in range(0, count):
+                (type_guid, guid, first, last, attributes, name) = GPT_ENTRY.unpack_from(data, i * entry_size)
+                if type_guid != "\0" * 16:
+                    self.partitions[i + 1] = Partition(i + 1, str(uuid.UUID(bytes_le=type_guid)).upper(),
+                                                       first, last - first + 1,
+                                                       str(uuid.UUID(bytes_le=guid)),
+                                                       name.decode("utf-16-le").rstrip(u"\0"), attributes)
+            if lba != 1:
+                # Repair the primary table with the next write.
+                self.changed = True
+            return
+        raise Exception("No valid GPT found")
+
+
+    def usable(self):
+        """Get the range of sectors available for partitions
+
+        @return Tuple (first sector, sector following the last sector)
+        """
+        if self.kind == "gpt":
+            entries = GPT_ENTRIES * GPT_ENTRY.size // self.sector_size
+            return (2 + entries, self.sectors - 1 - entries)
+        return (1, min(self.sectors, 2**32 - 1))
+
+
+    def to_sectors(self, value, what):
+        """Convert a number of bytes to sectors
+
+        @param value Number of bytes, a multiple of the sector size
+        @param what Description of the value for error messages
+
+        @return Number of sectors
+        """
+        if value % self.sector_size:
+            raise Exception("{} {} is not a multiple of the sector size {}".format(what, value, self.sector_size))
+        return value // self.sector_size
+
+
+    def check(self, partition):
+        """Check that a partition fits into the free space of the disk
+
+        @param partition Partition, not yet in the table or with new extents
+        """
+        (first, end) = self.usable()
+        if partition.size <= 0:
+            raise Exception("Partition {} is empty".format(partition.number))
+        if partition.start < first or partition.end() > end:
+            raise Exception("Partition {} at sectors {}-{} is outside of the usable sectors {}-{}".format(
+                partition.number, partition.start, partition.end() - 1, first, end - 1))
+        for other in self.partitions.itervalues():
+            if other.number != partition.number and \
+               partition.start < other.end() and other.start < partition.end():
+                raise Exception("Partition {} overlaps partition {}".format(partition.number, other.number))
+
+
+    def create(self, number, partition_type, start, size, guid="", name=""):
+        """Add a partition to the table
+
+        @param number Number of the partition
+        @param partition_type MBR partition type. It is mapped to the GPT
+                              partition type in a GPT.
+        @param start Offset of the partition in bytes
+        @param size Size of the partition in bytes
+        @param guid Unique GUID of a GPT partition, a new GUID if empty
+        @param name Name of a GPT partition
+        """
+        if number in self.partitions:
+            raise Exception("Partition {} exists".format(number))
+        if self.kind == "gpt":
+            if number < 1 or number > GPT_ENTRIES:
+                raise Exception("Invalid partition number {}".format(number))
+            if partition_type not in GPT_TYPES:
+                raise Exception("No GPT partition type for type {:#x}".format(partition_type))
+            if len(name) > 36:
+                raise Exception("Partition name {} is longer than 36 characters".format(name))
+            partition = Partition(number, GPT_TYPES[partition_type], self.to_sectors(start, "Start"),
+                                  self.to_sectors(size, "Size"), str(uuid.UUID(guid or str(uuid.uuid4()))), name)
+        else:
+            if number < 1 or number > 4:
+                raise Exception("Invalid partition number {}, only primary partitions are supported".format(number))
+            if partition_type < 1 or partition_type > 0xff or partition_type in MBR_TYPES_EXTENDED:
+                raise Exception("Invalid MBR partition type {:#x}".format(partition_type))
+            partition = Partition(number, partition_type, self.to_sectors(start, "Start"), self.to_sectors(size, "Size"))
+        self.check(partition)
+        self.partitions[number] = partition
+        self.changed = True
+
+
+    def resize(self, number, start, size):
+        """Change the size of a partition
+
+        The start of the partition cannot be moved, as that would not retain
+        its content.
+
+        @param number Number of the partition
+        @param start Offset of the partition in bytes
+        @param size New size of the partition in bytes
+        """
+        partition = self.partitions.get(number)
+        if not partition:
+            raise Exception("Partition {} does not exist".format(number))
+        if self.to_sectors(start, "Start") != partition.start:
+            raise Exception("Moving the start of partition {} is not supported".format(number))
+        resized = Partition(number, partition.type, partition.start, self.to_sectors(size, "Size"))
+        self.check(resized)
+        partition.size = resized.size
+        self.changed = True
+
+
+    def delete(self, number):
+        """Remove a partition from the table
+
+        @param number Number of the partition
+        """
+        if number not in self.partitions:
+            raise Exception("Partition {} does not exist".format(number))
+        del self.partitions[number]
+        self.changed = True
+
+
+    def write(self):
+        """Write the table to the disk if it has been changed
+
+        Syncs the disk and makes the kernel read the new table of a block
+        device.
+
+        @return True if the kernel uses the new table, False if it could not
+                read it as partitions of the disk are in use
+        """
+        if not self.changed:
+            return True
+        if self.kind == "gpt":
+            self.write_gpt()
+        else:
+            self.write_mbr()
+        os.fsync(self.fd)
+        self.changed = False
+        if self.block_device:
+            try:
+                fcntl.ioctl(self.fd, BLKRRPART)
+            except IOError as e:
+                logger.warning('PartitionManager.PartitionTable.write(): Kernel did not read the new table: %s.', e)
+                return False
+        return True
+
+
+    def mbr_sector(self, entries):
+        """Build the MBR sector
+
+        The boot code and disk signature of the current MBR are retained.
+
+        @param entries List of four packed MBR entries
+
+        @return MBR sector
+        """
+        mbr = self.mbr or "\0" * self.sector_size
+        return mbr[:MBR_ENTRIES_OFFSET] + "".join(entries) + MBR_SIGNATURE + mbr[512:]
+
+
+    def write_mbr(self):
+        """Write an MBR partition table
+        """
+        entries = []
+        for number in range(1, 5):
+            partition = self.partitions.get(number)
+            if partition:
+                entries.append(MBR_ENTRY.pack(partition.attributes, CHS_LBA, partition.type, CHS_LBA,
+                                              partition.start, partition.size))
+            else:
+                entries.append("\0" * MBR_ENTRY.size)
+        self.write_sectors(0, self.mbr_sector(entries))
+
+
+    def write_gpt(self):
+        """Write a GUID partition table
+
+        The backup table is written before the primary table, so that one
+        valid table remains if writing is interrupted.
+        """
+        data = []
+        for number in range(1, GPT_ENTRIES + 1):
+            partition = self.partitions.get(number)
+            if partition:
+                data.append(GPT_ENTRY.pack(uuid.UUID(partition.type).bytes_le, uuid.UUID(partition.guid).bytes_le,
+                                           partition.start, partition.end() - 1, partition.attributes,
+                                           partition.name.encode("utf-16-le")))
+            else:
+                data.append("\0" * GPT_ENTRY.size)
+        entries = "".join(data)
+        entries_crc = zlib.crc32(entries) & 0xffffffff
+        entries = entries + "\0" * (-len(entries) % self.sector_size)
+        entries_sectors = len(entries) // self.sector_size
+        (first, end) = self.usable()
+        backup_lba = self.sectors - 1
+
+        def header(current_lba, other_lba, entries_lba):
+            fields = [ GPT_SIGNATURE, GPT_REVISION, GPT_HEADER.size, 0, 0, current_lba, other_lba,
+                       first, end - 1, self.disk_guid, entries_lba, GPT_ENTRIES, GPT_ENTRY.size, entries_crc ]
+            fields[3] = zlib.crc32(GPT_HEADER.pack(*fields)) & 0xffffffff
+            data = GPT_HEADER.pack(*fields)
+            return data + "\0" * (self.sector_size - len(data))
+
+        self.write_sectors(backup_lba - entries_sectors, entries)
+        self.write_sectors(backup_lba, header(backup_lba, 1, backup_lba - entries_sectors))
+        self.write_sectors(2, entries)
+        self.write_sectors(1, header(1, backup_lba, 2))
+        if self.mbr is None or self.mbr[510:512] != MBR_SIGNATURE:
+            # Protective MBR covering the whole disk
+            self.write_sectors(0, self.mbr_sector([ MBR_ENTRY.pack(0, "\0\2\0", MBR_TYPE_PROTECTIVE, CHS_LBA, 1,
+                                                                   min(self.sectors - 1, 0xffffffff)) ] +
+                                                  [ "\0" * MBR_ENTRY.size ] * 3))
@@ -0,0 +1,468 @@
+# -*- coding: utf-8 -*-
+""" Partition Writer
+
+This module provides a block writer that streams an image into a disk
+partition.
+
+(c) 2015, 2016 - Jaguar Land Rover.
+Mozilla Public License 2.0
+"""
+
+import os
+import io
+import mmap
+import stat
+import errno
+import fcntl
+import struct
+import time
+import ctypes
+import ctypes.util
+import binascii
+import settings
+import logging
+import sparse_image
+import image_hash
+
+logger = logging.getLogger(settings.LOGGER)
+
+# Advice values of posix_fadvise()
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_DONTNEED = 4
+
+# Modes of fallocate()
+FALLOC_FL_KEEP_SIZE = 1
+FALLOC_FL_PUNCH_HOLE = 2
+
+# Block device ioctls taking a range (uint64 start, uint64 length)
+BLKDISCARD = 0x1277
+BLKZEROOUT = 0x127f
+
+_libc = None
+
+
+def get_libc():
+    """Get the C library
+
+    Python 2 does not provide posix_fadvise() and fallocate(), they are
+    called through ctypes.
+
+    @return ctypes library, None if not available
+    """
+    global _libc
+    if _libc is None:
+        try:
+            _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            _libc.posix_fadvise.argtypes = [ ctypes.c_int, ctypes.c_longlong,
+                                             ctypes.c_longlong, ctypes.c_int ]
+            _libc.fallocate64.argtypes = [ ctypes.c_int, ctypes.c_int,
+                                           ctypes.c_longlong, ctypes.c_longlong ]
+        except (OSError, AttributeError):
+            _libc = False
+    return _libc or None
+
+
+def fadvise(fd, offset, length, advice):
+    """Advise the kernel about the access pattern of a file
+
+    Does nothing if posix_fadvise() is not available.
+
+    @param fd File descriptor
+    @param offset Start of the range
+    @param length Length of the range, 0 for up to the end of the file
+    @param advice One of the POSIX_FADV_* values
+    """
+    libc = get_libc()
+    if libc:
+        libc.posix_fadvise(fd, offset, length, advice)
+
+
+def punch_hole(fd, offset, length, request):
+    """Release a range of a partition
+
+    The blocks of a block device are discarded with an ioctl, those of a
+    regular file standing in for a partition are deallocated. A hole in a
+    regular file reads as zeros.
+
+    @param fd File descriptor
+    @param offset Start of the range
+    @param length Length of the range
+    @param request BLKZEROOUT if the range must read as zeros afterwards,
+                   BLKDISCARD if its content does not matter
+
+    @return True if successful, False if not supported by the device
+    """
+    if stat.S_ISBLK(os.fstat(fd).st_mode):
+        try:
+            fcntl.ioctl(fd, request, struct.pack("QQ", offset, length))
+            return True
+        except IOError:
+            return False
+    libc = get_libc()
+    return bool(libc) and libc.fallocate64(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE,
+                                           offset, length) == 0
+
+
+def get_partition_device(disk, partition_number):
+    """Get the device of a partition
+
+    Partition devices are named like the kernel names them, e.g.
+    /dev/sda1 or /dev/mmcblk0p1. Partition number 0 denotes the
+    whole disk.
+
+    @param disk Device of the disk
+    @param partition_number Number of the partition
+
+    @return Path of the partition device
+    """
+    if partition_number == 0:
+        return disk
+    if disk[-1].isdigit():
+        return "{}p{}".format(disk, partition_number)
+    return "{}{}".format(disk, partition_number)
+
+
+def read_block(f, block, length=None):
+    """Read from a file until the start of a block buffer is full
+
+    @param f Unbuffered file object
+    @param block Buffer to read into
+    @param length Number of bytes to read into the start of the buffer,
+                  the size of the buffer if None
+
+    @return Number of bytes read, less than length only at the end of the
+            file
+    """
+    if length is None:
+        length = len(block)
+    view = block
+    if length < len(block):
+        # An mmap buffer cannot be sliced without copying, the ctypes
+        # view shares its memory and alignment.
+        view = (ctypes.c_char * length).from_buffer(block)
+    count = f.readinto(view) or 0
+    while count and count < length:
+        data = os.read(f.fileno(), length - count)
+        if not data:
+            break
+        block[count:count + len(data)] = data
+        count = count + len(data)
+    return count
+
+
+class PartitionWriter:
+    """Writer streaming an image into a partition
+
+    The image is copied in blocks of settings.PARTMGR_BLOCK_SIZE bytes through
+    page aligned buffers. The partition is opened for direct I/O, bypassing
+    the page cache, if settings.PARTMGR_DIRECT_IO is True and the device
+    supports it. Blocks of the image that are already on the partition are
+    not written if settings.PARTMGR_SKIP_IDENTICAL is True.
+
+    Images in the sparse image format are expanded while they are written.
+    Ranges filled with zeros are zeroed by the device, ranges whose content
+    does not matter are discarded, see punch_hole().
+
+    The image is hashed while it is written, see image_hash.HashPipeline,
+    if its Merkle root is given or settings.PARTMGR_VERIFY_READBACK is True.
+    The partition is then read back and checked against the same leaves.
+    """
+
+    def __init__(self, device, progress=None):
+        """Constructor
+
+        @param device Path of the partition device, or of a file standing in
+                      for it
+        @param progress Callable invoked with (bytes done, bytes total) every
+                        settings.PARTMGR_PROGRESS_INTERVAL seconds and once
+                        writing has completed
+        """
+        self.device = device
+        self.progress = progress
+        self.block_size = settings.PARTMGR_BLOCK_SIZE
+        self.direct = False
+        self.total = 0
+        self.done = 0
+        self.written = 0
+        self.discarded = 0
+        self.elapsed = 0.0
+        # State of a copy in progress
+        self.device_fd = None
+        self.device_file = None
+        self.source = None
+        self.target = None
+        self.direct_active = False
+        self.reported = 0
+        self.hasher = None
+        # (offset, length) of the ranges whose content does not matter
+        self.dont_care = []
+
+
+    def open_device(self):
+        """Open the partition device for reading and writing
+
+        @return File descriptor
+        """
+        if settings.PARTMGR_DIRECT_IO and hasattr(os, "O_DIRECT"):
+            try:
+                fd = os.open(self.device, os.O_RDWR | os.O_DIRECT)
+                self.direct = True
+                return fd
+            except OSError as e:
+                # The file system does not support direct I/O.
+                if e.errno != errno.EINVAL:
+                    raise
+        self.direct = False
+        return os.open(self.device, os.O_RDWR)
+
+
+    def set_direct(self, fd, direct):
+        """Switch direct I/O of the partition device on or off
+
+        @param fd File descriptor of the device
+        @param direct True to switch direct I/O on
+        """
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        if direct:
+            flags = flags | os.O_DIRECT
+        else:
+            flags = flags & ~os.O_DIRECT
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags)
+
+
+    def write(self, image_path, root=None):
+        """Write an image to the partition
+
+        @param image_path Path of the image, raw or in the sparse image format
+        @param root Merkle root of the image as hexadecimal string, None to
+                    not check the image
+
+        @return Nothing. Raises an exception if the image could not be written
+                or does not match its root.
+        """
+        start = time.time()
+        if root or settings.PARTMGR_VERIFY_READBACK:
+            self.hasher = image_hash.HashPipeline()
+        self.dont_care = []
+        image_fd = os.open(image_path, os.O_RDONLY)
+        try:
+            self.device_fd = self.open_device()
+            self.device_file = io.FileIO(self.device_fd, "r+", closefd=False)
+            # Anonymous maps are page aligned as required for direct I/O.
+            self.source = mmap.mmap(-1, self.block_size)
+            self.target = mmap.mmap(-1, self.block_size)
+            self.direct_active = self.direct
+            self.reported = time.time()
+            self.done = 0
+            self.written = 0
+            self.discarded = 0
+            try:
+                if sparse_image.is_sparse(image_fd):
+                    self.copy_sparse(image_fd)
+                else:
+                    self.copy(image_fd)
+                os.fsync(self.device_fd)
+                # Drop what has been read or written through the page cache.
+                fadvise(self.device_fd, 0, 0, POSIX_FADV_DONTNEED)
+                if self.hasher:
+                    self.verify(root)
+            finally:
+                self.hasher = None
+                self.source.close()
+                self.target.close()
+                os.close(self.device_fd)
+        finally:
+            os.close(image_fd)
+        if self.progress:
+            self.progress(self.done, self.total)
+        self.elapsed = time.time() - start
+        logger.info('PartitionManager.PartitionWriter.write(%s): %s bytes in %.1f s (%.1f MB/s), %s bytes written, %s bytes discarded, direct I/O: %s.',
+                    self.device, self.total, self.elapsed, self.total / max(self.elapsed, 0.001) / 1e6,
+                    self.written, self.discarded, self.direct)
+
+
+    def check_size(self):
+        """Check that the image fits into the partition
+        """
+        size = os.lseek(self.device_fd, 0, os.SEEK_END)
+        if self.total > size:
+            raise Exception("Image of {} bytes does not fit into partition of {} bytes".format(self.total, size))
+
+
+    def copy(self, image_fd):
+        """Copy a raw image to the partition block by block
+
+        @param image_fd File descriptor of the image
+        """
+        self.total = os.fstat(image_fd).st_size
+        self.check_size()
+        fadvise(image_fd, 0, 0, POSIX_FADV_SEQUENTIAL)
+        image = io.FileIO(image_fd, "r", closefd=False)
+        while self.done < self.total:
+            count = read_block(image, self.source)
+            if not count:
+                raise Exception("Image truncated at {} of {} bytes".format(self.done, self.total))
+            fadvise(image_fd, self.done, count, POSIX_FADV_DONTNEED)
+            if self.hasher:
+                self.hasher.update(self.source[0:count])
+            self.put(count)
+
+
+    def copy_sparse(self, image_fd):
+        """Expand a sparse image onto the partition
+
+        @param image_fd File descriptor of the image
+        """
+        (block_size, blocks, count, chunk_header_size) = sparse_image.read_header(image_fd)
+        os.lseek(image_fd, 0, os.SEEK_SET)
+        self.total = block_size * blocks
+        self.check_size()
+        fadvise(image_fd, 0, 0, POSIX_FADV_SEQUENTIAL)
+        for (chunk_type, offset, chunk_blocks, value) in sparse_image.chunks(image_fd):
+            self.done = offset * block_size
+            length = chunk_blocks * block_size
+            if chunk_type == sparse_image.CHUNK_RAW:
+                end = self.done + length
+                while self.done < end:
+                    size = min(self.block_size, end - self.done)
+                    data = os.read(image_fd, size)
+                    if len(data) != size:
+                        raise Exception("Image truncated at {} of {} bytes".format(self.done, self.total))
+                    if self.hasher:
+                        self.hasher.update(data)
+                    self.source[0:size] = data
+                    self.put(size)
+                continue
+            if self.hasher:
+                # Ranges whose content does not matter are hashed as zeros.
+                self.hasher.update_fill(value or "\0\0\0\0", length)
+            if chunk_type == sparse_image.CHUNK_FILL and value != "\0\0\0\0":
+                self.source[0:self.block_size] = value * (self.block_size // 4)
+                end = self.done + length
+                while self.done < end:
+                    self.put(min(self.block_size, end - self.done))
+            elif chunk_type == sparse_image.CHUNK_FILL:
+                self.zero(length)
+            else:
+                self.dont_care.append((self.done, length))
+                self.discard(length)
+        self.done = self.total
+
+
+    def verify(self, root):
+        """Check the image and read the partition back
+
+        The leaves hashed while the image was written are checked against
+        the root. If settings.PARTMGR_VERIFY_READBACK is True, the partition
+        is read back and its leaves are hashed again. Ranges whose content
+        does not matter are not read.
+
+        @param root Merkle root of the image as hexadecimal string, None if
+                    not known
+
+        @return Nothing. Raises an exception if a check fails.
+        """
+        leaves = self.hasher.leaves()
+        if root:
+            actual = binascii.hexlify(image_hash.merkle_root(leaves))
+            if actual != root.lower():
+                raise Exception("Image hash mismatch: expected {}, got {}".format(root, actual))
+        if not settings.PARTMGR_VERIFY_READBACK:
+            return
+
+        self.hasher = image_hash.HashPipeline()
+        if self.direct and not self.direct_active:
+            self.set_direct(self.device_fd, True)
+            self.direct_active = True
+        fadvise(self.device_fd, 0, 0, POSIX_FADV_SEQUENTIAL)
+        ranges = self.dont_care + [ (self.total, 0) ]
+        offset = 0
+        for (skip, length) in ranges:
+            while offset < skip:
+                count = min(self.block_size, skip - offset)
+                if self.direct_active and (count % mmap.PAGESIZE or offset % mmap.PAGESIZE):
+                    self.set_direct(self.device_fd, False)
+                    self.direct_active = False
+                os.lseek(self.device_fd, offset, os.SEEK_SET)
+                if read_block(self.device_file, self.target, count) < count:
+                    raise Exception("Partition truncated at {} bytes".format(offset))
+                self.hasher.update(self.target[0:count])
+                offset = offset + count
+                self.report()
+            if length:
+                self.hasher.update_fill("\0\0\0\0", length)
+                offset = offset + length
+        readback = self.hasher.leaves()
+        if readback != leaves:
+            index = ([ a == b for (a, b) in zip(readback, leaves) ] + [ False ]).index(False)
+            raise Exception("Read-back verification failed at offset {}".format(index * self.hasher.leaf_size))
+
+
+    def put(self, count):
+        """Write the start of the source buffer to the partition
+
+        The data is written at offset self.done unless the partition already
+        holds it.
+
+        @param count Number of bytes of the source buffer to write
+        """
+        # Direct I/O requires offset and length to be multiples of the
+        # logical block size, which the last block may not be.
+        if self.direct_active and (count % mmap.PAGESIZE or self.done % mmap.PAGESIZE):
+            self.set_direct(self.device_fd, False)
+            self.direct_active = False
+
+        identical = False
+        if settings.PARTMGR_SKIP_IDENTICAL:
+            os.lseek(self.device_fd, self.done, os.SEEK_SET)
+            existing = read_block(self.device_file, self.target, count)
+            identical = existing >= count and buffer(self.source, 0, count) == buffer(self.target, 0, count)
+        if not identical:
+            os.lseek(self.device_fd, self.done, os.SEEK_SET)
+            written = 0
+            while written < count:
+                written = written + self.device_file.write(buffer(self.source, written, count - written))
+            self.written = self.written + count
+        self.done = self.done + count
+        self.report()
+
+
+    def zero(self, length):
+        """Fill a range of the partition with zeros
+
+        The range starts at offset self.done. It is zeroed by the device if
+        possible, otherwise zeros are written.
+
+        @param length Length of the range
+        """
+        if punch_hole(self.device_fd, self.done, length, BLKZEROOUT):
+            self.discarded = self.discarded + length
+            self.done = self.done + length
+            self.report()
+            return
+        self.source[0:self.block_size] = "\0" * self.block_size
+        end = self.done + length
+        while self.done < end:
+            self.put(min(self.block_size, end - self.done))
+
+
+    def discard(self, length):
+        """Discard a range of the partition whose content does not matter
+
+        The range starts at offset self.done. It is left as it is if the
+        device does not support discarding.
+
+        @param length Length of the range
+        """
+        if punch_hole(self.device_fd, self.done, length, BLKDISCARD):
+            self.discarded = self.discarded + length
+        self.done = self.done + length
+        self.report()
+
+
+    def report(self):
+        """Report the progress every settings.PARTMGR_PROGRESS_INTERVAL seconds
+        """
+        if self.progress and time.time() - self.reported >= settings.PARTMGR_PROGRESS_INTERVAL:
+            self.reported = time.time()
+            self.progress(self.done, self.total)
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+""" Sparse Images
+
+This module reads and creates partition images in the Android sparse image
+format, as created by img2simg. A sparse image only holds the blocks of a
+partition that are in use. Blocks filled with a repeated 32-bit value are
+stored as the value, blocks whose content does not matter are not stored
+at all.
+
+(c) 2015, 2016 - Jaguar Land Rover.
+Mozilla Public License 2.0
+"""
+
+import os
+import sys
+import struct
+import settings
+import logging
+
+logger = logging.getLogger(settings.LOGGER)
+
+MAGIC = 0xED26FF3A
+# magic, major version, minor version, file header size, chunk header size,
+# block size, number of blocks, number of chunks, checksum
+HEADER = struct.Struct("<IHHHHIIII")
+# chunk type, reserved, number of blocks, size including the chunk header
+CHUNK = struct.Struct("<HHII")
+
+# Chunk types
+CHUNK_RAW = 0xCAC1
+CHUNK_FILL = 0xCAC2
+CHUNK_DONT_CARE = 0xCAC3
+CHUNK_CRC32 = 0xCAC4
+
+
+def is_sparse(fd):
+    """Check if a file is a sparse image
+
+    @param fd File descriptor, positioned at the start of the file
+
+    @return True if the file starts with the sparse image magic. The file
+            position is left unchanged.
+    """
+    data = os.read(fd, 4)
+    os.lseek(fd, -len(data), os.SEEK_CUR)
+    return len(data) == 4 and struct.unpack("<I", data)[0] == MAGIC
+
+
+def read_header(fd):
+    """Read the header of a sparse image
+
+    @param fd File descriptor, positioned at the start of the file
+
+    @return Tuple (block size, number of blocks, number of chunks, size of
+            the chunk headers). The file is positioned at the first chunk.
+    """
+    data = os.read(fd, HEADER.size)
+    if len(data) < HEADER.size:
+        raise Exception("Sparse image header truncated")
+    (magic, major, minor, header_size, chunk_header_size,
+     block_size, blocks, chunks, checksum) = HEADER.unpack(data)
+    if magic != MAGIC or major != 1:
+        raise Exception("Unsupported sparse image version {}.{}".format(major, minor))
+    if chunk_header_size < CHUNK.size or block_size == 0 or block_size % 4:
+        raise Exception("Invalid sparse image header")
+    os.lseek(fd, header_size, os.SEEK_SET)
+    return (block_size, blocks, chunks, chunk_header_size)
+
+
+def chunks(fd):
+    """Generator decoding the chunks of a sparse image
+
+    Yields a tuple (chunk type, block offset, number of blocks, argument)
+    for every chunk. The argument is the fill value of CHUNK_FILL chunks,
+    otherwise None. When a CHUNK_RAW chunk is yielded the file is positioned
+    at its data. The data need not be consumed.
+
+    @param fd File descriptor, positioned at the start of the file
+    """
+    (block_size, blocks, count, chunk_header_size) = read_header(fd)
+    offset = 0
+    for i in xrange(0, count):
+        data = os.read(fd, chunk_header_size)
+        if len(data) < chunk_header_size:
+            raise Exception("Sparse image truncated at chunk {}".format(i))
+        (chunk_type, reserved, chunk_blocks, total_size) = CHUNK.unpack(data[:CHUNK.size])
+        data_size = total_size - chunk_header_size
+        start = os.lseek(fd, 0, os.SEEK_CUR)
+        if offset + chunk_blocks > blocks:
+            raise Exception("Chunk {} exceeds the {} blocks of the image".format(i, blocks))
+        if chunk_type == CHUNK_RAW:
+            if data_size != chunk_blocks * block_size:
+                raise Exception("Invalid size of raw chunk {}".format(i))
+            yield (chunk_type, offset, chunk_blocks, None)
+        elif chunk_type == CHUNK_FILL:
+            if data_size != 4:
+                raise Exception("Invalid size of fill chunk {}".format(i))
+            yield (chunk_type, offset, chunk_blocks, os.read(fd, 4))
+        elif chunk_type == CHUNK_DONT_CARE:
+            yield (chunk_type, offset, chunk_blocks, None)
+        elif chunk_type != CHUNK_CRC32:
+            raise Exception("Invalid type {:#x} of chunk {}".format(chunk_type, i))
+        offset = offset + chunk_blocks
+        os.lseek(fd, start + data_size, os.SEEK_SET)
+    if offset != blocks:
+        raise Exception("Chunks cover {} of the {} blocks of the image".format(offset, blocks))
+
+
+def make_sparse(raw_path, sparse_path, block_size=4096):
+    """Create a sparse image from a raw image
+
+    Runs of blocks holding a single repeated 32-bit value, such as the zero
+    blocks of unused space, are stored as fill chunks, all other blocks as
+    raw chunks. The raw image size must be a multiple of the block size.
+
+    @param raw_path Raw partition image
+    @param sparse_path File the sparse image is written to
+    @param block_size Block size of the sparse image
+
+    @return Tuple (number of raw blocks, number of fill blocks)
+    """
+    size = os.path.getsize(raw_path)
+    if size % block_size:
+        raise Exception("Image size {} is not a multiple of the block size {}".format(size, block_size))
+    # current chunk: [type, number of blocks, fill value or list of blocks]
+    chunk = [ None, 0, None ]
+    counts = { CHUNK_RAW: 0, CHUNK_FILL: 0 }
+    written = [ 0 ]
+
+    def flush(out):
+        if chunk[0] == CHUNK_RAW:
+            out.write(CHUNK.pack(CHUNK_RAW, 0, chunk[1], CHUNK.size + chunk[1] * block_size))
+            out.write("".join(chunk[2]))
+        elif chunk[0] == CHUNK_FILL:
+            out.write(CHUNK.pack(CHUNK_FILL, 0, chunk[1], CHUNK.size + 4))
+            out.write(chunk[2])
+        if chunk[0] is not None:
+            counts[chunk[0]] = counts[chunk[0]] + chunk[1]
+            written[0] = written[0] + 1
+        chunk[:] = [ None, 0, None ]
+
+    with open(raw_path, "rb") as raw, open(sparse_path, "wb") as out:
+        out.write(HEADER.pack(MAGIC, 1, 0, HEADER.size, CHUNK.size, block_size, 0, 0, 0))
+        while True:
+            block = raw.read(block_size)
+            if not block:
+                break
+            value = block[:4]
+            if block == value * (block_size // 4):
+                if chunk[0] != CHUNK_FILL or chunk[2] != value:
+                    flush(out)
+                    chunk[:] = [ CHUNK_FILL, 0, value ]
+                chunk[1] = chunk[1] + 1
+            else:
+                if chunk[0] != CHUNK_RAW or chunk[1] * block_size >= settings.PARTMGR_BLOCK_SIZE:
+                    flush(out)
+                    chunk[:] = [ CHUNK_RAW, 0, [] ]
+                chunk[1] = chunk[1] + 1
+                chunk[2].append(block)
+        flush(out)
+        out.seek(0)
+        out.write(HEADER.pack(MAGIC, 1, 0, HEADER.size, CHUNK.size, block_size,
+                              size // block_size, written[0], 0))
+    return (counts[CHUNK_RAW], counts[CHUNK_FILL])
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print "Usage:", sys.argv[0], "raw_image sparse_image"
+        sys.exit(1)
+    (raw, fill) = make_sparse(sys.argv[1], sys.argv[2])
+    print "Sparse image {}: {} raw blocks, {} fill blocks, {} bytes".format(
+        sys.argv[2], raw, fill, os.path.getsize(sys.argv[2]))
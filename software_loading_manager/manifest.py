@@ -15,6 +15,7 @@ import subprocess
 import dbus
 from collections import deque
 import software_operation
+import manifest_reader
 import swm
 import traceback
 import settings
@@ -34,7 +35,7 @@ class Manifest:
     it contains.
     """
 
-    def __init__(self, mount_point, manifest_file, dbstore):
+    def __init__(self, mount_point, manifest_file, dbstore, transactions, completed_cache):
         """Constructor
         
         Initialize a Manifest object and kick off processing.
@@ -42,56 +43,75 @@ class Manifest:
         @param mount_point Mount point of the software update squashfs archive
         @param manifest_file Path to the file containing the manifest
         @param dbstore Database store to log operations
-        
-        @return Manifest object if successful or None otherwise
+        @param transactions Registry of in-flight transactions
+        @param completed_cache Cache of finished software operations
         """
         #
-        # The transaction we are waiting for a reply callback on
+        # The transactions we are waiting for a reply callback on,
+        # indexed by transaction id.
+        #
+        self.active_operations = {}
+
+        #
+        # Ids of the operations of this manifest that have been completed,
+        # either in this run or in a previous one. The value is True if
+        # operations depending on it may proceed, False otherwise.
+        #
+        self.completed_operations = {}
+
         #
-        # FIXME: Multiple parallel transactions not supported,
-        #        although the manifest file format does.
+        # Ids of the completed operations that were aborted without being
+        # carried out. With onFailure "continue" the operations following
+        # them in manifest order proceed, but operations explicitly
+        # depending on them do not.
         #
-        self.active_operation = None
+        self.aborted_operations = set()
+
+        #
+        # Ids of all operations of this manifest in manifest order, the
+        # number of leading operations that have all been completed and
+        # the index of the first completed operation that does not permit
+        # operations depending on it to proceed.
+        #
+        self.operation_ids = []
+        self.completed_count = 0
+        self.first_failure = None
+        # Number of pending operations marked as parallel
+        self.parallel_count = 0
+        self.concurrency = {}
         self.mount_point = mount_point
         self.manifest_file = manifest_file
         self.dbstore = dbstore
         self.software_update = None
 
-        # Transaction ID to use when sending
-        # out a DBUS transaction to another
-        # component. The component, in its callback
-        # to us, will use the same transaction ID, allowing
-        # us to tie a callback reply to an originating transaction.
+        # The registry hands out the transaction IDs to use when
+        # sending out a DBUS transaction to another component.
+        # The component, in its callback to us, will use the same
+        # transaction ID, allowing us to tie a callback reply to an
+        # originating transaction.
         #
         # Please note that this is not the same thing as an operation id
         # which is an element  of the manifest uniquely identifying each
         # software operation.
-        self.next_transaction_id = 0
+        self.transactions = transactions
+        self.completed_cache = completed_cache
 
         # Reset the update result
         self.operation_results = []
+        self.operations = deque()
         
-        # Load manifest file
-        if not self.load_from_file(self.manifest_file):
-            return None
-
-
-    def get_next_transaction_id(self):
-        """Get next transaction number for software operations
-        
-        Each software operation is dispatched to an execution module via
-        dbus. A transaction id is used to identify the operation.
-        
-        @return Next transaction id.
-        """
-        self.next_transaction_id = self.next_transaction_id + 1
-        return self.next_transaction_id
+        # Load manifest file. Whether the manifest was loaded and processed
+        # successfully is kept in self.loaded. The software update and the
+        # operations it starts are stored with a single commit.
+        with database.UnitOfWork(self.dbstore):
+            self.loaded = self.load_from_file(self.manifest_file)
 
 
     def load_from_file(self, manifest_fname):
         """Load manifest file and process it
         
-        Loads a manifest from file and processes it.
+        Loads a manifest from file and processes it. The operations are
+        decoded one at a time while the file is read.
         
         @param manifest_fname Path to the manifest file
         
@@ -102,8 +122,9 @@ class Manifest:
         logger.debug('SoftwareLoadingManager.Manifest.load_from_file(%s): Called.', manifest_fname)
         try:
             with open(manifest_fname, "r") as f:
-                logger.debug('SoftwareLoadingManager.Manifest.load_from_file(%s): File opened, loading strings.', manifest_fname)
-                return self.load_from_string(f.read())
+                logger.debug('SoftwareLoadingManager.Manifest.load_from_file(%s): File opened, reading manifest.', manifest_fname)
+                reader = manifest_reader.ManifestReader(f)
+                return self.load_manifest(reader.members())
         except IOError as e:
            logger.error('SoftwareLoadingManager.Manifest.load_from_file(%s): Could not open manifest: %s.', manifest_fname, e)
            return False
@@ -113,168 +134,626 @@ class Manifest:
     def load_from_string(self, manifest_string):
         """Load manifest from string and process it
         
-        Loads a manifest from a string and processes it.
-        
         @param manifest_string String containing the manifest
         
         @return True if processing the manifest string was successful,
                 False otherwise
         """
 
-        logger.debug('SoftwareLoadingManager.Manifest.load_from_string(%s): Called.', manifest_string)
+        logger.debug('SoftwareLoadingManager.Manifest.load_from_string(): Called.')
         try:
             manifest = json.loads(manifest_string)
         except ValueError as e:
-            logger.error('SoftwareLoadingManager.Manifest.load_from_string(%s): Failed to parse JSON string: %s.', manifest_string, e)
+            logger.error('SoftwareLoadingManager.Manifest.load_from_string(): Failed to parse JSON string: %s.', e)
             return False
 
-        # Retrieve top-level elements
-        self.update_id = manifest.get('updateId', False)
-        self.name = manifest.get('name', False)
-        self.description = manifest.get('description', False)
-        self.show_hmi_progress = manifest.get('showHmiProgress', False)
-        self.show_hmi_result = manifest.get('showHmiResult', False)
-        self.get_user_confirmation = manifest.get('getUserConfirmation', False)
+        members = [ (name, value) for (name, value) in manifest.iteritems() if name != 'operations' ]
+        members.append(('operations', manifest.get('operations', [])))
+        return self.load_manifest(members)
+
+
+    def load_manifest(self, members):
+        """Process the members of a manifest
+        
+        Operations that have already been processed are not loaded. If
+        settings.MANIFEST_LAZY is False, all other operations are validated
+        and started in the database right away and the manifest is rejected
+        if any of them is not valid. Otherwise, this happens when they are
+        dispatched.
+        
+        @param members Iterable of (name, value) tuples of the top-level
+                       elements of the manifest. The value of operations may
+                       be an iterator, which is consumed before the next
+                       element is requested.
+        
+        @return True if processing the manifest was successful,
+                False otherwise
+        """
+        self.update_id = False
+        self.name = False
+        self.description = False
+        self.show_hmi_progress = False
+        self.show_hmi_result = False
+        self.get_user_confirmation = False
+        self.concurrency = {}
         self.operations = deque()
+        self.parallel_count = 0
+
+        # Operations listed before the updateId and name are kept until
+        # both are known, since they identify the software update.
+        pending = []
+
+        # Ids of all operations preceding the current one
+        known_ids = set()
+
+        # Retrieve top-level elements. Traverse all operations and
+        # create / load up a relevant object for each one. The members
+        # are decoded while they are traversed, so syntax errors are
+        # raised here as well.
+        try:
+            for (name, value) in members:
+                if name == 'updateId':
+                    self.update_id = value
+                elif name == 'name':
+                    self.name = value
+                elif name == 'description':
+                    self.description = value
+                elif name == 'showHmiProgress':
+                    self.show_hmi_progress = value
+                elif name == 'showHmiResult':
+                    self.show_hmi_result = value
+                elif name == 'getUserConfirmation':
+                    self.get_user_confirmation = value
+                elif name == 'concurrency':
+                    self.concurrency = value
+                elif name == 'operations':
+                    for op in value:
+                        if False in [ self.update_id, self.name ]:
+                            pending.append(op)
+                        elif not self.add_operation(op, known_ids):
+                            return False
+
+            for op in pending:
+                if not self.add_operation(op, known_ids):
+                    return False
+        except Exception as e:
+            logger.error('SoftwareLoadingManager.Manifest.load_manifest(%s): Manifest exception: %s.', self.update_id, e)
+            return False
+
         logger.debug('SoftwareLoadingManager.Manifest.updateId:            %s', self.update_id)
         logger.debug('SoftwareLoadingManager.Manifest.name:                %s', self.name)
         logger.debug('SoftwareLoadingManager.Manifest.description:         %s', self.description)
         logger.debug('SoftwareLoadingManager.Manifest.getUserConfirmation: %s', self.get_user_confirmation)
         logger.debug('SoftwareLoadingManager.Manifest.showHmiProgress:     %s', self.show_hmi_progress)
         logger.debug('SoftwareLoadingManager.Manifest.showHmiResult:       %s', self.show_hmi_result)
+        logger.debug('SoftwareLoadingManager.Manifest.concurrency:         %s', self.concurrency)
+        logger.debug('SoftwareLoadingManager.Manifest.operations:          %s', len(self.operation_ids))
 
-        # Query database
-        self.software_update = database.SWUpdate.getSWUpdate(self.dbstore, self.update_id, self.name)
-        self.software_update.start()
-
-        # Traverse all operations and create / load up a relevant 
-        # object for each one.
-        try:
-            for op in manifest.get('operations', []):
+        # Check that we have all mandatory fields set
+        if False in [ self.update_id, self.name, self.description ]:
+            logger.error('SoftwareLoadingManager.Manifest.load_manifest(%s): One of mandatory updateId, name, description. or operations not set.', self.update_id)
+            return False
 
-                # Grab opearation id. 
-                op_id = op.get('id', False)
-                op_operation = op.get('operation', False)
+        if not settings.MANIFEST_LAZY:
+            self.batch_operations()
+        return True
 
-                # Skip entire operation if operation_id is not defined.
-                if not op_id:
-                    logger.warning('SoftwareLoadingManager.Manifest.load_from_string(%s): Manifest operation is missing operationId. Skipped.', manifest_string)
-                    continue
-                    
-                # Get operation from database or create a new one if id does not exist
-                swo = self.software_update.getSWOperation(op_id)
-                if not swo:
-                    swo = self.software_update.addSWOperation(op_id, op_operation)
-
-                # Check if this operation has already been executed
-                if swo.isfinished():
-                    # Add the result code for the given operation id
-                    self.operation_results.append(
-                        swm.result(op_id,
-                                   swm.SWMResult.SWM_RES_ALREADY_PROCESSED,
-                                   "Operation already processed")
-                        )
-                    logger.info('SoftwareLoadingManager.Manifest.load_from_string(%s): Manifest operation %s already completed. Deleted from manifest.', manifest_string, op_id)
-                    # Continue with the next operation
-                    continue
 
-                # Start the operation
-                swo.start()
-
-                # Instantiate an object and feed it the manifest file 
-                # operation object so that the new object can initialize
-                # itself correctly.
-                try:
-                    op['mountPoint'] = self.mount_point
-                    op_obj = software_operation.SoftwareOperation(op)
-                except Exception as e:
-                    logger.error('SoftwareLoadingManager.Manifest.load_from_string(%s): Could not process manifest operation: %s.\nSkipped', manifest_string, e)
+    def add_operation(self, op, known_ids):
+        """Add an operation of the manifest to the queue of pending operations
+        
+        @param op Manifest element of the operation
+        @param known_ids Set of the ids of the operations added so far
+        
+        @return True if the operation was added or skipped,
+                False if the manifest is not valid
+        """
+        try:
+            # Grab opearation id. 
+            op_id = op.get('id', False)
+
+            # Skip entire operation if operation_id is not defined.
+            if not op_id:
+                logger.warning('SoftwareLoadingManager.Manifest.add_operation(%s): Manifest operation is missing operationId. Skipped.', self.update_id)
+                return True
+
+            # Dependencies must refer to operations listed earlier in
+            # the manifest. This also rules out dependency cycles.
+            for dep_id in op.get('dependsOn', []):
+                if dep_id not in known_ids:
+                    logger.error('SoftwareLoadingManager.Manifest.add_operation(%s): Operation %s depends on unknown or later operation %s.', self.update_id, op_id, dep_id)
                     return False
-
-                # Add new object to operations we need to process
-                self.operations.append(op_obj)
         except Exception as e:
-            logger.error('SoftwareLoadingManager.Manifest.load_from_string(%s): Manifest exception: %s.', manifest_string, e)
+            logger.error('SoftwareLoadingManager.Manifest.add_operation(%s): Manifest exception: %s.', self.update_id, e)
             return False
 
-        # Check that we have all mandatory fields set
-        if False in [ self.update_id, self.name, self.description ]:
-            logger.error('SoftwareLoadingManager.Manifest.load_from_string(%s): One of mandatory updateId, name, description. or operations not set.', manifest_string)
+        # Unless the operation is explicitly marked as parallel it
+        # waits for all operations before its index.
+        op['index'] = len(self.operation_ids)
+        self.operation_ids.append(op_id)
+        known_ids.add(op_id)
+
+        # Check if this operation has already been executed. Operations
+        # finished in a previous run are found in the cache, so the
+        # software update is only loaded from the database if there
+        # is anything left to do.
+        if self.completed_cache.contains(self.update_id, op_id):
+            # Add the result code for the given operation id
+            self.operation_results.append(
+                swm.result(op_id,
+                           swm.SWMResult.SWM_RES_ALREADY_PROCESSED,
+                           "Operation already processed")
+                )
+            logger.info('SoftwareLoadingManager.Manifest.add_operation(%s): Manifest operation %s already completed. Deleted from manifest.', self.update_id, op_id)
+            self.completed_operations[op_id] = True
+            return True
+
+        # Instantiate an object and feed it the manifest file 
+        # operation object so that the new object can initialize
+        # itself correctly.
+        try:
+            op['mountPoint'] = self.mount_point
+            op_obj = software_operation.SoftwareOperation(op)
+            if not settings.MANIFEST_LAZY:
+                self.prepare_operation(op_obj)
+        except Exception as e:
+            logger.error('SoftwareLoadingManager.Manifest.add_operation(%s): Could not process manifest operation %s: %s.', self.update_id, op_id, e)
             return False
 
+        # Add new object to operations we need to process
+        self.operations.append(op_obj)
+        if op_obj.parallel:
+            self.parallel_count = self.parallel_count + 1
         return True
 
 
-    def start_next_operation(self):
-        """Process the next software operation
+    def get_software_update(self):
+        """Get the software update of this manifest from the database
+
+        The software update is loaded, or created, and started the first
+        time it is needed.
+
+        @return Software update instance
+        """
+        if not self.software_update:
+            self.software_update = database.SWUpdate.getSWUpdate(self.dbstore, self.update_id, self.name)
+            self.software_update.start()
+        return self.software_update
+
+
+    def get_sw_operation(self, op):
+        """Get a software operation from the database
+
+        @param op Software operation of this manifest
+
+        @return Database instance of the software operation, created if it
+                does not exist yet
+        """
+        software_update = self.get_software_update()
+        swo = software_update.getSWOperation(op.operation_id)
+        if not swo:
+            swo = software_update.addSWOperation(op.operation_id, op.operation)
+        return swo
+
+
+    def prepare_operation(self, op):
+        """Validate a software operation and start it in the database
+
+        @param op Software operation of this manifest
+
+        @return Nothing. Raises an exception if the operation is not valid.
+        """
+        op.prepare()
+        for member in op.get_operations():
+            self.get_sw_operation(member).start()
+
+
+    def batch_operations(self):
+        """Combine consecutive operations into batch operations
         
-        Take the next operation off the queue and process it.
+        Consecutive operations that can be carried out by a single
+        transaction, such as installPackage operations, are replaced
+        by a batch operation of at most settings.OPERATION_BATCH_MAX
+        operations.
+        """
+        operations = deque()
+        batch = []
+        for op in list(self.operations) + [None]:
+            if op and batch and len(batch) < settings.OPERATION_BATCH_MAX and \
+               software_operation.SoftwareOperationBatch.can_batch(batch[0], op):
+                batch.append(op)
+                continue
+            if len(batch) > 1:
+                operations.append(software_operation.SoftwareOperationBatch(batch))
+            elif batch:
+                operations.append(batch[0])
+            batch = [ op ]
+        self.operations = operations
+
+
+    def take_batch(self, op):
+        """Combine an operation with the pending operations following it
+
+        Used in lazy mode when an operation is dispatched. Operations directly
+        following op in the queue are prepared and removed from the queue as long
+        as they can be batched with op.
+
+        @param op Prepared software operation that has been removed from the queue
         
-        @return True if processing the operation was successful
-                False otherwise
+        @return Batch operation or op if no operations could be batched with it
         """
-        if len(self.operations) == 0:
-            return False
+        batch = [ op ]
+        batch_ids = set([ op.operation_id ])
+        while self.operations and len(batch) < settings.OPERATION_BATCH_MAX:
+            next_op = self.operations[0]
+            if next_op.parallel or not software_operation.SoftwareOperationBatch.same_batch(op, next_op):
+                break
+            # The operation waits for all operations before it. Those
+            # not in the batch, e.g. parallel operations still in flight,
+            # must have completed and permit it to proceed.
+            if not all([ op_id in batch_ids or self.completed_operations.get(op_id)
+                         for op_id in self.operation_ids[op.index + 1:next_op.index] ]):
+                break
+            try:
+                next_op.prepare()
+            except Exception as e:
+                # Reported when the operation itself is dispatched
+                break
+            if not software_operation.SoftwareOperationBatch.can_batch(op, next_op):
+                break
+            batch_ids.add(next_op.operation_id)
+            batch.append(self.operations.popleft())
+        if len(batch) == 1:
+            return op
+        return software_operation.SoftwareOperationBatch(batch)
+
+
+    def get_concurrency_limit(self, path):
+        """Get the concurrency limit of a dbus service
+        
+        Returns the maximum number of operations that may be in flight on
+        the dbus service at the same time. The manifest's concurrency element
+        takes precedence over settings.OPERATION_CONCURRENCY.
+        
+        @param path Dbus service (org.genivi.xxx) of the operation
+        
+        @return Maximum number of concurrent operations
+        """
+        if path in self.concurrency:
+            return self.concurrency[path]
+        return settings.OPERATION_CONCURRENCY.get(path, settings.OPERATION_CONCURRENCY_DEFAULT)
+
+
+    def get_dependency_state(self, op):
+        """Check if the dependencies of an operation are satisfied
         
-        # Retrieve next operation to process.
-        op = self.operations.popleft()
- 
-        transaction_id = self.get_next_transaction_id()
+        @param op Software operation to check
+        
+        @return True if all dependencies completed and permit the operation to proceed
+                False if a dependency failed and does not permit it to proceed
+                None if a dependency has not yet completed
+        """
+        if not op.parallel:
+            # The operation waits for all operations preceding it.
+            while self.completed_count < len(self.operation_ids) and \
+                  self.operation_ids[self.completed_count] in self.completed_operations:
+                if self.first_failure is None and \
+                   not self.completed_operations[self.operation_ids[self.completed_count]]:
+                    self.first_failure = self.completed_count
+                self.completed_count = self.completed_count + 1
+            if self.completed_count < op.index:
+                return None
+            return self.first_failure is None or self.first_failure >= op.index
+
+        for dep_id in op.depends_on:
+            if dep_id not in self.completed_operations:
+                return None
+        for dep_id in op.depends_on:
+            if not self.completed_operations[dep_id] or dep_id in self.aborted_operations:
+                return False
+        return True
+
+
+    def remove_operation(self, op):
+        """Remove an operation from the queue of pending operations
+
+        @param op Pending software operation
+        """
+        self.operations.remove(op)
+        if op.parallel:
+            self.parallel_count = self.parallel_count - 1
 
+
+    def start_next_operations(self):
+        """Start all software operations that are ready to be processed
+        
+        Walks the queue of pending operations in manifest order and dispatches
+        every operation whose dependencies have completed and whose dbus service
+        has not yet reached its concurrency limit. Operations depending on a
+        failed operation are aborted without being dispatched.
+        
+        @return List of operations that were dispatched
+        """
+        started = []
+        load = {}
+        for op in self.active_operations.itervalues():
+            load[op.path] = load.get(op.path, 0) + 1
+
+        # Aborting an operation may in turn resolve the dependencies of
+        # later operations, hence repeat until nothing changes.
+        progress = True
+        while progress:
+            progress = False
+            for op in list(self.operations):
+                state = self.get_dependency_state(op)
+                if state is None:
+                    if not op.parallel and self.parallel_count == 0:
+                        # All later operations wait for this one as well.
+                        break
+                    continue
+
+                if state is False:
+                    self.remove_operation(op)
+                    self.abort_operation(op,
+                                         swm.SWMResult.SWM_RES_DEPENDENCY_FAILURE,
+                                         "Dependency failure")
+                    progress = True
+                    continue
+
+                if load.get(op.path, 0) >= self.get_concurrency_limit(op.path):
+                    continue
+
+                self.remove_operation(op)
+                if settings.MANIFEST_LAZY:
+                    # Validate and start the operation, combined with the
+                    # operations following it into a batch, if possible.
+                    try:
+                        with database.UnitOfWork(self.dbstore):
+                            op.prepare()
+                            op = self.take_batch(op)
+                            self.prepare_operation(op)
+                    except Exception as e:
+                        logger.error('SoftwareLoadingManager.Manifest.start_next_operations(): Invalid operation %s: %s.',
+                                     op.operation_id, e)
+                        self.abort_operation(op,
+                                             swm.SWMResult.SWM_RES_VALIDATION_FAILED,
+                                             "Invalid operation")
+                        progress = True
+                        continue
+
+                if not self.dispatch_operation(op):
+                    progress = True
+                    continue
+
+                load[op.path] = load.get(op.path, 0) + 1
+                started.append(op)
+
+        return started
+
+
+    def dispatch_operation(self, op):
+        """Dispatch a software operation
+        
+        Registers a new transaction for the operation and sends it to
+        the component carrying it out.
+        
+        @param op Software operation
+        
+        @return True if the operation was dispatched, False otherwise
+        """
+        transaction_id = self.transactions.register(op, self)
+
+        # Store this as an active transaction for which we 
+        # are waiting on a callback reply.
+        self.active_operations[transaction_id] = op
+        return self.send_operation(op, transaction_id)
+
+
+    def send_operation(self, op, transaction_id):
+        """Send an active software operation to the component carrying it out
+        
+        @param op Software operation
+        @param transaction_id Id of the transaction of the operation
+        
+        @return True if the operation was sent, False if it failed
+        """
         #
         # Invoke the software operation object, created by
-        # the Manifest object
+        # the Manifest object. If the component cannot be reached
+        # the transaction fails right away rather than at its deadline.
         #
-        if op.send_transaction(transaction_id):
-            # Store this as an active transaction for which we 
-            # are waiting on a callback reply.
-            self.active_operation = op
-            return True
+        if not op.send_transaction(transaction_id, self.transactions.fail):
+            del self.active_operations[transaction_id]
+            self.transactions.complete(transaction_id)
+            self.finish_operation(op,
+                                  swm.SWMResult.SWM_RES_INTERNAL_ERROR,
+                                  "Failed to dispatch operation")
+            return False
+
+        return True
+
+
+    def retry_operation(self, transaction):
+        """Dispatch a timed out software operation again
+        
+        The first attempt may still be in progress at the component, hence
+        only operations in settings.TRANSACTION_RETRY_OPERATIONS, which can
+        safely be carried out twice, are dispatched again. The operation is
+        sent under the same transaction id, so that the result of either
+        attempt completes it.
+        
+        @param transaction Expired transaction
+        
+        @return True if the operation was dispatched, False otherwise
+        """
+        op = self.active_operations.get(transaction.transaction_id)
+        if not op or op.operation not in settings.TRANSACTION_RETRY_OPERATIONS:
+            return False
+        logger.info('SoftwareLoadingManager.Manifest.retry_operation(%s): Retrying operation %s.',
+                    transaction.transaction_id, op.operation_id)
+        self.transactions.retry(transaction)
+        return self.send_operation(op, transaction.transaction_id)
+
+
+    def expire_operation(self, transaction):
+        """Give up on a timed out software operation
+        
+        @param transaction Expired transaction
+        
+        @return True if the operation was aborted, False if it was not in flight
+        """
+        op = self.active_operations.pop(transaction.transaction_id, None)
+        if not op:
+            return False
+        self.abort_operation(op,
+                             swm.SWMResult.SWM_RES_GENERAL_ERROR,
+                             "Operation timed out")
+        return True
+
+
+    def is_finished(self):
+        """Check if all operations of this manifest have been processed
+        
+        @return True if no operations are pending or in flight, False otherwise
+        """
+        return len(self.operations) == 0 and len(self.active_operations) == 0
+
+
+    def finish_operation(self, op, result_code, result_text):
+        """Record the result of a processed software operation
+        
+        Stores the result in the database so that the operation is not run
+        again on restart and adds it to the results reported to SOTA.
+        All operations of a batch operation get the same result.
+        
+        @param op Software operation
+        @param result_code Code indicating the result of the operation
+        @param result_text Text with result details
+        """
+        self.finish_operations(op, [ (result_code, result_text) ] * len(op.get_operations()))
+
+
+    def finish_operations(self, op, results):
+        """Record the results of a processed software operation
+        
+        If the results cannot be stored the operation is aborted instead,
+        so that it is carried out again when the manifest is processed the
+        next time.
+        
+        @param op Software operation
+        @param results List with a tuple (result_code, result_text) for each
+                       operation returned by op.get_operations()
+        
+        @return True if the results were stored, False if the operation was aborted
+        """
+        members = op.get_operations()
 
-        return False
+        # Completed operations must not be carried out again after a
+        # power loss, so their results are committed durably.
+        try:
+            with database.UnitOfWork(self.dbstore, durable=True):
+                for (member, (result_code, result_text)) in zip(members, results):
+                    swo = self.get_sw_operation(member)
+                    swo.finish(result_code,result_text)
+                # Operations still pending may not have been stored yet, hence
+                # the software update is only finished with the last operation.
+                if self.is_finished():
+                    self.software_update.finish()
+                self.software_update.update()
+        except Exception as e:
+            logger.error('SoftwareLoadingManager.Manifest.finish_operations(%s): Could not store results: %s.',
+                         op.operation_id, e)
+            self.abort_operation(op,
+                                 swm.SWMResult.SWM_RES_INTERNAL_ERROR,
+                                 "Failed to store operation result")
+            return False
+
+        # Only operations whose results have been stored are completed
+        # and skipped as already processed.
+        for (member, (result_code, result_text)) in zip(members, results):
+            self.completed_operations[member.operation_id] = \
+                result_code == swm.SWMResult.SWM_RES_OK or member.on_failure != "abort"
+
+            #
+            # Add the result code from a software operation to self
+            # All operation results will be reported to SOTA.
+            #
+            self.operation_results.append(
+                swm.result(member.operation_id, result_code, result_text)
+            )
+            self.completed_cache.add(self.update_id, member.operation_id)
+        return True
+
+
+    def abort_operation(self, op, result_code, result_text):
+        """Abort a software operation without processing it
+        
+        The operation is marked as aborted in the database so that it will
+        be attempted again when the manifest is processed the next time.
+        The operations following it in manifest order proceed if its
+        onFailure is "continue", operations explicitly depending on it
+        are aborted as well. The operation is aborted even if the database
+        cannot be updated.
+        
+        @param op Software operation
+        @param result_code Code indicating the reason for aborting
+        @param result_text Text with result details
+        """
+        members = op.get_operations()
+        try:
+            with database.UnitOfWork(self.dbstore):
+                for member in members:
+                    swo = self.get_sw_operation(member)
+                    swo.abort(result_code, result_text)
+                self.software_update.update()
+        except Exception as e:
+            logger.error('SoftwareLoadingManager.Manifest.abort_operation(%s): Could not store abort: %s.',
+                         op.operation_id, e)
 
+        for member in members:
+            logger.warning('SoftwareLoadingManager.Manifest.abort_operation(%s): %s.', member.operation_id, result_text)
+            self.completed_operations[member.operation_id] = member.on_failure != "abort"
+            self.aborted_operations.add(member.operation_id)
+            self.operation_results.append(
+                swm.result(member.operation_id, result_code, result_text)
+            )
 
-    #
-    # Check if this operation has already been executed.
-    #
-    def complete_operation(self, transaction_id, result_code, result_text):
-        """Complete currently pending operation
+
+    def complete_operation(self, transaction_id, result_code, result_text, results=None):
+        """Complete a pending operation
         
-        Callback in response to an operation started with start_next_operation.
+        Callback in response to an operation started with start_next_operations.
+        The transaction must already have been removed from the registry.
         
         @param transaction_id Id of the transaction
         @param result_code Code indicating the result of the operation
         @param result_text Text with result details
+        @param results Optional list of results encoded with swm.result(), one per
+                       item of a batch operation. Overrides result_code and result_text.
         
         @return True Sucessfully completed operation
-                False No active operation
+                False No active operation with the given transaction id
         """
-        # Check that we have an active operation to
-        # work with.
-        if not self.active_operation:
-            logger.warning('SoftwareLoadingManager.Manifest.complete_operation: No active operation.')
+        op = self.active_operations.pop(transaction_id, None)
+        if not op:
+            logger.warning('SoftwareLoadingManager.Manifest.complete_operation(%s): No active operation.', transaction_id)
             return False
 
         # We have completed this specific transaction
         # Store it so that we don't run it again on restart
-        swo = self.software_update.getSWOperation(self.active_operation.operation_id)
-        swo.finish(result_code,result_text)
-        self.software_update.finish()
-        self.software_update.update()
+        if results is None:
+            self.finish_operation(op, result_code, result_text)
+            return True
 
-        #
-        # Add the result code from a software operation to self
-        # All operation results will be reported to SOTA.
-        #
-        self.operation_results.append(
-            swm.result(
-                self.active_operation.operation_id,
-                result_code,
-                result_text)
-        )
-
-        self.active_operation = None
+        results = [ (r['result_code'], r['result_text']) for r in results ]
+        members = op.get_operations()
+        if len(members) == 1 and results:
+            # A single manifest operation with several items, e.g. an explicit
+            # installPackages operation. Report the first failure, if any.
+            failed = [ r for r in results if r[0] != swm.SWMResult.SWM_RES_OK ]
+            results = [ (failed or results)[0] ]
+        elif len(results) < len(members):
+            results = results + [ (swm.SWMResult.SWM_RES_INTERNAL_ERROR, "No result reported") ] * \
+                      (len(members) - len(results))
+        self.finish_operations(op, results)
         return True
-        
-
-
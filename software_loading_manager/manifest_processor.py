@@ -12,16 +12,180 @@ Mozilla Public License 2.0
 import json
 import os
 import subprocess
+import shutil
+import threading
 import dbus
 from collections import deque
 import manifest
+import manifest_reader
+import swm
+import worker
 import settings
 import logging
 import traceback
 
 logger = logging.getLogger(settings.LOGGER)
 
-    
+
+class UpdateImage:
+    """Update image
+
+    This class holds a squashfs update image and the state of its
+    preparation. An image is prepared by extracting and validating its
+    manifest and by mounting it. Preparation does not access the database
+    or dbus, so it may run on a worker thread.
+    """
+
+    def __init__(self, image_path, mount_point):
+        """Constructor
+
+        @param image_path Path to the image
+        @param mount_point Mount point of the image
+        """
+        self.image_path = image_path
+        self.mount_point = mount_point
+        self.manifest_file = None
+        self.mounted = False
+        # None if not prepared yet, True if the image has been prepared
+        # successfully, False otherwise
+        self.valid = None
+        self.preparing = False
+        self.prepared = threading.Event()
+        # Space reserved below the mount point while preparing
+        self.reserved = 0
+
+
+    def get_required_space(self):
+        """Get the space the prepared image takes below the mount point
+
+        @return Estimated size in bytes
+        """
+        if not settings.SQUASHFS_EXTRACT:
+            return 0
+        try:
+            return os.path.getsize(self.image_path) * settings.SQUASHFS_EXTRACT_FACTOR
+        except OSError:
+            return 0
+
+
+    def mount(self):
+        """Mount the image
+
+        @return True if successful, False otherwise
+        """
+        logger.debug('SoftwareLoadingManager.UpdateImage.mount(%s): Creating mount point: %s.', self.image_path, self.mount_point)
+        if not os.path.isdir(self.mount_point):
+            try:
+                os.makedirs(self.mount_point)
+            except OSError as e:
+                logger.error('SoftwareLoadingManager.UpdateImage.mount(%s): Failed creating mount point %s: %s.',
+                             self.image_path, self.mount_point, e)
+        try:
+            command = settings.SQUASHFS_MOUNT_CMD.format(
+                    mount_point=self.mount_point,
+                    image_path=self.image_path).split()
+            subprocess.check_call(command)
+        except (subprocess.CalledProcessError, OSError) as e:
+            logger.error('SoftwareLoadingManager.UpdateImage.mount(%s): Failed mounting on %s: %s.',
+                         self.image_path, self.mount_point, e)
+            return False
+        self.mounted = True
+        return True
+
+
+    def unmount(self):
+        """Unmount the image
+
+        Unmount the image, if mounted, and remove the mount point and
+        an extracted manifest.
+        """
+        if self.mounted:
+            try:
+                command = list(settings.SQUASHFS_UNMOUNT_CMD)
+                command.append(self.mount_point)
+                subprocess.check_call(command)
+            except (subprocess.CalledProcessError, OSError) as e:
+                logger.error('SoftwareLoadingManager.UpdateImage.unmount(%s): Failed to unmount %s: %s.',
+                             self.image_path, self.mount_point, e)
+            self.mounted = False
+        # The unmount command of a full extraction removes the mount point
+        # together with the files.
+        if os.path.isdir(self.mount_point):
+            try:
+                os.rmdir(self.mount_point)
+            except OSError as e:
+                logger.warning('SoftwareLoadingManager.UpdateImage.unmount(%s): Failed to remove %s: %s.',
+                               self.image_path, self.mount_point, e)
+        self.remove_manifest()
+
+
+    def extract_manifest(self):
+        """Extract only the manifest of the image
+
+        @return Path to the extracted manifest file, None if the manifest
+                could not be extracted
+        """
+        dest_dir = self.mount_point + '.manifest'
+        command = settings.SQUASHFS_MANIFEST_CMD.format(
+                dest_dir=dest_dir,
+                image_path=self.image_path).split()
+        logger.debug('SoftwareLoadingManager.UpdateImage.extract_manifest(%s): Command: %s.', self.image_path, command)
+        try:
+            with open(os.devnull, "w") as devnull:
+                subprocess.check_call(command, stdout=devnull)
+        except (subprocess.CalledProcessError, OSError) as e:
+            logger.error('SoftwareLoadingManager.UpdateImage.extract_manifest(%s): Failed extracting manifest: %s.',
+                         self.image_path, e)
+            shutil.rmtree(dest_dir, True)
+            return None
+        return "{}/update_manifest.json".format(dest_dir)
+
+
+    def remove_manifest(self):
+        """Remove the extracted manifest, if any
+        """
+        if settings.SQUASHFS_MANIFEST_CMD and self.manifest_file:
+            shutil.rmtree(os.path.dirname(self.manifest_file), True)
+            self.manifest_file = None
+
+
+    def prepare(self, mount=True):
+        """Prepare the image
+
+        Extract and validate the manifest, if settings.SQUASHFS_MANIFEST_CMD
+        is set, and mount the image. A manifest that is not valid JSON is
+        rejected without mounting the image.
+
+        @param mount False to only extract the manifest, if possible
+        @return True if successful, False otherwise
+        """
+        try:
+            if settings.SQUASHFS_MANIFEST_CMD:
+                self.manifest_file = self.extract_manifest()
+                if self.manifest_file:
+                    try:
+                        # Decoded element by element, the operations
+                        # are not kept in memory.
+                        with open(self.manifest_file, "r") as f:
+                            for (name, value) in manifest_reader.ManifestReader(f).members():
+                                pass
+                    except (IOError, ValueError) as e:
+                        logger.error('SoftwareLoadingManager.UpdateImage.prepare(%s): Invalid manifest: %s.',
+                                     self.image_path, e)
+                        self.remove_manifest()
+                if self.manifest_file and mount and not self.mount():
+                    self.remove_manifest()
+            elif self.mount():
+                self.manifest_file = "{}/update_manifest.json".format(self.mount_point)
+            self.valid = self.manifest_file is not None
+        except Exception as e:
+            logger.error('SoftwareLoadingManager.UpdateImage.prepare(%s): Exception: %s.', self.image_path, e)
+            self.valid = False
+        finally:
+            self.prepared.set()
+        return self.valid
+
+
 #
 # Simplistic storage of successfully completed
 # operations
@@ -29,29 +193,45 @@ logger = logging.getLogger(settings.LOGGER)
 class ManifestProcessor:
     """Manifest Processing
     
-    This class processes multiple images with their manifests.
+    This class processes multiple images with their manifests. While the
+    manifest of one image is processed, the next settings.SQUASHFS_PREFETCH
+    queued images are prepared on a worker thread.
     """
     
-    def __init__(self, dbstore):
+    def __init__(self, dbstore, transactions, completed_cache):
         """Constructor
         
         Create a new ManifestProcessor instance.
         
         @param dbstore Reference to the database store
+        @param transactions Registry of in-flight transactions
+        @param completed_cache Cache of finished software operations
         """
 
         #
-        # A queue of Manifest objects waiting to be processed.
+        # A queue of UpdateImage objects waiting to be processed.
         #
         self.image_queue = deque()
         
         # File name we will use to read and store
         # all completed software operations.
         self.dbstore = dbstore
+        self.transactions = transactions
+        self.completed_cache = completed_cache
 
         self.current_manifest = None
-        self.mount_point = None
-        self.manifest_file = None
+        self.current_image = None
+        self.image_count = 0
+
+        # Tuple (update id, results) of the update rejected by the last
+        # call of load_next_manifest(), None if no update was rejected
+        self.rejected = None
+
+        # Space reserved for images being prepared in the background
+        self.reserved_space = 0
+        self.workers = None
+        if settings.SQUASHFS_PREFETCH > 0:
+            self.workers = worker.WorkerPool(1)
 
 
     def queue_image(self, image_path):
@@ -63,9 +243,70 @@ class ManifestProcessor:
         @param image_path Path to the image
         """
         logger.debug('SoftwareLoadingManager.ManifestProcessor.queue_image(%s): Called.', image_path)
-        self.image_queue.appendleft(image_path)
+        self.image_count = self.image_count + 1
+        if not settings.SQUASHFS_MOUNT_POINT.endswith('/'):
+            mount_point = settings.SQUASHFS_MOUNT_POINT + '/'
+        else:
+            mount_point = settings.SQUASHFS_MOUNT_POINT
+        mount_point = mount_point + "{}.{}".format(os.getpid(), self.image_count)
+        self.image_queue.appendleft(UpdateImage(image_path, mount_point))
+        self.prefetch_images()
+
+
+    def get_free_space(self):
+        """Get the free space below the mount point
+
+        @return Free space in bytes, None if it cannot be determined
+        """
+        try:
+            if not os.path.isdir(settings.SQUASHFS_MOUNT_POINT):
+                os.makedirs(settings.SQUASHFS_MOUNT_POINT)
+            st = os.statvfs(settings.SQUASHFS_MOUNT_POINT)
+        except OSError as e:
+            logger.warning('SoftwareLoadingManager.ManifestProcessor.get_free_space(): Failed: %s.', e)
+            return None
+        return st.f_bavail * st.f_frsize
+
+
+    def prefetch_images(self):
+        """Prepare the next queued images in the background
+
+        Submits the next settings.SQUASHFS_PREFETCH images of the queue for
+        preparation, as long as the space they are estimated to take leaves
+        settings.SQUASHFS_PREFETCH_MIN_FREE bytes free below the mount point.
+        """
+        if not self.workers:
+            return
+        # The next image to process is at the right end of the queue.
+        for image in list(reversed(self.image_queue))[:settings.SQUASHFS_PREFETCH]:
+            if image.preparing or image.valid is not None:
+                continue
+            required = image.get_required_space()
+            if required > 0:
+                free = self.get_free_space()
+                if free is None or \
+                   free - self.reserved_space - required < settings.SQUASHFS_PREFETCH_MIN_FREE:
+                    logger.info('SoftwareLoadingManager.ManifestProcessor.prefetch_images(): Not enough space to prepare %s.',
+                                image.image_path)
+                    return
+            logger.debug('SoftwareLoadingManager.ManifestProcessor.prefetch_images(): Preparing %s.', image.image_path)
+            image.preparing = True
+            image.reserved = required
+            self.reserved_space = self.reserved_space + required
+            self.workers.submit(image.prepare, lambda result, error, image=image: self.prefetch_done(image))
+
+
+    def prefetch_done(self, image):
+        """Main loop callback for an image that has been prepared
+
+        @param image UpdateImage object
+        """
+        logger.debug('SoftwareLoadingManager.ManifestProcessor.prefetch_done(%s): Valid: %s.', image.image_path, image.valid)
+        self.reserved_space = self.reserved_space - image.reserved
+        image.reserved = 0
+        image.preparing = False
+
 
-    
     #
     # Load the next manifest to process from the queue populated
     # by queue_manifest()
@@ -73,7 +314,15 @@ class ManifestProcessor:
     def load_next_manifest(self):
         """Load next manifest from image
         
-        Mount the squashfs image and load the manifest in it for processing.
+        Load the manifest of the next squashfs image for processing. The
+        image may have been prepared in the background already, otherwise
+        it is prepared now. If settings.SQUASHFS_MANIFEST_CMD is set and the
+        image has not been prepared in the background, only its manifest is
+        extracted and the image is mounted only if the manifest has operations
+        left to process.
+        
+        If the image or its manifest is rejected, the update id and the
+        results to report for it are kept in self.rejected.
         
         @return True if successful, False otherwise
         """
@@ -84,69 +333,72 @@ class ManifestProcessor:
         logger.debug('SoftwareLoadingManager.ManifestProcessor.load_next_manifest(): Called.')
 
         #
-        # Unmount previous mount point
+        # Unmount previous image
         #
-        if self.mount_point:
-            try:
-                command = list(settings.SQUASHFS_UNMOUNT_CMD)
-                command.append(self.mount_point)
-                subprocess.check_call(command)
-            except subprocess.CalledProcessError as e:
-                logger.error('SoftwareLoadingManager.ManifestProcessor.load_next_manifest(): Failed to unmount %s: %s.',
-                             self.mount_point, e)
-        self.mount_point = None
+        if self.current_image:
+            self.current_image.unmount()
+        self.current_image = None
         self.current_manifest = None
+        self.rejected = None
         
         if len(self.image_queue) == 0:
             logger.debug('SoftwareLoadingManager.ManifestProcessor.load_next_manifest(): Image queue is empty.')
             return False
         logger.debug('SoftwareLoadingManager.ManifestProcessor.load_next_manifest(): Manifests in queue: %s.', len(self.image_queue))
 
-        image_path = self.image_queue.pop()
-        logger.debug('SoftwareLoadingManager.ManifestProcessor.load_next_manifest(): Processing update image: %s.', image_path)
+        image = self.image_queue.pop()
+        self.current_image = image
+        logger.debug('SoftwareLoadingManager.ManifestProcessor.load_next_manifest(): Processing update image: %s.', image.image_path)
 
-        # Mount the file system
-        if not settings.SQUASHFS_MOUNT_POINT.endswith('/'):
-            self.mount_point = settings.SQUASHFS_MOUNT_POINT + '/' + str(os.getpid())
-        else:
-            self.mount_point = settings.SQUASHFS_MOUNT_POINT + str(os.getpid())
-        logger.debug('SoftwareLoadingManager.ManifestProcessor.load_next_manifest(): Creating mount point: %s.', self.mount_point)
-        try:
-            os.makedirs(self.mount_point)
-        except OSError as e:
-            logger.error('SoftwareLoadingManager.ManifestProcessor.load_next_manifest(): Failed creating mount point %s: %s.', self.mount_point, e)
-            pass
-        try:
-            command = settings.SQUASHFS_MOUNT_CMD.format(
-                    mount_point=self.mount_point,
-                    image_path=image_path).split()
-            subprocess.check_call(command)
-        except subprocess.CalledProcessError as e:
-            logger.error('SoftwareLoadingManager.ManifestProcessor.load_next_manifest(): Failed mounting %s on %s: %s.',
-                         image_path, self.mount_point, e)
+        if image.preparing:
+            # Wait for the worker thread to finish preparing the image.
+            image.prepared.wait()
+        elif image.valid is None:
+            image.prepare(mount=False)
+        self.prefetch_images()
+
+        if not image.valid:
+            image.unmount()
+            self.current_image = None
+            self.rejected = (image.image_path,
+                             [ swm.result(image.image_path,
+                                          swm.SWMResult.SWM_RES_VALIDATION_FAILED,
+                                          "Invalid update image") ])
             return False
 
         # Create the new manifest object
-        # Specify manifest file to load
-        self.manifest_file= "{}/update_manifest.json".format(self.mount_point)
         try:
-            self.current_manifest = manifest.Manifest(self.mount_point, self.manifest_file, self.dbstore)
+            self.current_manifest = manifest.Manifest(image.mount_point, image.manifest_file,
+                                                      self.dbstore, self.transactions,
+                                                      self.completed_cache)
         except Exception as e:
             logger.error('SoftwareLoadingManager.ManifestProcessor.load_next_manifest(): Failed loading manifest: %s.', e)
             traceback.print_exc()
-    
-        if not self.current_manifest:
+        image.remove_manifest()
+
+        result_text = "Invalid manifest"
+        if self.current_manifest and self.current_manifest.loaded:
+            if len(self.current_manifest.operations) == 0:
+                # Nothing left to do, the image is not needed.
+                image.unmount()
+            elif not image.mounted and not image.mount():
+                self.current_manifest.loaded = False
+                result_text = "Failed to mount update image"
+
+        if not self.current_manifest or not self.current_manifest.loaded:
+            update_id = image.image_path
+            results = []
+            if self.current_manifest:
+                update_id = self.current_manifest.update_id or update_id
+                results = self.current_manifest.operation_results
+            self.rejected = (update_id,
+                             results + [ swm.result(update_id,
+                                                    swm.SWMResult.SWM_RES_VALIDATION_FAILED,
+                                                    result_text) ])
             self.current_manifest = None
             # Unmount file system
-            try:
-                command = list(settings.SQUASHFS_UNMOUNT_CMD)
-                command.append(self.mount_point)
-                subprocess.check_call(command)
-            except subprocess.CalledProcessError as e:
-                logger.error('SoftwareLoadingManager.ManifestProcessor.load_next_manifest(): Failed unmounting %s: %s.',
-                             self.mount_point, e)
-            self.mount_point = None
+            image.unmount()
+            self.current_image = None
             return False
 
         return True
-    
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+""" Manifest Reader
+
+This module provides an incremental reader for manifest files. The
+operations of a manifest are decoded one at a time while the file is
+read, so that the whole manifest never has to be held in memory.
+
+(c) 2015, 2016 - Jaguar Land Rover.
+Mozilla Public License 2.0
+"""
+
+import re
+import json
+import settings
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+
+class ManifestReader:
+    """Incremental reader of a manifest file
+
+    The reader decodes the top-level object of a manifest member by member.
+    The elements of the operations array are decoded one by one as they are
+    requested. Only the data of the element currently decoded is kept in the
+    read buffer.
+
+    Errors in the JSON syntax are raised as ValueError, like json.loads().
+    """
+
+    # Top-level member whose array elements are decoded one at a time
+    STREAMED_MEMBER = "operations"
+
+    def __init__(self, f, read_size=None):
+        """Constructor
+
+        @param f File object to read the manifest from
+        @param read_size Number of bytes read from the file at a time,
+                         settings.MANIFEST_READ_SIZE if None
+        """
+        self.file = f
+        self.read_size = read_size or settings.MANIFEST_READ_SIZE
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        # File offset of the start of the buffer
+        self.offset = 0
+        self.eof = False
+
+
+    def read(self, size=0):
+        """Read more data from the file into the buffer
+
+        Data that has already been decoded is dropped from the buffer.
+
+        @param size Minimum number of bytes to read, at least self.read_size
+                    bytes are read
+
+        @return True if data was read, False at the end of the file
+        """
+        if self.eof:
+            return False
+        data = self.file.read(max(size, self.read_size))
+        if not data:
+            self.eof = True
+            return False
+        self.offset = self.offset + self.pos
+        self.buffer = self.buffer[self.pos:] + data
+        self.pos = 0
+        return True
+
+
+    def peek(self):
+        """Get the next character that is not whitespace
+
+        The character is not consumed.
+
+        @return Next character, empty string at the end of the file
+        """
+        while True:
+            self.pos = _WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.read():
+                return ""
+
+
+    def expect(self, characters):
+        """Consume the next character that is not whitespace
+
+        @param characters String with the characters expected
+
+        @return Character consumed. Raises ValueError if the next character
+                is not one of characters.
+        """
+        c = self.peek()
+        if not c or c not in characters:
+            raise ValueError("Expecting one of '{}' at offset {}".format(characters, self.offset + self.pos))
+        self.pos = self.pos + 1
+        return c
+
+
+    def decode(self):
+        """Decode the next JSON value
+
+        @return Decoded value. Raises ValueError if the value is not valid.
+        """
+        self.peek()
+        while True:
+            try:
+                (value, end) = self.decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                # The value may continue beyond the buffer. Reading at least
+                # as much as is pending keeps decoding long values linear.
+                if not self.read(len(self.buffer) - self.pos):
+                    raise
+                continue
+            # A number ending with the buffer may have more digits.
+            if end == len(self.buffer) and self.read():
+                continue
+            self.pos = end
+            return value
+
+
+    def elements(self):
+        """Generator decoding the elements of an array one at a time
+
+        The opening bracket must have been consumed.
+        """
+        if self.peek() == "]":
+            self.pos = self.pos + 1
+            return
+        while True:
+            yield self.decode()
+            if self.expect(",]") == "]":
+                return
+
+
+    def members(self):
+        """Generator decoding the members of the manifest
+
+        Yields a tuple (name, value) for each member of the top-level object.
+        The value of the operations member is a generator yielding its elements.
+        Elements that have not been consumed when the next member is requested
+        are skipped.
+        """
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos = self.pos + 1
+        else:
+            while True:
+                name = self.decode()
+                if not isinstance(name, basestring):
+                    raise ValueError("Expecting member name at offset {}".format(self.offset + self.pos))
+                self.expect(":")
+                if name == self.STREAMED_MEMBER and self.peek() == "[":
+                    self.pos = self.pos + 1
+                    elements = self.elements()
+                    yield (name, elements)
+                    for element in elements:
+                        pass
+                else:
+                    yield (name, self.decode())
+                if self.expect(",}") == "}":
+                    break
+        if self.peek():
+            raise ValueError("Extra data at offset {}".format(self.offset + self.pos))
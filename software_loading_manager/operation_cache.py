@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+""" Completed Operation Cache
+
+This module provides an in-memory cache of the software operations that
+have been finished, so that already processed operations of a manifest
+can be recognized without loading them from the database.
+
+(c) 2015, 2016 - Jaguar Land Rover.
+Mozilla Public License 2.0
+"""
+
+import database
+import settings
+import logging
+
+logger = logging.getLogger(settings.LOGGER)
+
+
+class CompletedOperationCache:
+    """Cache of finished software operations
+
+    The cache holds the (update id, operation id) pairs of all software
+    operations with status finished. It is loaded from the database with a
+    single query and kept up to date as operations are finished. The cache
+    is exact, a lookup never reports an operation as finished that is not
+    finished in the database and vice versa.
+    """
+
+    def __init__(self, store):
+        """Constructor
+
+        @param store Reference to the database store
+        """
+        self.store = store
+        self.operations = set()
+        self.load()
+
+
+    def load(self):
+        """Load the cache from the database
+
+        @return True if successful, False otherwise
+        """
+        try:
+            result = self.store.execute("SELECT updateId, id FROM SWOperation WHERE status = ?",
+                                        (database.SWOperation.ST_FINISHED,))
+            self.operations = set(result.get_all())
+            self.store.commit()
+        except Exception as e:
+            logger.error('SoftwareLoadingManager.CompletedOperationCache.load(): Exception: %s.', e)
+            self.operations = set()
+            return False
+        logger.debug('SoftwareLoadingManager.CompletedOperationCache.load(): %s finished operations.', len(self.operations))
+        return True
+
+
+    def contains(self, update_id, operation_id):
+        """Check if a software operation is finished
+
+        @param update_id Id of the software update
+        @param operation_id Id of the software operation
+
+        @return True if the software operation is finished, False otherwise
+        """
+        return (unicode(update_id), unicode(operation_id)) in self.operations
+
+
+    def add(self, update_id, operation_id):
+        """Add a software operation that has been finished
+
+        @param update_id Id of the software update
+        @param operation_id Id of the software operation
+        """
+        self.operations.add((unicode(update_id), unicode(operation_id)))
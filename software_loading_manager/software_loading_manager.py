@@ -8,8 +8,11 @@ import gobject
 import dbus.service
 from dbus.mainloop.glib import DBusGMainLoop
 import manifest_processor
+import transaction
+import operation_cache
 import traceback
 import sys
+import time
 import getopt
 import os
 import swm
@@ -25,7 +28,14 @@ logger = logging.getLogger(settings.LOGGER)
 #
 class SLMService(dbus.service.Object):
     def __init__(self, dbstore):
-        self.manifest_processor = manifest_processor.ManifestProcessor(dbstore)
+        self.dbstore = dbstore
+        self.transactions = transaction.TransactionRegistry(self.transaction_timeout)
+        self.completed_cache = operation_cache.CompletedOperationCache(dbstore)
+        self.manifest_processor = manifest_processor.ManifestProcessor(dbstore, self.transactions,
+                                                                       self.completed_cache)
+        # Apply the database retention periodically while idle
+        self.retention_running = False
+        gobject.timeout_add_seconds(settings.DB_RETENTION_INTERVAL, self.start_retention)
         # Define our own bus name
         bus_name = dbus.service.BusName('org.genivi.SoftwareLoadingManager', bus=dbus.SessionBus())        
         # Define our own object on the SoftwareLoadingManager bus
@@ -33,7 +43,7 @@ class SLMService(dbus.service.Object):
 
             
     def initiate_download(self, package_id):
-        swm.dbus_method("org.genivi.SotaClient", "initiateDownload", package_id)
+        swm.dbus_method_async("org.genivi.SotaClient", "initiateDownload", package_id)
 
     # 
     # Distribute a report of a completed installation
@@ -43,44 +53,72 @@ class SLMService(dbus.service.Object):
     def distribute_update_result(self, 
                                  update_id, 
                                  results):
+        recipients = [ "org.genivi.SotaClient" ]
         if settings.HMI_ENABLED:
-            # Send installation report to HMI
-            logger.info('SoftwareLoadingManager.SLMService.distribute_update_result(%s): Sending report to Hmi.updateReport().', update_id)
-            swm.dbus_method("org.genivi.Hmi", "updateReport", dbus.String(update_id), results)
+            recipients.append("org.genivi.Hmi")
 
-        # Send installation report to SOTA
-        logger.debug('SoftwareLoadingManager.SLMService.distribute_update_result(%s): Sending report to SotaClient.updateReport().', update_id)
-        swm.dbus_method("org.genivi.SotaClient", "updateReport", dbus.String(update_id), results)
+        # Send installation report to SOTA and HMI concurrently
+        logger.debug('SoftwareLoadingManager.SLMService.distribute_update_result(%s): Sending report to %s.', update_id, recipients)
+        swm.dbus_broadcast(recipients, "updateReport", dbus.String(update_id), results)
 
     def get_current_manifest(self):
         return self.manifest_processor.current_manifest
 
-    def start_next_manifest(self):
-        if not self.manifest_processor.load_next_manifest():
+    def is_idle(self):
+        return not self.get_current_manifest() and len(self.manifest_processor.image_queue) == 0
+
+    def start_retention(self):
+        #
+        # Timer callback. Run the database retention in steps from the
+        # main loop, so that incoming dbus calls are not held up.
+        #
+        if not self.retention_running:
+            self.retention_running = True
+            gobject.idle_add(self.run_retention_step)
+        return True
+
+    def run_retention_step(self):
+        #
+        # Stop as soon as an update is being processed. The retention
+        # continues with the next timer.
+        #
+        if not self.is_idle():
+            self.retention_running = False
             return False
 
+        removed = database.pruneDatabase(self.dbstore, settings.DB_RETENTION_BATCH)
+        if removed:
+            self.completed_cache.load()
+        released = database.vacuumDatabase(self.dbstore, settings.DB_VACUUM_PAGES)
+        if removed == settings.DB_RETENTION_BATCH or released == settings.DB_VACUUM_PAGES:
+            return True
+
+        self.retention_running = False
+        logger.info('SoftwareLoadingManager.SLMService.run_retention_step(): Database metrics: %s.',
+                    database.getDatabaseMetrics(self.dbstore))
+        return False
+
+    def start_next_manifest(self):
+        #
+        # Report updates whose image or manifest is rejected as failed
+        # and carry on with the next queued image.
+        #
+        while not self.manifest_processor.load_next_manifest():
+            if not self.manifest_processor.rejected:
+                return False
+            (update_id, results) = self.manifest_processor.rejected
+            logger.warning('SoftwareLoadingManager.SLMService.start_next_manifest(): Update %s rejected.', update_id)
+            self.distribute_update_result(update_id, results)
+
         manifest = self.get_current_manifest()
         self.inform_hmi_of_new_manifest(manifest)
-        # 
-        # This whole manifest may already have been executed and stored
-        # as completed by the manifest_processor. If so, distribute the
-        # given result
-        # 
-        if not manifest.start_next_operation():
-            self.distribute_update_result(manifest.update_id,
-                                          manifest.operation_results)
-            # Recursively call self to engage next manifest.
-            return self.start_next_manifest()
-
-        if settings.HMI_ENABLED:
-            self.inform_hmi_of_new_operation(manifest.active_operation)
-        return True
+        return self.start_next_operation()
         
     def inform_hmi_of_new_operation(self,op):
         logger.info('inform hmi of new operation')
         if settings.HMI_ENABLED:
-            swm.dbus_method("org.genivi.Hmi", "operationStarted",
-                            op.operation_id, op.time_estimate, op.hmi_message)
+            swm.dbus_method_async("org.genivi.Hmi", "operationStarted",
+                                  op.operation_id, op.time_estimate, op.hmi_message)
         return None
     
     def inform_hmi_of_new_manifest(self,manifest):
@@ -89,43 +127,58 @@ class SLMService(dbus.service.Object):
             total_time = total_time + op.time_estimate
 
         if settings.HMI_ENABLED:
-            swm.dbus_method("org.genivi.Hmi", "manifestStarted",
-                            manifest.update_id, total_time, manifest.description)
+            swm.dbus_method_async("org.genivi.Hmi", "manifestStarted",
+                                  manifest.update_id, total_time, manifest.description)
         return None
     
     def start_next_operation(self):
-        #
-        # If we are currently not processing an image, load
-        # the one we just queued.
-        #
-        
         #
         # No manifest loaded.
         # Load next manifest and, if successful, start the
-        # fist operation in said manifest
+        # operations in said manifest that are ready to go.
         #
         manifest = self.get_current_manifest()
         if not manifest:
             return self.start_next_manifest()
 
-        # We have an active manifest. Check if we have an active operation.
-        # If so return success
-        if  manifest.active_operation:
+        # We have an active manifest. Start all operations
+        # that are ready and inform the HMI about them.
+        for op in manifest.start_next_operations():
+            self.inform_hmi_of_new_operation(op)
+
+        # If we are still waiting on callback replies the
+        # manifest is in progress.
+        if not manifest.is_finished():
             return True
 
+        # 
+        # All operations of the manifest have been processed, or
+        # had already been processed and stored as completed by the
+        # manifest_processor. Distribute the result and engage
+        # the next manifest.
+        # 
+        self.distribute_update_result(manifest.update_id,
+                                      manifest.operation_results)
+        database.checkpointDatabase(manifest.dbstore, settings.DB_CHECKPOINT_FINISHED)
+        return self.start_next_manifest()
 
-        # We have an active manifest, but no active operation.
-        # Try to start the next operation.
-        # If that fails, we are out of operations in the current
-        # manifest. Try to load the next manifest, which
-        # will also start its first operation.
-        if not manifest.start_next_operation():
-            return self.manifest_processor.load_next_manifest()
+    def transaction_timeout(self, expired):
+        #
+        # No result was received for a dispatched operation in time.
+        # Dispatch it again under the same transaction id if it can
+        # safely be carried out twice or, otherwise and once the
+        # retries are used up, abort it and carry on with the manifest.
+        #
+        manifest = expired.manifest
+        if manifest is not self.get_current_manifest():
+            return None
 
-        # Inform HMI of active operation
-        if settings.HMI_ENABLED:
-            self.inform_hmi_of_new_operation(manifest.active_operation)
-        return True
+        if expired.attempt <= settings.TRANSACTION_MAX_RETRIES and \
+           manifest.retry_operation(expired):
+            return None
+        manifest.expire_operation(expired)
+        self.start_next_operation()
+        return None
 
     @dbus.service.method("org.genivi.SoftwareLoadingManager",
                          async_callbacks=('send_reply', 'send_error'))
@@ -153,7 +206,7 @@ class SLMService(dbus.service.Object):
         #
         if request_confirmation:
             logger.debug('SoftwareLoadingManager.SLMService.updateAvailable(): Called Hmi.updateNotification().')
-            swm.dbus_method("org.genivi.Hmi", "updateNotification", update_id, description)
+            swm.dbus_method_async("org.genivi.Hmi", "updateNotification", update_id, description)
             return None
 
         logger.debug('SoftwareLoadingManager.SLMService.updateAvailable(): No user cnfirmation requested: initiating download.')
@@ -254,21 +307,98 @@ class SLMService(dbus.service.Object):
             # their own calls (nested calls).
             #
             send_reply(True)
+            self.complete_transaction(transaction_id, result_code, result_text)
+        except Exception as e:
+            logger.error('SoftwareLoadingManager.SLMService.operationResult(): Failed to process operation result: %s.', e)
+            traceback.print_exc()
+        return None
+
+    #
+    # Receive the progress of an operation that takes long, such as
+    # writing a disk partition.
+    #
+    @dbus.service.method("org.genivi.SoftwareLoadingManager",
+                         async_callbacks=('send_reply', 'send_error'))
+    def operationProgress(self, 
+                          transaction_id, 
+                          completed, 
+                          total,
+                          send_reply,
+                          send_error): 
+
+        logger.debug('SoftwareLoadingManager.SLMService.operationProgress(%s, %s, %s): Called.',
+                     transaction_id, completed, total)
+        
+        try:
+            # Send back an immediate reply since DBUS
+            # doesn't like python dbus-invoked methods to do 
+            # their own calls (nested calls).
+            #
+            send_reply(True)
+            # An operation making progress has not timed out.
+            transaction = self.transactions.extend(transaction_id)
+            if transaction:
+                elapsed = max(time.time() - transaction.dispatch_time, 0.001)
+                logger.info('SoftwareLoadingManager.SLMService.operationProgress(): Operation %s: %s of %s bytes (%.1f MB/s).',
+                            transaction.operation.operation_id, completed, total, completed / elapsed / 1e6)
+        except Exception as e:
+            logger.error('SoftwareLoadingManager.SLMService.operationProgress(): Failed to process operation progress: %s.', e)
+        return None
 
-            manifest = self.get_current_manifest()
-            if not manifest:
-                logger.warning('SoftwareLoadingManager.SLMService.operationResult(): No manifest to handle callback reply.')
-                return None
+    #
+    # Receive and process the results of a batch operation,
+    # one result per item of the batch.
+    #
+    @dbus.service.method("org.genivi.SoftwareLoadingManager",
+                         async_callbacks=('send_reply', 'send_error'))
+    def operationResults(self, 
+                         transaction_id, 
+                         results,
+                         send_reply,
+                         send_error): 
 
-            manifest.complete_operation(transaction_id, result_code, result_text)
-            if not self.start_next_operation():
-                self.distribute_update_result(manifest.update_id,
-                                              manifest.operation_results)
+        logger.debug('SoftwareLoadingManager.SLMService.operationResults(%s, %s): Called.',
+                     transaction_id, results)
+        
+        try:
+            # Send back an immediate reply since DBUS
+            # doesn't like python dbus-invoked methods to do 
+            # their own calls (nested calls).
+            #
+            send_reply(True)
+            self.complete_transaction(transaction_id, None, None, results)
         except Exception as e:
-            logger.error('SoftwareLoadingManager.SLMService.operationResult(): Failed to process operation result: %s.', e)
+            logger.error('SoftwareLoadingManager.SLMService.operationResults(): Failed to process operation results: %s.', e)
             traceback.print_exc()
         return None
 
+    def complete_transaction(self, transaction_id, result_code, result_text, results=None):
+        # Look up the transaction. Late replies to expired transactions
+        # and duplicate replies are no longer in flight.
+        completed = self.transactions.complete(transaction_id)
+        if not completed:
+            logger.warning('SoftwareLoadingManager.SLMService.complete_transaction(%s): Unknown or expired transaction.', transaction_id)
+            return None
+
+        manifest = self.get_current_manifest()
+        if completed.manifest is not manifest:
+            logger.warning('SoftwareLoadingManager.SLMService.complete_transaction(%s): No manifest to handle callback reply.', transaction_id)
+            return None
+
+        manifest.complete_operation(completed.transaction_id, result_code, result_text, results)
+        self.start_next_operation()
+        return None
+
+    @dbus.service.method("org.genivi.SoftwareLoadingManager",
+                         out_signature="tttuu")
+    def getDatabaseMetrics(self):
+        logger.debug('SoftwareLoadingManager.SLMService.getDatabaseMetrics(): Called.')
+        metrics = database.getDatabaseMetrics(self.dbstore)
+        if not metrics:
+            raise dbus.exceptions.DBusException("Failed to read database metrics")
+        return (metrics.get("size", 0), metrics.get("freeSize", 0), metrics.get("walSize", 0),
+                metrics["updates"], metrics["operations"])
+
     @dbus.service.method("org.genivi.SoftwareLoadingManager")
     def getInstalledPackages(self, include_packegs, include_module_firmware): 
         logger.debug('SoftwareLoadingManager.SLMService.getInstalledPackages(%s, %s): Called.',
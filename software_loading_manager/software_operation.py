@@ -10,95 +10,324 @@ import os
 import subprocess
 import dbus
 import swm
+import fidl
 import settings
 import logging
 
 logger = logging.getLogger(settings.LOGGER)
 
+def _image_path(mount_point, image):
+    """Prepend the mount point of the update to an image path
+    """
+    return "{}/{}".format(mount_point, image)
+
+def _image_paths(mount_point, images):
+    """Prepend the mount point of the update to a list of image paths
+    """
+    return dbus.Array(["{}/{}".format(mount_point, image) for image in images], 's')
+
+
+#
+# Operation descriptor
+# Compiled form of an operation defined in settings.OPERATIONS.
+#
+class OperationDescriptor(object):
+    __slots__ = ("operation", "path", "method", "arguments")
+
+    #
+    # Ugly workaround.
+    # We need to prepend the image path with
+    # the mount point so that the recipient (partition_manager, etc)
+    # can open it.
+    #
+    CONVERSIONS = {
+        "image": _image_path,
+        "images": _image_paths
+    }
+
+    def __init__(self, operation, descriptor):
+        """Constructor
+
+        @param operation Name of the operation as used in the manifest
+        @param descriptor Definition of the operation in settings.OPERATIONS
+        """
+        (self.path, self.method, arguments, parameters) = descriptor
+        self.operation = operation
+        signatures = self.get_signatures(len(arguments))
+
+        # Tuples (argument, mandatory, default value, conversion, marshaller)
+        # in the order of the arguments of the dbus method.
+        compiled = []
+        for ((argument, default_value), signature) in zip(arguments, signatures):
+            if isinstance(default_value, list) and not default_value:
+                # this is only necessary for empty lists as dbus won't be able to detect
+                # the type from an empty list, hence create an empty string list explicitly.
+                default_value = dbus.Array(default_value, 's')
+            compiled.append((argument, default_value is None, default_value,
+                             self.CONVERSIONS.get(argument), fidl.marshaller(signature)))
+        self.arguments = tuple(compiled)
+
+    def get_signatures(self, count):
+        """Get the D-Bus signatures of the arguments of the dbus method
+
+        The signatures are taken from the Franca IDL definition of the
+        method. Its first argument, the transaction id, is not included.
+
+        @param count Number of arguments of the operation
+
+        @return List of count signatures, None for arguments whose values
+                are passed to dbus-python as they are
+        """
+        registry = fidl.get_registry()
+        if not registry:
+            return [ None ] * count
+        interface = fidl.get_interface(self.path)
+        arguments = registry.get_arguments(interface, self.method)
+        if arguments is None:
+            logger.debug('SoftwareLoadingManager.OperationDescriptor(%s): No definition of %s.%s().',
+                         self.operation, interface, self.method)
+            return [ None ] * count
+        if len(arguments) != count + 1:
+            logger.warning('SoftwareLoadingManager.OperationDescriptor(%s): %s.%s() has %s arguments, operation has %s. Arguments are not converted.',
+                           self.operation, interface, self.method, len(arguments) - 1, count)
+            return [ None ] * count
+        return [ signature for (name, signature) in arguments[1:] ]
+
+    def build_arguments(self, op_obj, operation_id):
+        """Extract the arguments of the dbus method from a manifest operation
+
+        @param op_obj Manifest element of the operation
+        @param operation_id Id of the operation
+
+        @return Tuple (arguments, named_arguments) with the list of arguments
+                in dbus order and the dictionary of arguments by name. Raises an
+                exception if a mandatory argument is missing or does not match
+                the signature of the dbus method.
+        """
+        values = []
+        named_values = {}
+        for (argument, mandatory, value, conversion, marshal) in self.arguments:
+            if argument in op_obj:
+                value = op_obj[argument]
+            elif mandatory:
+                raise Exception("Element {} not defined in operation: {}".format(argument, operation_id))
+            if conversion:
+                value = conversion(op_obj['mountPoint'], value)
+            if marshal:
+                try:
+                    value = marshal(value)
+                except (TypeError, ValueError) as e:
+                    raise Exception("Element {} of operation {}: {}".format(argument, operation_id, e))
+            values.append(value)
+            named_values[argument] = value
+        return (values, named_values)
+
+
+# Descriptors of all operations in settings.OPERATIONS by operation name,
+# compiled when the module is loaded.
+DESCRIPTORS = dict([ (operation, OperationDescriptor(operation, descriptor))
+                     for (operation, descriptor) in settings.OPERATIONS.iteritems() ])
+
+
 #
 # Software operation
 # Contains a single software operation
 # loaded from a manifest file.
 #
-class SoftwareOperation:
+class SoftwareOperation(object):
+    __slots__ = ("operation_id", "operation", "path", "method",
+                 "arguments", "named_arguments", "time_estimate",
+                 "description", "hmi_message", "on_failure", "depends_on",
+                 "parallel", "index", "op_obj")
+
     def __init__(self, op_obj):
-        logger.debug('SoftwareLoadingManager.SoftwareOperation: Called: %s', op_obj)
         # Retrieve unique id for sofware operation
         if not 'id' in op_obj:
-            raise Exception("SoftwareOperation(): 'id' not defined in: {}".format(op_obj))
+            raise Exception("SoftwareOperation(): 'id' not defined in operation.")
 
         self.operation_id = op_obj['id']
-        self.arguments = []
+        self.arguments = None
+        self.named_arguments = None
         self.time_estimate = op_obj.get('timeEstimate', 0)
         self.description = op_obj.get('description', '')
         self.hmi_message = op_obj.get('hmiMessage', '')
         self.on_failure = op_obj.get('onFailure', 'continue')
+        self.depends_on = op_obj.get('dependsOn', ())
+        self.parallel = op_obj.get('parallel', False)
+        # Position of the operation in the manifest. Unless the operation
+        # is parallel, it waits for all operations before that position.
+        self.index = op_obj.get('index', 0)
         
         # Retrieve operation
         if not 'operation' in op_obj:
             raise Exception("'operation' not defined in operation {}.".format(self.operation_id))
 
-        operation = op_obj['operation']
-        
-        # Retrieve the operation descriptor
-        if operation not in settings.OPERATIONS:
-            raise Exception("operation {} not supported.".format(operation))
-
-        # Store the DBUS path (org.genivi.xxx), method, and elements from
-        # software operations to provide with DBUS call.
-        (self.path, self.method, arguments, parameters) = settings.OPERATIONS[operation]
-
-        logger.debug('SoftwareLoadingManager.SoftwareOperation: operationId:  %s', self.operation_id)
-        logger.debug('SoftwareLoadingManager.SoftwareOperation: operation:    %s', operation)
-        logger.debug('SoftwareLoadingManager.SoftwareOperation: timeEstimate: %s', self.time_estimate)
-        logger.debug('SoftwareLoadingManager.SoftwareOperation: hmiMessage:   %s', self.hmi_message)
-        logger.debug('SoftwareLoadingManager.SoftwareOperation: description:  %s', self.description)
-        logger.debug('SoftwareLoadingManager.SoftwareOperation: onFailure:    %s', self.on_failure)
-        logger.debug('SoftwareLoadingManager.SoftwareOperation: path:         %s', self.path)
-        logger.debug('SoftwareLoadingManager.SoftwareOperation: method:       %s', self.method)
-
-        # Go through the list of arguments and extract them
-        # from the manifest's software operation object
-        # These arguments will be provided, in order, to the DBUS call
-        for (argument, default_value) in arguments:
-            if not argument in op_obj:
-                # Argument was not present as element in software operation
-                # and default was None, specifying that the argument
-                # is mandatory.
-                if default_value == None:
-                    logger.error('SoftwareLoadingManager.SoftwareOperation: Mandatory element %s not defined in operation', argument)
-                    raise Exception("Element {} not defined in operation: {}".format(argument,self.operation_id))
-                else:
-                    # Argument not found in software operation, but
-                    # we have a default value
-                    value = default_value
-                    if isinstance(value, list) and not value:
-                        # this is only necessary for empty lists as dbus won't be able to detect
-                        # the type from an empty list, hence create an empty string list explicitly.
-                        value = dbus.Array(value, 's')
-                    logger.debug('SoftwareLoadingManager.SoftwareOperation: method_arg %s = %s (default)', argument, value)
-            else:
-                value = op_obj[argument]
-                logger.debug('SoftwareLoadingManager.SoftwareOperation: method_arg %s = %s (manifest)', argument, value)
-
-            #
-            # Ugly workaround.
-            # We need to prepend the image path with
-            # the mount point so that the recipient (partition_manager, etc)
-            # can open it.
-            #
-            if argument == "image":
-                self.arguments.append("{}/{}".format(op_obj['mountPoint'], value))
-            else:
-                self.arguments.append(value)
-
-        print "  ----"
+        self.operation = op_obj['operation']
+        descriptor = DESCRIPTORS.get(self.operation)
+        if descriptor:
+            self.path = descriptor.path
+            self.method = descriptor.method
+        else:
+            self.path = None
+            self.method = None
+
+        # The manifest element is kept until the operation is prepared.
+        self.op_obj = op_obj
+
+    def prepare(self):
+        """Validate the operation and extract its arguments
+
+        The arguments are extracted from the manifest element only once,
+        further calls return right away.
+
+        @return Nothing. Raises an exception if the operation is not valid.
+        """
+        if self.arguments is not None:
+            return
+
+        descriptor = DESCRIPTORS.get(self.operation)
+        if not descriptor:
+            raise Exception("operation {} not supported.".format(self.operation))
+
+        (self.arguments, self.named_arguments) = descriptor.build_arguments(self.op_obj, self.operation_id)
+        self.op_obj = None
+        logger.debug('SoftwareLoadingManager.SoftwareOperation.prepare(%s): %s %s.%s()',
+                     self.operation_id, self.operation, self.path, self.method)
     
-    def send_transaction(self, transaction_id):
+    def get_operations(self):
+        """Get the manifest operations carried out by this operation
+
+        @return List with this operation
+        """
+        return [ self ]
+
+    def send_transaction(self, transaction_id, error_callback=None):
         try:
-            swm.dbus_method(self.path, self.method, transaction_id, *self.arguments)
+            call = swm.dbus_method_async(self.path, self.method, transaction_id, *self.arguments)
+            if error_callback:
+                def done(call):
+                    if call.error is not None:
+                        error_callback(transaction_id, call.error)
+                call.add_done_callback(done)
         except Exception as e:
             logger.error('SoftwareLoadingManager.SoftwareOperation.send_transaction(%s): Exception %s', transaction_id, e)
             return False
 
         return True
+
+
+#
+# Batch of software operations
+# Carries out several consecutive manifest operations
+# with a single transaction.
+#
+class SoftwareOperationBatch(SoftwareOperation):
+    __slots__ = ("operations",)
+
+    # Operations that can be batched, mapped to the operation carrying
+    # out the batch, the argument collected from each operation and the
+    # argument of the batch operation holding the collected values. If no
+    # argument is given, the operation itself is collected as a dictionary
+    # of its name and the arguments not shared by the batch. The other
+    # arguments of the batch operation must be the same for all operations.
+    BATCHES = {
+        "installPackage": ("installPackages", "image", "images"),
+        "createDiskPartition": ("changeDiskPartitions", None, "changes"),
+        "resizeDiskPartition": ("changeDiskPartitions", None, "changes"),
+        "deleteDiskPartition": ("changeDiskPartitions", None, "changes")
+    }
+
+    @classmethod
+    def same_batch(cls, first, op):
+        """Check if two operations are carried out by the same batch operation
+
+        @param first First operation of the batch
+        @param op Operation to add to the batch
+
+        @return True if both operations can be batched into the same batch
+                operation
+        """
+        return first.operation in cls.BATCHES and op.operation in cls.BATCHES and \
+            cls.BATCHES[first.operation][0] == cls.BATCHES[op.operation][0]
+
+    @classmethod
+    def can_batch(cls, first, op):
+        """Check if an operation can join a batch
+
+        Operations can be batched if they are carried out by the same batch
+        operation, share its other arguments and wait for all preceding
+        operations. Both operations must have been prepared.
+
+        @param first First operation of the batch
+        @param op Operation to add to the batch
+
+        @return True if op can be added to the batch started by first
+        """
+        if not cls.same_batch(first, op) or first.parallel or op.parallel:
+            return False
+        (batch_operation, argument, batch_argument) = cls.BATCHES[first.operation]
+        for name in cls.shared_arguments(batch_operation, batch_argument):
+            if op.named_arguments.get(name) != first.named_arguments.get(name):
+                return False
+        return True
+
+    @staticmethod
+    def shared_arguments(batch_operation, batch_argument):
+        """Get the arguments a batch operation takes from all its operations
+
+        @param batch_operation Name of the batch operation
+        @param batch_argument Argument holding the collected values
+
+        @return List of argument names
+        """
+        return [ name for (name, mandatory, default_value, conversion, marshal)
+                 in DESCRIPTORS[batch_operation].arguments if name != batch_argument ]
+
+    def __init__(self, operations):
+        first = operations[0]
+        (batch_operation, argument, batch_argument) = self.BATCHES[first.operation]
+        descriptor = DESCRIPTORS[batch_operation]
+        self.path = descriptor.path
+        self.method = descriptor.method
+
+        self.operations = operations
+        self.operation = batch_operation
+        self.operation_id = first.operation_id
+        self.time_estimate = sum([op.time_estimate for op in operations])
+        self.description = first.description
+        self.hmi_message = first.hmi_message
+        self.parallel = False
+        self.index = first.index
+        self.op_obj = None
+        if "abort" in [op.on_failure for op in operations]:
+            self.on_failure = "abort"
+        else:
+            self.on_failure = "continue"
+
+        # Batched operations are not parallel, so the batch waits for all
+        # operations preceding its first operation.
+        ids = [op.operation_id for op in operations]
+        self.depends_on = []
+
+        shared = self.shared_arguments(batch_operation, batch_argument)
+        self.named_arguments = dict([ (name, first.named_arguments[name]) for name in shared ])
+        if argument:
+            self.named_arguments[batch_argument] = dbus.Array(
+                [op.named_arguments[argument] for op in operations], 's')
+        else:
+            changes = []
+            for op in operations:
+                change = dict([ (name, value) for (name, value) in op.named_arguments.iteritems()
+                                if name not in shared ])
+                change["operation"] = op.operation
+                changes.append(dbus.Dictionary(change, signature='sv'))
+            self.named_arguments[batch_argument] = dbus.Array(changes, 'a{sv}')
+        self.arguments = [self.named_arguments[name] for (name, mandatory, default_value, conversion, marshal) in descriptor.arguments]
+        logger.debug('SoftwareLoadingManager.SoftwareOperationBatch: %s: %s', self.method, ids)
+
+    def get_operations(self):
+        """Get the manifest operations carried out by this batch
+
+        @return List of operations in the order of the per-operation results
+        """
+        return self.operations
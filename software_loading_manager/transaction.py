@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+""" Transaction Tracking
+
+This module provides classes to keep track of the transactions that
+Software Loading Manager has dispatched to other components and for
+which it is waiting on an operationResult() callback.
+
+(c) 2015, 2016 - Jaguar Land Rover.
+Mozilla Public License 2.0
+"""
+
+
+import time
+import gobject
+import settings
+import logging
+
+logger = logging.getLogger(settings.LOGGER)
+
+
+class Transaction:
+    """In-flight transaction
+
+    This class holds the information about a single dispatched software
+    operation.
+    """
+
+    def __init__(self, transaction_id, operation, manifest, timeout, attempt):
+        """Constructor
+
+        @param transaction_id Id of the transaction
+        @param operation Software operation that was dispatched
+        @param manifest Manifest the software operation belongs to
+        @param timeout Time in milliseconds to wait for the result
+        @param attempt Number of times the operation has been dispatched
+        """
+        self.transaction_id = transaction_id
+        self.operation = operation
+        self.manifest = manifest
+        self.dispatch_time = time.time()
+        self.deadline = self.dispatch_time + timeout / 1000.0
+        self.attempt = attempt
+        self.timer = None
+
+
+class TransactionRegistry:
+    """Registry of in-flight transactions
+
+    This class hands out transaction ids, unique for the lifetime of the
+    Software Loading Manager, and maps them back to the dispatched software
+    operations. A timer on the gobject main loop is armed for every transaction.
+    If no result arrives before the deadline, the timeout callback is invoked
+    with the expired transaction.
+    """
+
+    def __init__(self, timeout_callback):
+        """Constructor
+
+        @param timeout_callback Callable invoked with the Transaction object
+                                when a transaction has timed out
+        """
+        self.transactions = {}
+        self.next_transaction_id = 0
+        self.timeout_callback = timeout_callback
+
+
+    def get_timeout(self, operation):
+        """Get the time to wait for the result of an operation
+
+        @param operation Software operation
+
+        @return Timeout in milliseconds
+        """
+        return max(int(operation.time_estimate * settings.TRANSACTION_TIMEOUT_FACTOR),
+                   settings.TRANSACTION_TIMEOUT_MIN)
+
+
+    def register(self, operation, manifest, attempt=1):
+        """Register a new transaction
+
+        Allocates a new transaction id for the operation and arms its timer.
+
+        @param operation Software operation to be dispatched
+        @param manifest Manifest the software operation belongs to
+        @param attempt Number of times the operation has been dispatched
+
+        @return Transaction id
+        """
+        self.next_transaction_id = self.next_transaction_id + 1
+        transaction_id = self.next_transaction_id
+        timeout = self.get_timeout(operation)
+        transaction = Transaction(transaction_id, operation, manifest, timeout, attempt)
+        transaction.timer = gobject.timeout_add(timeout, self.expire, transaction_id)
+        self.transactions[transaction_id] = transaction
+        logger.debug('SoftwareLoadingManager.TransactionRegistry.register(%s): Operation %s, attempt %s, timeout %s ms.',
+                     transaction_id, operation.operation_id, attempt, timeout)
+        return transaction_id
+
+
+    def retry(self, transaction):
+        """Register an expired transaction again for another attempt
+
+        The transaction keeps its id, so that a late result of an earlier
+        attempt completes it as well. Its timer is armed again.
+
+        @param transaction Expired transaction
+
+        @return Transaction id
+        """
+        timeout = self.get_timeout(transaction.operation)
+        transaction.attempt = transaction.attempt + 1
+        transaction.dispatch_time = time.time()
+        transaction.deadline = transaction.dispatch_time + timeout / 1000.0
+        transaction.timer = gobject.timeout_add(timeout, self.expire, transaction.transaction_id)
+        self.transactions[transaction.transaction_id] = transaction
+        logger.debug('SoftwareLoadingManager.TransactionRegistry.retry(%s): Operation %s, attempt %s, timeout %s ms.',
+                     transaction.transaction_id, transaction.operation.operation_id, transaction.attempt, timeout)
+        return transaction.transaction_id
+
+
+    def get(self, transaction_id):
+        """Look up an in-flight transaction
+
+        @param transaction_id Id of the transaction
+
+        @return Transaction object or None if not in flight
+        """
+        try:
+            return self.transactions.get(int(transaction_id))
+        except (TypeError, ValueError):
+            return None
+
+
+    def complete(self, transaction_id):
+        """Remove a transaction from the registry
+
+        Disarms the timer of the transaction. A second call for the same
+        transaction id, e.g. caused by a late or duplicate reply, returns None.
+
+        @param transaction_id Id of the transaction
+
+        @return Transaction object or None if not in flight
+        """
+        transaction = self.get(transaction_id)
+        if not transaction:
+            return None
+        del self.transactions[transaction.transaction_id]
+        if transaction.timer:
+            gobject.source_remove(transaction.timer)
+            transaction.timer = None
+        return transaction
+
+
+    def extend(self, transaction_id):
+        """Extend the deadline of a transaction that is making progress
+
+        Rearms the timer of the transaction with the full timeout of its
+        operation, counted from now.
+
+        @param transaction_id Id of the transaction
+
+        @return Transaction object or None if not in flight
+        """
+        transaction = self.get(transaction_id)
+        if not transaction or not transaction.timer:
+            return transaction
+        timeout = self.get_timeout(transaction.operation)
+        gobject.source_remove(transaction.timer)
+        transaction.deadline = time.time() + timeout / 1000.0
+        transaction.timer = gobject.timeout_add(timeout, self.expire, transaction.transaction_id)
+        return transaction
+
+
+    def fail(self, transaction_id, error):
+        """Fail a transaction before its deadline
+
+        Used when the operation could not be delivered. The timeout callback
+        is invoked from the main loop, not from within this call.
+
+        @param transaction_id Id of the transaction
+        @param error Exception that caused the failure
+        """
+        transaction = self.get(transaction_id)
+        if not transaction:
+            return
+        logger.warning('SoftwareLoadingManager.TransactionRegistry.fail(%s): Operation %s failed: %s.',
+                       transaction_id, transaction.operation.operation_id, error)
+        if transaction.timer:
+            gobject.source_remove(transaction.timer)
+        transaction.timer = gobject.idle_add(self.expire, transaction.transaction_id)
+
+
+    def expire(self, transaction_id):
+        """Timer callback for a transaction that has not completed in time
+
+        @param transaction_id Id of the transaction
+
+        @return Always False to not reschedule the timer
+        """
+        transaction = self.transactions.pop(transaction_id, None)
+        if not transaction:
+            return False
+        transaction.timer = None
+        logger.warning('SoftwareLoadingManager.TransactionRegistry.expire(%s): Operation %s timed out after %.1f s.',
+                       transaction_id, transaction.operation.operation_id,
+                       time.time() - transaction.dispatch_time)
+        try:
+            self.timeout_callback(transaction)
+        except Exception as e:
+            logger.error('SoftwareLoadingManager.TransactionRegistry.expire(%s): Exception: %s.', transaction_id, e)
+        return False
+